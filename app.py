@@ -2,17 +2,40 @@ import logging
 import sqlite3
 import csv
 import io
+import copy
 import asyncio
 import random
 from datetime import datetime, timedelta
 import json
 import os
+import hashlib
+import math
+import heapq
+import sys
+from array import array
+import re
+import time
+import signal
+import multiprocessing
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
 from dotenv import load_dotenv
+try:
+    import numpy
+except ImportError:
+    numpy = None
 from aiogram import Bot, Dispatcher, executor, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters import Text
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.dispatcher.storage import BaseStorage
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
+from aiogram.utils.exceptions import BotBlocked, ChatNotFound, UserDeactivated
+from aiohttp import web
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, ParseMode, InputFile, ContentType, MediaGroup
 
 load_dotenv()
@@ -25,16 +48,592 @@ SUPER_ADMIN_ID = int(os.environ.get('SUPER_ADMIN_ID', '0'))
 if SUPER_ADMIN_ID == 0:
     raise ValueError("SUPER_ADMIN_ID environment variable is required!")
 
+ADMIN_REALTIME_NOTIFY = os.environ.get('ADMIN_REALTIME_NOTIFY', '0') == '1'
+ADMIN_DIGEST_INTERVAL = int(os.environ.get('ADMIN_DIGEST_INTERVAL', '3600'))
+ADMIN_DIGEST_TOP = int(os.environ.get('ADMIN_DIGEST_TOP', '10'))
+
+DB_PATH = os.environ.get('DB_PATH', 'dating_database.db')
+FSM_DB_PATH = os.environ.get('FSM_DB_PATH', DB_PATH)
+FSM_FLUSH_INTERVAL = float(os.environ.get('FSM_FLUSH_INTERVAL', '2'))
+FSM_HOT_TTL = int(os.environ.get('FSM_HOT_TTL', '600'))
+FSM_STATE_TTL = int(os.environ.get('FSM_STATE_TTL', str(7 * 24 * 3600)))
+
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+BOT_API_SERVER = os.environ.get('BOT_API_SERVER')
+SKIP_UPDATES = os.environ.get('SKIP_UPDATES', '0') == '1'
+ALLOWED_UPDATES = os.environ.get('ALLOWED_UPDATES', 'message,callback_query').split(',')
+POLLING_TIMEOUT = int(os.environ.get('POLLING_TIMEOUT', '30'))
+POLLING_LIMIT = int(os.environ.get('POLLING_LIMIT', '100'))
+POLLING_RELAX = float(os.environ.get('POLLING_RELAX', '0'))
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', '')
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or None
+WEBAPP_HOST = os.environ.get('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.environ.get('WEBAPP_PORT', '8080'))
+MAX_CONCURRENT_UPDATES = int(os.environ.get('MAX_CONCURRENT_UPDATES', '64'))
+MAX_QUEUED_UPDATES = int(os.environ.get('MAX_QUEUED_UPDATES', '1000'))
+MAX_USER_QUEUED_UPDATES = int(os.environ.get('MAX_USER_QUEUED_UPDATES', '20'))
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', '1'))
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+METRICS_SAMPLES = int(os.environ.get('METRICS_SAMPLES', '1000'))
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '50'))
+SLOW_QUERY_LOG_INTERVAL = float(os.environ.get('SLOW_QUERY_LOG_INTERVAL', '60'))
+FEED_REFRESH_INTERVAL = int(os.environ.get('FEED_REFRESH_INTERVAL', '300'))
+FEED_WINDOW = int(os.environ.get('FEED_WINDOW', '20'))
+FEED_WEIGHTS = {
+    'premium': float(os.environ.get('FEED_WEIGHT_PREMIUM', '3')),
+    'boost': float(os.environ.get('FEED_WEIGHT_BOOST', '2')),
+    'activity': float(os.environ.get('FEED_WEIGHT_ACTIVITY', '1')),
+    'reciprocity': float(os.environ.get('FEED_WEIGHT_RECIPROCITY', '2')),
+    'popularity': float(os.environ.get('FEED_WEIGHT_POPULARITY', '0.5')),
+    'impressions': float(os.environ.get('FEED_WEIGHT_IMPRESSIONS', '0.5')),
+    'age': float(os.environ.get('FEED_WEIGHT_AGE', '0.2')),
+    'recency': float(os.environ.get('FEED_WEIGHT_RECENCY', '2')),
+}
+PROFILE_INDEX_REFRESH = int(os.environ.get('PROFILE_INDEX_REFRESH', '600'))
+TIER_SCAN_LIMIT = int(os.environ.get('TIER_SCAN_LIMIT', '500'))
+TIER_EMPTY_TTL = int(os.environ.get('TIER_EMPTY_TTL', '300'))
+TIER_EMPTY_MAX = int(os.environ.get('TIER_EMPTY_MAX', '100000'))
+SKIP_TTL_DAYS = int(os.environ.get('SKIP_TTL_DAYS', '30'))
+SKIP_COMPACT_INTERVAL = int(os.environ.get('SKIP_COMPACT_INTERVAL', '3600'))
+SKIP_COMPACT_BATCH = int(os.environ.get('SKIP_COMPACT_BATCH', '1000'))
+LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL', '60'))
+ACTIVE_USER_DAYS = int(os.environ.get('ACTIVE_USER_DAYS', '7'))
+PURGE_INTERVAL = int(os.environ.get('PURGE_INTERVAL', '60'))
+PURGE_BATCH = int(os.environ.get('PURGE_BATCH', '500'))
+RECORD_UPDATES_DIR = os.environ.get('RECORD_UPDATES_DIR', '')
+RECORD_UPDATES_MAX_BYTES = int(os.environ.get('RECORD_UPDATES_MAX_BYTES', str(50 * 1024 * 1024)))
+RECORD_UPDATES_SALT = os.environ.get('RECORD_UPDATES_SALT', '')
+THROTTLE_LIMITS = {
+    'search': os.environ.get('THROTTLE_SEARCH', '5/10'),
+    'like': os.environ.get('THROTTLE_LIKE', '10/10'),
+    'report': os.environ.get('THROTTLE_REPORT', '3/300'),
+    'admin': os.environ.get('THROTTLE_ADMIN', '20/10'),
+}
+if BOT_MODE not in ('polling', 'webhook'):
+    raise ValueError("BOT_MODE must be 'polling' or 'webhook'!")
+if BOT_MODE == 'webhook' and not WEBHOOK_HOST:
+    raise ValueError("WEBHOOK_HOST environment variable is required in webhook mode!")
+# Every worker must anonymize with the same key, and replay.py needs it to find recorded users
+if RECORD_UPDATES_DIR and not RECORD_UPDATES_SALT:
+    raise ValueError("RECORD_UPDATES_SALT environment variable is required when RECORD_UPDATES_DIR is set!")
+
 logging.basicConfig(level=logging.INFO)
 
-bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
+class SQLiteStorage(BaseStorage):
+    """
+    FSM storage persisted in SQLite.
+
+    Recently used states live in memory and are written back in batches every
+    FSM_FLUSH_INTERVAL seconds; every read or write also refreshes the stored
+    updated_at in the same batch. States idle longer than FSM_HOT_TTL are dropped
+    from memory, and states idle longer than FSM_STATE_TTL are deleted entirely.
+    """
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL;')
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            chat TEXT,
+            user TEXT,
+            state TEXT,
+            data TEXT,
+            bucket TEXT,
+            updated_at REAL,
+            PRIMARY KEY (chat, user)
+        )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_fsm_updated_at ON fsm_states(updated_at);')
+        self.conn.commit()
+        self.records = {}
+        self.dirty = set()
+        self.active = set()
+
+    def _record(self, chat, user) -> dict:
+        key = tuple(map(str, self.check_address(chat=chat, user=user)))
+        record = self.records.get(key)
+        if record is None:
+            row = self.conn.execute("SELECT state, data, bucket FROM fsm_states WHERE chat=? AND user=?", key).fetchone()
+            if row:
+                record = {'state': row[0], 'data': json.loads(row[1] or '{}'), 'bucket': json.loads(row[2] or '{}')}
+            else:
+                record = {'state': None, 'data': {}, 'bucket': {}}
+            self.records[key] = record
+        record['touched'] = time.time()
+        self.active.add(key)
+        return record
+
+    def _mark_dirty(self, chat, user):
+        self.dirty.add(tuple(map(str, self.check_address(chat=chat, user=user))))
+
+    def flush(self):
+        if not self.dirty and not self.active:
+            return
+        now = time.time()
+        upserts = []
+        deletes = []
+        stamps = [(now,) + key for key in self.active - self.dirty]
+        for key in self.dirty:
+            record = self.records.get(key)
+            if record is None:
+                continue
+            if record['state'] is None and not record['data'] and not record['bucket']:
+                deletes.append(key)
+            else:
+                upserts.append(key + (record['state'], json.dumps(record['data']), json.dumps(record['bucket']), now))
+        self.dirty.clear()
+        self.active.clear()
+        with self.conn:
+            if stamps:
+                self.conn.executemany("UPDATE fsm_states SET updated_at=? WHERE chat=? AND user=?", stamps)
+            if upserts:
+                self.conn.executemany("INSERT OR REPLACE INTO fsm_states (chat, user, state, data, bucket, updated_at) VALUES (?, ?, ?, ?, ?, ?)", upserts)
+            if deletes:
+                self.conn.executemany("DELETE FROM fsm_states WHERE chat=? AND user=?", deletes)
+
+    def evict(self):
+        now = time.time()
+        for key, record in list(self.records.items()):
+            if key not in self.dirty and now - record['touched'] > FSM_HOT_TTL:
+                del self.records[key]
+        with self.conn:
+            self.conn.execute("DELETE FROM fsm_states WHERE updated_at < ?", (now - FSM_STATE_TTL,))
+
+    async def run(self):
+        last_evict = time.time()
+        while True:
+            await asyncio.sleep(FSM_FLUSH_INTERVAL)
+            try:
+                self.flush()
+                if time.time() - last_evict >= FSM_HOT_TTL:
+                    self.evict()
+                    last_evict = time.time()
+            except Exception as e:
+                logging.error(f"Error in FSM storage flush: {e}")
+
+    async def close(self):
+        self.flush()
+        self.records.clear()
+
+    async def wait_closed(self):
+        self.conn.close()
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        state = self._record(chat, user)['state']
+        return state if state is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        return copy.deepcopy(self._record(chat, user)['data'])
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        self._record(chat, user)['state'] = self.resolve_state(state)
+        self._mark_dirty(chat, user)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        self._record(chat, user)['data'] = copy.deepcopy(data or {})
+        self._mark_dirty(chat, user)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        self._record(chat, user)['data'].update(copy.deepcopy(data or {}), **copy.deepcopy(kwargs))
+        self._mark_dirty(chat, user)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        return copy.deepcopy(self._record(chat, user)['bucket'])
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        self._record(chat, user)['bucket'] = copy.deepcopy(bucket or {})
+        self._mark_dirty(chat, user)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        self._record(chat, user)['bucket'].update(copy.deepcopy(bucket or {}), **copy.deepcopy(kwargs))
+        self._mark_dirty(chat, user)
+
+class Histogram:
+    bounds = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(self.bounds)
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=METRICS_SAMPLES)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.samples.append(value)
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+    def percentile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def render(self, name: str, labels: str = '') -> list:
+        sep = ',' if labels else ''
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.bucket_counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{suffix} {self.total}')
+        lines.append(f'{name}_count{suffix} {self.count}')
+        return lines
+
+class Metrics:
+    def __init__(self):
+        self.updates = Counter()
+        self.update_latency = Histogram()
+        self.update_db_time = Histogram()
+        self.update_api_time = Histogram()
+        self.handler_latency = defaultdict(Histogram)
+        self.handler_errors = Counter()
+        self.api_latency = defaultdict(Histogram)
+        self.api_errors = Counter()
+        self.query_latency = defaultdict(Histogram)
+        self.slow_queries = Counter()
+
+metrics = Metrics()
+update_timings = ContextVar('update_timings', default=None)
+current_handler_name = ContextVar('current_handler_name', default=None)
+
+def add_timing(kind: str, elapsed: float):
+    timings = update_timings.get()
+    if timings is not None:
+        timings[kind] += elapsed
+
+class HandlerErrorCounter(logging.Handler):
+    def emit(self, record):
+        name = current_handler_name.get()
+        if name:
+            metrics.handler_errors[name] += 1
+
+logging.getLogger().addHandler(HandlerErrorCounter(level=logging.ERROR))
+
+UNREACHABLE_ERRORS = ((BotBlocked, 'blocked'), (ChatNotFound, 'chat_not_found'), (UserDeactivated, 'deactivated'))
+
+class InstrumentedBot(Bot):
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        if update_recorder and data and data.get('reply_markup'):
+            update_recorder.learn_buttons(data['reply_markup'])
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception as e:
+            metrics.api_errors[method] += 1
+            chat_id = data.get('chat_id') if data else None
+            for error, reason in UNREACHABLE_ERRORS:
+                if isinstance(e, error) and str(chat_id).isdigit():
+                    mark_unreachable(int(chat_id), reason)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.api_latency[method].observe(elapsed)
+            add_timing('api', elapsed)
+
+@lru_cache(maxsize=1024)
+def query_fingerprint(sql: str) -> str:
+    fingerprint = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    fingerprint = re.sub(r'\b\d+(?:\.\d+)?\b', '?', fingerprint)
+    fingerprint = re.sub(r'\s+', ' ', fingerprint).strip()
+    return re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?)', fingerprint)
+
+slow_query_logged = {}
+
+def log_slow_query(connection, sql: str, parameters, fingerprint: str, elapsed: float):
+    metrics.slow_queries[fingerprint] += 1
+    now = time.monotonic()
+    if now - slow_query_logged.get(fingerprint, -SLOW_QUERY_LOG_INTERVAL) < SLOW_QUERY_LOG_INTERVAL:
+        return
+    slow_query_logged[fingerprint] = now
+    plan = []
+    if parameters is None:
+        plan = ["no plan: empty batch"]
+    elif fingerprint.upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH')):
+        try:
+            plan = [row[3] for row in connection.execute('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()]
+        except sqlite3.Error as e:
+            plan = [f"EXPLAIN failed: {e}"]
+    full_scan = any(step.startswith('SCAN') and 'INDEX' not in step for step in plan)
+    plan_text = '\n'.join(f"  {step}" for step in plan)
+    logging.warning(f"Slow query ({elapsed * 1000:.1f} ms{', full scan' if full_scan else ''}): {fingerprint}\n{plan_text}")
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    Cursor that times every statement, including fetching its rows, by a normalized
+    fingerprint and logs statements slower than SLOW_QUERY_MS with their query plan.
+
+    SQLite does most of a SELECT's work while rows are fetched, so execute and fetch
+    time add up to one observation. It is recorded once the rows are consumed, or
+    when the next statement starts on this cursor.
+    """
+
+    statement = None
+
+    def _finish(self):
+        if self.statement is None:
+            return
+        sql, parameters, fingerprint, elapsed = self.statement
+        self.statement = None
+        metrics.query_latency[fingerprint].observe(elapsed)
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            log_slow_query(self.connection, sql, parameters, fingerprint, elapsed)
+
+    def _add(self, started: float, finished: bool):
+        elapsed = time.perf_counter() - started
+        add_timing('db', elapsed)
+        if self.statement is not None:
+            self.statement[3] += elapsed
+            if finished:
+                self._finish()
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        self.statement = [sql, parameters, query_fingerprint(sql), 0.0]
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            # Statements without a result set are complete here
+            self._add(started, self.description is None)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        # The first row's parameters stand in for the batch when a slow one is explained
+        seq_of_parameters = list(seq_of_parameters)
+        self.statement = [sql, seq_of_parameters[0] if seq_of_parameters else None, query_fingerprint(sql), 0.0]
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._add(started, True)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = None
+        try:
+            row = super().fetchone()
+            return row
+        finally:
+            self._add(started, row is None)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._add(started, True)
+
+class UnitOfWorkConnection(sqlite3.Connection):
+    """
+    Connection whose commit() is deferred while a unit_of_work() block is open, so
+    helpers that commit on their own join the surrounding transaction instead.
+    """
+
+    depth = 0
+
+    def commit(self):
+        if not self.depth:
+            super().commit()
+
+class ProfileIndex:
+    """
+    Column-oriented copy of the users fields that search filters on. Each column
+    is a typed array (gender, sought gender, city and country as small dictionary codes, age,
+    flag bits, boost time), so a filter is a vectorized scan with numpy when it
+    is installed and a plain loop otherwise. Filters return user ids; rows are
+    then loaded from SQLite by primary key.
+    """
+    SEARCHABLE = 1
+    COMPLETE = 2
+    PREMIUM = 4
+    BLOCKED = 8
+    ACTIVE = 16
+    columns_sql = "SELECT user_id, gender, seeking_gender, city, country, age, is_searchable, is_complete, premium, blocked, last_boost, last_seen FROM users"
+
+    def __init__(self):
+        self.user_ids = array('q')
+        self.gender = array('B')
+        self.seeking = array('B')
+        self.city = array('H')
+        self.country = array('B')
+        self.age = array('B')
+        self.flags = array('B')
+        self.boost = array('q')
+        self.positions = {}
+        self.codes = {'gender': {}, 'city': {}, 'country': {}}
+        self.active_since = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - ACTIVE_USER_DAYS * 86400))
+        self.ready = False
+
+    def _code(self, kind: str, value) -> int:
+        if value is None:
+            return 0
+        codes = self.codes[kind]
+        return codes.setdefault(value, len(codes) + 1)
+
+    def set_row(self, row):
+        user_id, gender, seeking, city, country, age, searchable, complete, premium, blocked, last_boost, last_seen = row
+        try:
+            boost = int(datetime.fromisoformat(last_boost).timestamp()) if last_boost else 0
+        except ValueError:
+            boost = 0
+        flags = ((self.SEARCHABLE if searchable else 0) | (self.COMPLETE if complete else 0)
+                 | (self.PREMIUM if premium else 0) | (self.BLOCKED if blocked else 0)
+                 | (self.ACTIVE if last_seen and last_seen >= self.active_since else 0))
+        values = (user_id, self._code('gender', gender), self._code('gender', seeking), self._code('city', city),
+                  self._code('country', country), min(max(age or 0, 0), 255), flags, boost)
+        columns = (self.user_ids, self.gender, self.seeking, self.city, self.country, self.age, self.flags, self.boost)
+        position = self.positions.get(user_id)
+        if position is None:
+            self.positions[user_id] = len(self.user_ids)
+            for column, value in zip(columns, values):
+                column.append(value)
+        else:
+            for column, value in zip(columns, values):
+                column[position] = value
+
+    def remove(self, user_id: int):
+        position = self.positions.pop(user_id, None)
+        if position is not None:
+            self.flags[position] = 0
+            self.gender[position] = 0
+
+    def refresh(self, user_id: int, connection_cursor):
+        connection_cursor.execute(self.columns_sql + " WHERE user_id=?", (user_id,))
+        row = connection_cursor.fetchone()
+        if row:
+            self.set_row(tuple(row))
+        else:
+            self.remove(user_id)
+
+    def load(self, connection):
+        for row in connection.execute(self.columns_sql):
+            self.set_row(row)
+        self.ready = True
+
+    def _match(self, gender=None, city=None, countries=None, min_age=None, max_age=None, flag=0, premium=None, seeking=None):
+        if gender is not None and gender not in self.codes['gender']:
+            return []
+        if seeking is not None and seeking not in self.codes['gender']:
+            return []
+        if city is not None and city not in self.codes['city']:
+            return []
+        gender_code = self.codes['gender'].get(gender)
+        seeking_code = self.codes['gender'].get(seeking)
+        city_code = self.codes['city'].get(city)
+        country_codes = [self.codes['country'][name] for name in countries if name in self.codes['country']] if countries is not None else None
+        if country_codes == []:
+            return []
+        if min_age is not None:
+            min_age = max(min_age, 1)
+        if numpy is not None:
+            if not self.user_ids:
+                return numpy.empty(0, dtype=numpy.int64)
+            mask = numpy.ones(len(self.user_ids), dtype=bool)
+            if gender_code is not None:
+                mask &= numpy.frombuffer(self.gender, dtype=numpy.uint8) == gender_code
+            if seeking_code is not None:
+                mask &= numpy.frombuffer(self.seeking, dtype=numpy.uint8) == seeking_code
+            if city_code is not None:
+                mask &= numpy.frombuffer(self.city, dtype=numpy.uint16) == city_code
+            if country_codes is not None:
+                mask &= numpy.isin(numpy.frombuffer(self.country, dtype=numpy.uint8), country_codes)
+            if min_age is not None:
+                mask &= numpy.frombuffer(self.age, dtype=numpy.uint8) >= min_age
+            if max_age is not None:
+                mask &= numpy.frombuffer(self.age, dtype=numpy.uint8) <= max_age
+            flags = numpy.frombuffer(self.flags, dtype=numpy.uint8)
+            if flag:
+                mask &= (flags & flag) != 0
+            if premium is not None:
+                mask &= ((flags & self.PREMIUM) != 0) == bool(premium)
+            return numpy.flatnonzero(mask)
+        country_codes = set(country_codes) if country_codes is not None else None
+        return [
+            position for position in range(len(self.user_ids))
+            if (gender_code is None or self.gender[position] == gender_code)
+            and (seeking_code is None or self.seeking[position] == seeking_code)
+            and (city_code is None or self.city[position] == city_code)
+            and (country_codes is None or self.country[position] in country_codes)
+            and (min_age is None or self.age[position] >= min_age)
+            and (max_age is None or self.age[position] <= max_age)
+            and (not flag or self.flags[position] & flag)
+            and (premium is None or bool(self.flags[position] & self.PREMIUM) == bool(premium))
+        ]
+
+    def filter(self, gender=None, countries=None, min_age=None, max_age=None, premium=None, flag=0) -> list:
+        positions = self._match(gender=gender, countries=countries, min_age=min_age, max_age=max_age,
+                                flag=flag, premium=premium)
+        if numpy is not None and len(positions):
+            return numpy.frombuffer(self.user_ids, dtype=numpy.int64)[positions].tolist()
+        return [self.user_ids[position] for position in positions]
+
+    def ranked(self, gender: str, city: str = None, flag: int = SEARCHABLE, exclude=(), limit: int = 5,
+               min_age: int = None, max_age: int = None, countries=None, seeking: str = None) -> list:
+        """Candidate ids ordered like the SQL search: premium, recently active, latest boost, then random."""
+        positions = self._match(gender=gender, city=city, countries=countries, flag=flag, min_age=min_age, max_age=max_age,
+                                seeking=seeking)
+        if numpy is not None and len(positions):
+            ids = numpy.frombuffer(self.user_ids, dtype=numpy.int64)[positions]
+            if exclude:
+                keep = ~numpy.isin(ids, numpy.fromiter(exclude, dtype=numpy.int64, count=len(exclude)))
+                positions, ids = positions[keep], ids[keep]
+            flags = numpy.frombuffer(self.flags, dtype=numpy.uint8)[positions]
+            boost = numpy.frombuffer(self.boost, dtype=numpy.int64)[positions]
+            order = numpy.lexsort((numpy.random.random(len(ids)), boost, flags & self.ACTIVE, flags & self.PREMIUM))[::-1][:limit]
+            return ids[order].tolist()
+        candidates = [position for position in positions if self.user_ids[position] not in exclude]
+        best = heapq.nlargest(limit, candidates, key=lambda position: (
+            self.flags[position] & self.PREMIUM, self.flags[position] & self.ACTIVE, self.boost[position], random.random()))
+        return [self.user_ids[position] for position in best]
+
+    def memory_usage(self) -> dict:
+        usage = {name: len(column) * column.itemsize for name, column in (
+            ('user_id', self.user_ids), ('gender', self.gender), ('seeking', self.seeking), ('city', self.city), ('country', self.country),
+            ('age', self.age), ('flags', self.flags), ('boost', self.boost))}
+        # dict slots plus two small int objects per entry
+        usage['positions'] = sys.getsizeof(self.positions) + len(self.positions) * 2 * sys.getsizeof(2 ** 40)
+        usage['codes'] = sum(sys.getsizeof(codes) + sum(sys.getsizeof(value) for value in codes)
+                             for codes in self.codes.values())
+        return usage
+
+bot = InstrumentedBot(token=API_TOKEN, server=TelegramAPIServer.from_base(BOT_API_SERVER) if BOT_API_SERVER else TELEGRAM_PRODUCTION)
+storage = SQLiteStorage(FSM_DB_PATH)
 dp = Dispatcher(bot, storage=storage)
 
-conn = sqlite3.connect('dating_database.db', check_same_thread=False)
+conn = sqlite3.connect(DB_PATH, check_same_thread=False, factory=UnitOfWorkConnection)
 conn.row_factory = sqlite3.Row
 conn.execute('PRAGMA journal_mode=WAL;')
-cursor = conn.cursor()
+cursor = conn.cursor(factory=InstrumentedCursor)
+
+@contextmanager
+def unit_of_work():
+    # All writes of one handler in a single transaction and a single fsync. The block must not
+    # await: the connection is shared, another handler's statements would land in this transaction.
+    conn.depth += 1
+    try:
+        yield
+    except BaseException:
+        conn.depth -= 1
+        if not conn.depth:
+            conn.rollback()
+        raise
+    conn.depth -= 1
+    if not conn.depth:
+        conn.commit()
+        ctx = user_context.get()
+        if ctx is not None:
+            ctx.invalidate()
 
 cursor.execute('''
 CREATE TABLE IF NOT EXISTS users (
@@ -66,6 +665,108 @@ if 'invited_count' not in columns:
     cursor.execute("ALTER TABLE users ADD COLUMN invited_count INTEGER DEFAULT 0")
 if 'last_boost' not in columns:
     cursor.execute("ALTER TABLE users ADD COLUMN last_boost DATETIME")
+if 'is_complete' not in columns:
+    cursor.execute("ALTER TABLE users ADD COLUMN is_complete INTEGER DEFAULT 0")
+if 'is_searchable' not in columns:
+    cursor.execute("ALTER TABLE users ADD COLUMN is_searchable INTEGER DEFAULT 0")
+if 'impressions' not in columns:
+    cursor.execute("ALTER TABLE users ADD COLUMN impressions INTEGER DEFAULT 0")
+if 'pref_age_min' not in columns:
+    cursor.execute("ALTER TABLE users ADD COLUMN pref_age_min INTEGER")
+if 'pref_age_max' not in columns:
+    cursor.execute("ALTER TABLE users ADD COLUMN pref_age_max INTEGER")
+if 'unreachable' not in columns:
+    cursor.execute("ALTER TABLE users ADD COLUMN unreachable TEXT")
+if 'last_seen' not in columns:
+    cursor.execute("ALTER TABLE users ADD COLUMN last_seen DATETIME")
+if 'deleted' not in columns:
+    cursor.execute("ALTER TABLE users ADD COLUMN deleted INTEGER DEFAULT 0")
+
+PROFILE_COMPLETE_SQL = "(photos IS NOT NULL AND photos NOT IN ('', '[]') AND name IS NOT NULL AND age IS NOT NULL AND gender IS NOT NULL AND seeking_gender IS NOT NULL AND city IS NOT NULL)"
+
+profile_index = ProfileIndex()
+profile_index_changed = set()
+
+def build_profile_index(connection=None) -> ProfileIndex:
+    index = ProfileIndex()
+    if connection is not None:
+        index.load(connection)
+        return index
+    # Runs in a worker thread, so it uses its own connection
+    connection = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        index.load(connection)
+    finally:
+        connection.close()
+    return index
+
+def refresh_profile_index(user_id: int):
+    ctx = caller_context(user_id)
+    if ctx is not None:
+        ctx.invalidate()
+    profile_index_changed.add(user_id)
+    profile_index.refresh(user_id, cursor)
+
+async def profile_index_loop():
+    global profile_index
+    while True:
+        try:
+            profile_index_changed.clear()
+            started = time.perf_counter()
+            index = await asyncio.to_thread(build_profile_index)
+            # Writes made while the thread was loading went to the old index
+            for user_id in profile_index_changed:
+                index.refresh(user_id, cursor)
+            profile_index = index
+            profile_index_changed.clear()
+            logging.info(f"Profile index rebuilt: {len(index.positions)} profiles, "
+                         f"{sum(index.memory_usage().values()) / 1024 / 1024:.1f} MB in {time.perf_counter() - started:.1f}s")
+        except Exception as e:
+            logging.error(f"Error in profile_index_loop: {e}")
+        await asyncio.sleep(PROFILE_INDEX_REFRESH)
+
+def refresh_profile_flags(user_id: int = None):
+    query = (f"UPDATE users SET is_complete = ({PROFILE_COMPLETE_SQL} AND deleted = 0), "
+             f"is_searchable = ({PROFILE_COMPLETE_SQL} AND deleted = 0 AND blocked = 0 AND unreachable IS NULL)")
+    if user_id is None:
+        cursor.execute(query)
+    else:
+        cursor.execute(query + " WHERE user_id=?", (user_id,))
+        refresh_profile_index(user_id)
+
+if 'is_searchable' not in columns:
+    refresh_profile_flags()
+
+def mark_unreachable(user_id: int, reason: str):
+    # Hidden from search and skipped by notifications and broadcasts until the next /start
+    try:
+        cursor.execute("UPDATE users SET unreachable=? WHERE user_id=? AND unreachable IS NOT ?", (reason, user_id, reason))
+        if cursor.rowcount:
+            refresh_profile_flags(user_id)
+            conn.commit()
+            logging.info(f"User {user_id} marked unreachable: {reason}")
+    except Exception as e:
+        logging.error(f"Error in mark_unreachable: {e}")
+
+def reactivate_user(user_id: int):
+    cursor.execute("UPDATE users SET unreachable=NULL WHERE user_id=? AND unreachable IS NOT NULL", (user_id,))
+    if cursor.rowcount:
+        refresh_profile_flags(user_id)
+        conn.commit()
+
+async def notify_user(user_id: int, text: str) -> bool:
+    cursor.execute("SELECT unreachable FROM users WHERE user_id=?", (user_id,))
+    result = cursor.fetchone()
+    if result and result['unreachable']:
+        return False
+    try:
+        await bot.send_message(user_id, text)
+        return True
+    except (BotBlocked, ChatNotFound, UserDeactivated):
+        return False
+    except Exception as e:
+        logging.error(f"Failed to send notification to {user_id}: {e}")
+        return False
 
 cursor.execute('CREATE INDEX IF NOT EXISTS idx_gender ON users(gender);')
 cursor.execute('CREATE INDEX IF NOT EXISTS idx_seeking_gender ON users(seeking_gender);')
@@ -74,6 +775,9 @@ cursor.execute('CREATE INDEX IF NOT EXISTS idx_country ON users(country);')
 cursor.execute('CREATE INDEX IF NOT EXISTS idx_city ON users(city);')
 cursor.execute('CREATE INDEX IF NOT EXISTS idx_premium ON users(premium);')
 cursor.execute('CREATE INDEX IF NOT EXISTS idx_last_boost ON users(last_boost);')
+cursor.execute('CREATE INDEX IF NOT EXISTS idx_searchable ON users(is_searchable, gender, city);')
+cursor.execute('CREATE INDEX IF NOT EXISTS idx_complete ON users(is_complete, gender);')
+cursor.execute('CREATE INDEX IF NOT EXISTS idx_last_seen ON users(last_seen);')
 
 cursor.execute('''
 CREATE TABLE IF NOT EXISTS likes (
@@ -83,8 +787,13 @@ CREATE TABLE IF NOT EXISTS likes (
     PRIMARY KEY (from_user, to_user)
 )
 ''')
+cursor.execute("PRAGMA table_info(likes)")
+if 'handled' not in [info[1] for info in cursor.fetchall()]:
+    cursor.execute("ALTER TABLE likes ADD COLUMN handled INTEGER DEFAULT 0")
 cursor.execute('CREATE INDEX IF NOT EXISTS idx_from_user ON likes(from_user);')
-cursor.execute('CREATE INDEX IF NOT EXISTS idx_to_user ON likes(to_user);')
+# Serves every to_user lookup as well, so the plain to_user index is not needed
+cursor.execute('CREATE INDEX IF NOT EXISTS idx_to_user_handled ON likes(to_user, handled);')
+cursor.execute('DROP INDEX IF EXISTS idx_to_user;')
 
 cursor.execute('''
 CREATE TABLE IF NOT EXISTS dislikes (
@@ -100,11 +809,19 @@ cursor.execute('''
 CREATE TABLE IF NOT EXISTS skips (
     from_user INTEGER,
     to_user INTEGER,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
     PRIMARY KEY (from_user, to_user)
 )
 ''')
+cursor.execute("PRAGMA table_info(skips)")
+if 'created_at' not in [info[1] for info in cursor.fetchall()]:
+    # Skips made before expiry existed start their TTL now
+    cursor.execute("ALTER TABLE skips ADD COLUMN created_at DATETIME")
+    cursor.execute("UPDATE skips SET created_at = CURRENT_TIMESTAMP")
 cursor.execute('CREATE INDEX IF NOT EXISTS idx_from_user_skip ON skips(from_user);')
 cursor.execute('CREATE INDEX IF NOT EXISTS idx_to_user_skip ON skips(to_user);')
+cursor.execute('CREATE INDEX IF NOT EXISTS idx_skip_active ON skips(from_user, created_at, to_user);')
+cursor.execute('CREATE INDEX IF NOT EXISTS idx_skip_created ON skips(created_at);')
 
 cursor.execute('''
 CREATE TABLE IF NOT EXISTS logs (
@@ -117,6 +834,24 @@ CREATE TABLE IF NOT EXISTS logs (
 cursor.execute('CREATE INDEX IF NOT EXISTS idx_log_user ON logs(user_id);')
 cursor.execute('CREATE INDEX IF NOT EXISTS idx_log_timestamp ON logs(timestamp);')
 
+cursor.execute("PRAGMA table_info(feed_pages)")
+feed_columns = [info[1] for info in cursor.fetchall()]
+if feed_columns and 'seeking_gender' not in feed_columns:
+    # Derived data, the next rebuild fills it again
+    cursor.execute("DROP TABLE feed_pages")
+cursor.execute('''
+CREATE TABLE IF NOT EXISTS feed_pages (
+    city TEXT,
+    gender TEXT,
+    seeking_gender TEXT,
+    rank INTEGER,
+    user_id INTEGER,
+    age INTEGER,
+    score REAL,
+    PRIMARY KEY (city, gender, seeking_gender, rank)
+)
+''')
+
 cursor.execute('''
 CREATE TABLE IF NOT EXISTS admins (
     user_id INTEGER PRIMARY KEY
@@ -134,8 +869,133 @@ CREATE TABLE IF NOT EXISTS invitations (
 cursor.execute('CREATE INDEX IF NOT EXISTS idx_inviter_id ON invitations(inviter_id);')
 cursor.execute('CREATE INDEX IF NOT EXISTS idx_invited_id ON invitations(invited_id);')
 
+cursor.execute('''
+CREATE TABLE IF NOT EXISTS purge_queue (
+    user_id INTEGER PRIMARY KEY,
+    queued_at DATETIME DEFAULT CURRENT_TIMESTAMP
+)
+''')
+
+# Events for the admin digest; every worker writes here and only the primary one sends
+cursor.execute('''
+CREATE TABLE IF NOT EXISTS admin_events (
+    event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT,
+    item TEXT,
+    city TEXT
+)
+''')
+cursor.execute('CREATE INDEX IF NOT EXISTS idx_admin_events_kind ON admin_events(kind, event_id);')
+
 conn.commit()
 
+# Cover the tiered candidate lookups, including their ORDER BY, without touching the table
+# Ranking columns follow the location so a tier walks its segment best-first; age is only a filter
+MATCH_INDEXES = {
+    'idx_match_city': 'users(gender, seeking_gender, city, is_searchable, premium DESC, last_seen DESC, last_boost, age)',
+    'idx_match_country': 'users(gender, seeking_gender, country, is_searchable, premium DESC, last_seen DESC, last_boost, age)',
+    'idx_match_any': 'users(gender, seeking_gender, is_searchable, premium DESC, last_seen DESC, last_boost, age, country)',
+}
+RETIRED_INDEXES = ('idx_search_age', 'idx_search_country')
+
+def build_match_indexes(connection=None) -> list:
+    # CREATE INDEX holds the write lock for the whole build, so it runs at import, before any
+    # update is served and before sharded workers are spawned; handlers never wait on it
+    own_connection = connection is None
+    if own_connection:
+        connection = sqlite3.connect(DB_PATH, timeout=60)
+    try:
+        existing = dict(connection.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index'"))
+        built = []
+        for name, definition in MATCH_INDEXES.items():
+            create_sql = f"CREATE INDEX {name} ON {definition}"
+            if existing.get(name) == create_sql:
+                continue
+            started = time.perf_counter()
+            # A changed definition is swapped in one transaction, readers keep the old index until commit
+            connection.execute("BEGIN")
+            if name in existing:
+                connection.execute(f"DROP INDEX {name}")
+            connection.execute(create_sql)
+            connection.commit()
+            built.append(name)
+            logging.info(f"Index {name} built in {time.perf_counter() - started:.1f}s")
+        for name in RETIRED_INDEXES:
+            if name in existing:
+                connection.execute(f"DROP INDEX IF EXISTS {name}")
+                connection.commit()
+        return built
+    finally:
+        if own_connection:
+            connection.close()
+
+build_match_indexes(conn)
+
+# Skips expire, so a skipped profile comes back into search after SKIP_TTL_DAYS
+ACTIVE_SKIP_SQL = f"created_at > datetime('now', '-{SKIP_TTL_DAYS} days')"
+RECENTLY_ACTIVE_SQL = f"last_seen > datetime('now', '-{ACTIVE_USER_DAYS} days')"
+
+async def delete_in_batches(table: str, condition: str, params=(), batch: int = PURGE_BATCH) -> int:
+    deleted = 0
+    while True:
+        cursor.execute(f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {condition} LIMIT ?)",
+                       (*params, batch))
+        conn.commit()
+        deleted += cursor.rowcount
+        if cursor.rowcount < batch:
+            return deleted
+        # Small batches keep the write lock short, handlers run in between
+        await asyncio.sleep(0.1)
+
+async def skip_compaction_loop():
+    while True:
+        try:
+            deleted = await delete_in_batches('skips', f"created_at <= datetime('now', '-{SKIP_TTL_DAYS} days')",
+                                              batch=SKIP_COMPACT_BATCH)
+            if deleted:
+                logging.info(f"Expired skips deleted: {deleted}")
+        except Exception as e:
+            logging.error(f"Error in skip_compaction_loop: {e}")
+        await asyncio.sleep(SKIP_COMPACT_INTERVAL)
+
+# One indexed column per pass; an OR across two columns would scan both index ranges per batch
+PURGE_COLUMNS = (
+    ('likes', 'from_user'), ('likes', 'to_user'),
+    ('dislikes', 'from_user'), ('dislikes', 'to_user'),
+    ('skips', 'from_user'), ('skips', 'to_user'),
+    ('logs', 'user_id'),
+    ('invitations', 'inviter_id'), ('invitations', 'invited_id'),
+)
+
+def soft_delete_user(user_id: int):
+    # Blocked as well, so the user's own buttons stop working until the purge finishes
+    cursor.execute("UPDATE users SET deleted = 1, blocked = 1 WHERE user_id = ?", (user_id,))
+    cursor.execute("INSERT OR IGNORE INTO purge_queue (user_id) VALUES (?)", (user_id,))
+    refresh_profile_flags(user_id)
+    conn.commit()
+
+async def purge_deleted_users() -> int:
+    cursor.execute("SELECT user_id FROM purge_queue ORDER BY queued_at")
+    user_ids = [row[0] for row in cursor.fetchall()]
+    for user_id in user_ids:
+        rows = 0
+        for table, column in PURGE_COLUMNS:
+            rows += await delete_in_batches(table, f"{column} = ?", (user_id,))
+        cursor.execute("DELETE FROM users WHERE user_id = ? AND deleted = 1", (user_id,))
+        cursor.execute("DELETE FROM purge_queue WHERE user_id = ?", (user_id,))
+        conn.commit()
+        refresh_profile_index(user_id)
+        logging.info(f"User {user_id} purged: {rows} dependent rows")
+    return len(user_ids)
+
+async def purge_loop():
+    while True:
+        try:
+            await purge_deleted_users()
+        except Exception as e:
+            logging.error(f"Error in purge_loop: {e}")
+        await asyncio.sleep(PURGE_INTERVAL)
+
 cities_by_country = {
     'Россия': ['Москва', 'Санкт-Петербург', 'Новосибирск', 'Екатеринбург', 'Казань', 'Красноярск', 'Нижний Новгород', 'Челябинск', 'Уфа', 'Краснодар', 'Самара', 'Ростов-на-Дону', 'Омск', 'Воронеж', 'Пермь', 'Волгоград', 'Саратов', 'Тюмень', 'Тольятти', 'Махачкала'],
     'Таджикистан': ['Бохтар', 'Бустон', 'Вахдат', 'Гиссар', 'Гулистон', 'Душанбе', 'Истаравшан', 'Истиклол', 'Исфара', 'Канибадам', 'Куляб', 'Левакант', 'Нурек', 'Пенджикент', 'Рогун', 'Турсунзаде', 'Худжанд', 'Хорог'],
@@ -144,24 +1004,81 @@ cities_by_country = {
     'Казахстан': ['Алматы', 'Астана', 'Шымкент', 'Актобе', 'Караганда', 'Тараз', 'Усть-Каменогорск', 'Павлодар', 'Атырау', 'Семей', 'Актау', 'Кызылорда', 'Костанай', 'Уральск', 'Туркестан', 'Петропавловск', 'Кокшетау', 'Темиртау', 'Талдыкорган', 'Экибастуз']
 }
 
+neighbour_countries = {
+    'Россия': ['Казахстан'],
+    'Казахстан': ['Россия', 'Кыргызстан', 'Узбекистан'],
+    'Узбекистан': ['Казахстан', 'Кыргызстан', 'Таджикистан'],
+    'Кыргызстан': ['Казахстан', 'Узбекистан', 'Таджикистан'],
+    'Таджикистан': ['Узбекистан', 'Кыргызстан']
+}
+
 class SearchContext(StatesGroup):
     search = State()
 
 class ViewingState(StatesGroup):
     likes = State()
 
+class UserContext:
+    """
+    The user behind the current update: users row, admin flag and premium status.
+    Each is loaded on first use and kept for the rest of the update; writes to the
+    row through refresh_profile_index() or unit_of_work() drop the cached copy.
+    """
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.admin = None
+        self.premium = None
+        self._row = None
+        self._row_loaded = False
+
+    @property
+    def row(self):
+        if not self._row_loaded:
+            cursor.execute("SELECT * FROM users WHERE user_id=?", (self.user_id,))
+            self._row = cursor.fetchone()
+            self._row_loaded = True
+        return self._row
+
+    def invalidate(self):
+        self.premium = None
+        self._row = None
+        self._row_loaded = False
+
+user_context = ContextVar('user_context', default=None)
+
+def caller_context(user_id: int):
+    ctx = user_context.get()
+    return ctx if ctx is not None and ctx.user_id == user_id else None
+
 def check_admin(user_id: int) -> bool:
     if user_id == SUPER_ADMIN_ID:
         return True
+    ctx = caller_context(user_id)
+    if ctx is not None and ctx.admin is not None:
+        return ctx.admin
     cursor.execute("SELECT 1 FROM admins WHERE user_id=?", (user_id,))
-    return cursor.fetchone() is not None
+    is_admin = cursor.fetchone() is not None
+    if ctx is not None:
+        ctx.admin = is_admin
+    return is_admin
 
 def check_super_admin(user_id: int) -> bool:
     return user_id == SUPER_ADMIN_ID
 
 def get_premium_status(user_id: int):
-    cursor.execute("SELECT premium, premium_expiry FROM users WHERE user_id=?", (user_id,))
-    result = cursor.fetchone()
+    ctx = caller_context(user_id)
+    if ctx is None:
+        cursor.execute("SELECT premium, premium_expiry FROM users WHERE user_id=?", (user_id,))
+        return premium_status_from_row(user_id, cursor.fetchone())
+    if ctx.premium is None:
+        status = premium_status_from_row(user_id, ctx.row)
+        # The expiry notice is reported once, later calls in the same update see plain "not premium"
+        ctx.premium = status[:2]
+        return status
+    return (*ctx.premium, False)
+
+def premium_status_from_row(user_id: int, result):
     if not result:
         return False, None, False
     premium = result['premium']
@@ -171,6 +1088,7 @@ def get_premium_status(user_id: int):
         expiry_dt = datetime.fromisoformat(expiry)
         if datetime.now() >= expiry_dt:
             cursor.execute("UPDATE users SET premium=0, premium_expiry=NULL WHERE user_id=?", (user_id,))
+            refresh_profile_index(user_id)
             conn.commit()
             needs_notify = True
             return False, None, True
@@ -181,24 +1099,320 @@ def get_premium_status(user_id: int):
 async def check_premium(user_id: int) -> bool:
     is_prem, _, notify = get_premium_status(user_id)
     if notify:
-        try:
-            await bot.send_message(user_id, "🔥 Ваш VIP статус истёк! Продлите для безлимитных лайков и буста анкеты 💎\n\n💎 2 дня - 4 сомони\n💎💎 7 дней - 10 сомони\n💎💎💎 Месяц - 28 сомони\n\nНапишите @x_silence_x2 или @rajabov3 для покупки!")
-        except Exception as e:
-            logging.error(f"Failed to send expiry notification to {user_id}: {e}")
+        await notify_user(user_id, "🔥 Ваш VIP статус истёк! Продлите для безлимитных лайков и буста анкеты 💎\n\n💎 2 дня - 4 сомони\n💎💎 7 дней - 10 сомони\n💎💎💎 Месяц - 28 сомони\n\nНапишите @x_silence_x2 или @rajabov3 для покупки!")
     return is_prem
 
-async def check_like_limit(user_id: int) -> bool:
-    if await check_premium(user_id):
-        return True
+def count_recent_likes(user_id: int) -> int:
     cursor.execute("""
         SELECT COUNT(*) FROM likes 
         WHERE from_user=? AND timestamp > datetime('now', '-1 day')
     """, (user_id,))
-    count = cursor.fetchone()[0]
-    return count < 30
+    return cursor.fetchone()[0]
+
+async def check_like_limit(user_id: int) -> bool:
+    if await check_premium(user_id):
+        return True
+    return count_recent_likes(user_id) < 30
+
+feed_impressions = Counter()
+
+def score_profile(premium, boosted, actions, likes_given, dislikes_given, likes_received, impressions, idle_days) -> float:
+    return (FEED_WEIGHTS['premium'] * premium
+            + FEED_WEIGHTS['recency'] / (1 + idle_days)
+            + FEED_WEIGHTS['boost'] * boosted
+            + FEED_WEIGHTS['activity'] * math.log1p(actions)
+            + FEED_WEIGHTS['reciprocity'] * (likes_given + 1) / (likes_given + dislikes_given + 2)
+            + FEED_WEIGHTS['popularity'] * math.log1p(likes_received)
+            - FEED_WEIGHTS['impressions'] * math.log1p(impressions))
+
+def rebuild_feed() -> int:
+    # Runs in a worker thread, so it uses its own connection
+    connection = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        rows = connection.execute('''
+        SELECT u.user_id, u.city, u.gender, u.seeking_gender, u.age, u.premium,
+               COALESCE(u.last_boost > datetime('now', '-1 day'), 0),
+               (SELECT COUNT(*) FROM logs WHERE logs.user_id = u.user_id AND logs.timestamp > datetime('now', '-7 days')),
+               (SELECT COUNT(*) FROM likes WHERE from_user = u.user_id),
+               (SELECT COUNT(*) FROM dislikes WHERE from_user = u.user_id),
+               (SELECT COUNT(*) FROM likes WHERE to_user = u.user_id),
+               u.impressions,
+               COALESCE(julianday('now') - julianday(u.last_seen), 365)
+        FROM users u WHERE u.is_searchable = 1
+        ''').fetchall()
+        segments = defaultdict(list)
+        for user_id, city, gender, seeking_gender, age, *signals in rows:
+            segments[(city, gender, seeking_gender)].append((score_profile(*(value or 0 for value in signals)), user_id, age))
+        pages = []
+        for (city, gender, seeking_gender), scored in segments.items():
+            scored.sort(reverse=True)
+            pages.extend((city, gender, seeking_gender, rank, user_id, age, score)
+                         for rank, (score, user_id, age) in enumerate(scored, 1))
+        with connection:
+            connection.execute("DELETE FROM feed_pages")
+            connection.executemany('''
+            INSERT INTO feed_pages (city, gender, seeking_gender, rank, user_id, age, score) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', pages)
+        return len(pages)
+    finally:
+        connection.close()
+
+def flush_feed_impressions():
+    if not feed_impressions:
+        return
+    cursor.executemany("UPDATE users SET impressions = impressions + ? WHERE user_id = ?",
+                       [(count, user_id) for user_id, count in feed_impressions.items()])
+    conn.commit()
+    feed_impressions.clear()
+
+async def feed_loop(rebuild: bool):
+    while True:
+        try:
+            flush_feed_impressions()
+            if rebuild:
+                started = time.perf_counter()
+                count = await asyncio.to_thread(rebuild_feed)
+                logging.info(f"Feed rebuilt: {count} profiles in {time.perf_counter() - started:.1f}s")
+        except Exception as e:
+            logging.error(f"Error in feed_loop: {e}")
+        await asyncio.sleep(FEED_REFRESH_INTERVAL)
+
+def find_feed_candidate(user_id: int, seeking_gender: str, city: str, age: int = None,
+                        min_age: int = None, max_age: int = None, gender: str = None):
+    cursor.execute(f'''
+    SELECT f.user_id, f.age, f.score FROM feed_pages f
+    WHERE f.city = ? AND f.gender = ? AND f.seeking_gender = ? AND f.user_id != ? AND f.age BETWEEN ? AND ?
+    AND NOT EXISTS (SELECT 1 FROM likes WHERE from_user = ? AND to_user = f.user_id)
+    AND NOT EXISTS (SELECT 1 FROM dislikes WHERE from_user = ? AND to_user = f.user_id)
+    AND NOT EXISTS (SELECT 1 FROM skips WHERE from_user = ? AND to_user = f.user_id AND {ACTIVE_SKIP_SQL})
+    ORDER BY f.rank LIMIT ?
+    ''', (city, seeking_gender, gender, user_id, min_age or 0, max_age or 255, user_id, user_id, user_id, FEED_WINDOW))
+    window = cursor.fetchall()
+    if not window:
+        return None
+    if age is not None:
+        best = max(window, key=lambda row: row['score'] - FEED_WEIGHTS['age'] * abs((row['age'] or age) - age))
+    else:
+        best = window[0]
+    cursor.execute("SELECT * FROM users WHERE user_id = ? AND is_searchable = 1", (best['user_id'],))
+    return cursor.fetchone()
+
+# Ordered by expiry: the TTL is fixed, so a key marked later also expires later
+exhausted_tiers = OrderedDict()
+
+def search_tiers(city: str, country: str = None) -> list:
+    tiers = [('city', city)]
+    if country:
+        tiers.append(('country', country))
+        if neighbour_countries.get(country):
+            tiers.append(('neighbours', tuple(neighbour_countries[country])))
+    tiers.append(('any', None))
+    return tiers
+
+def tier_exhausted(key) -> bool:
+    expires = exhausted_tiers.get(key)
+    if expires is None:
+        return False
+    if expires < time.monotonic():
+        del exhausted_tiers[key]
+        return False
+    return True
+
+def mark_tier_exhausted(key):
+    now = time.monotonic()
+    exhausted_tiers[key] = now + TIER_EMPTY_TTL
+    exhausted_tiers.move_to_end(key)
+    # Expired keys sit at the front; past the cap the soonest to expire go first
+    while exhausted_tiers and (len(exhausted_tiers) > TIER_EMPTY_MAX or next(iter(exhausted_tiers.values())) < now):
+        exhausted_tiers.popitem(last=False)
+
+def find_indexed_candidate(user_id: int, seeking_gender: str, city: str, is_admin: bool = False,
+                           min_age: int = None, max_age: int = None, country: str = None, gender: str = None):
+    if is_admin:
+        seen = {user_id}
+    else:
+        cursor.execute(f'''
+        SELECT to_user FROM likes WHERE from_user = ?
+        UNION ALL SELECT to_user FROM dislikes WHERE from_user = ?
+        UNION ALL SELECT to_user FROM skips WHERE from_user = ? AND {ACTIVE_SKIP_SQL}
+        ''', (user_id, user_id, user_id))
+        seen = {row[0] for row in cursor.fetchall()}
+        seen.add(user_id)
+    flag = ProfileIndex.COMPLETE if is_admin else ProfileIndex.SEARCHABLE
+    if is_admin:
+        eligible, check_params = 'is_complete = 1', (seeking_gender,)
+    else:
+        eligible, check_params = 'is_searchable = 1 AND seeking_gender = ?', (gender, seeking_gender)
+    tiers = [('any', None)] if is_admin else search_tiers(city, country)
+    for tier, location in tiers:
+        key = (user_id, gender, seeking_gender, tier, location, min_age, max_age)
+        if not is_admin and tier_exhausted(key):
+            continue
+        candidate_ids = profile_index.ranked(
+            seeking_gender, location if tier == 'city' else None, flag, seen, min_age=min_age, max_age=max_age,
+            countries=[location] if tier == 'country' else location if tier == 'neighbours' else None,
+            seeking=None if is_admin else gender)
+        if not candidate_ids and not is_admin:
+            mark_tier_exhausted(key)
+        # The index may lag behind writes made by other workers, so rows are re-checked
+        for candidate_id in candidate_ids:
+            cursor.execute(f"SELECT * FROM users WHERE user_id = ? AND {eligible} AND gender = ?", (candidate_id, *check_params))
+            profile = cursor.fetchone()
+            if profile:
+                return profile
+    return None
+
+# The inner LIMIT caps how many unseen rows a tier collects before ranking, so a
+# large country or the worldwide tier never sorts its whole population. The scan
+# walks the match index in premium, last_seen order, so the window holds the best
+# ranked rows: every premium and recently active profile comes before the rest.
+TIER_CANDIDATE_SQL = f'''
+SELECT * FROM users WHERE user_id = (
+    SELECT user_id FROM (
+        SELECT user_id, premium, last_boost, last_seen FROM users
+        WHERE gender = ? AND seeking_gender = ? AND {{location}} AND is_searchable = 1 AND age BETWEEN ? AND ? AND user_id != ?
+        AND user_id NOT IN (SELECT to_user FROM likes WHERE from_user = ?)
+        AND user_id NOT IN (SELECT to_user FROM dislikes WHERE from_user = ?)
+        AND user_id NOT IN (SELECT to_user FROM skips WHERE from_user = ? AND {ACTIVE_SKIP_SQL})
+        ORDER BY premium DESC, last_seen DESC LIMIT ?
+    )
+    ORDER BY premium DESC, {RECENTLY_ACTIVE_SQL} DESC, last_boost DESC, RANDOM() LIMIT 1
+)
+'''
+
+def tier_candidate_query(tier: str, location, user_id: int, gender: str, seeking_gender: str,
+                         min_age: int = None, max_age: int = None):
+    if tier == 'city':
+        clause, location_params = 'city = ?', [location]
+    elif tier == 'country':
+        clause, location_params = 'country = ?', [location]
+    elif tier == 'neighbours':
+        clause, location_params = f"country IN ({', '.join('?' for _ in location)})", list(location)
+    else:
+        clause, location_params = '1 = 1', []
+    params = [seeking_gender, gender, *location_params, min_age or 0, max_age or 255,
+              user_id, user_id, user_id, user_id, TIER_SCAN_LIMIT]
+    return TIER_CANDIDATE_SQL.format(location=clause), params
+
+def find_candidate(user_id: int, seeking_gender: str, city: str, is_admin: bool = False, age: int = None,
+                   min_age: int = None, max_age: int = None, country: str = None, gender: str = None):
+    # Regular users only see profiles that are looking for their gender too
+    if is_admin:
+        min_age = max_age = None
+    elif not tier_exhausted((user_id, gender, seeking_gender, 'city', city, min_age, max_age)):
+        profile = find_feed_candidate(user_id, seeking_gender, city, age, min_age, max_age, gender)
+        if profile:
+            return profile
+    # Segment not ranked yet (new city or fresh start) or its feed is exhausted
+    if profile_index.ready:
+        return find_indexed_candidate(user_id, seeking_gender, city, is_admin, min_age, max_age, country, gender)
+    if is_admin:
+        cursor.execute('''
+        SELECT * FROM users WHERE is_complete = 1 AND gender = ? AND user_id != ?
+        ORDER BY premium DESC, last_boost DESC, RANDOM() LIMIT 1
+        ''', (seeking_gender, user_id))
+        return cursor.fetchone()
+    for tier, location in search_tiers(city, country):
+        key = (user_id, gender, seeking_gender, tier, location, min_age, max_age)
+        if tier_exhausted(key):
+            continue
+        cursor.execute(*tier_candidate_query(tier, location, user_id, gender, seeking_gender, min_age, max_age))
+        profile = cursor.fetchone()
+        if profile:
+            return profile
+        mark_tier_exhausted(key)
+    return None
+
+# Incoming likes are walked in arrival order; idx_to_user_handled serves the unanswered
+# ones directly. Likers already liked or disliked back are left out as well
+INCOMING_LIKES_SQL = '''
+SELECT {columns} FROM users me
+JOIN likes l ON l.to_user = me.user_id AND l.handled = 0
+JOIN users u ON u.user_id = l.from_user
+WHERE me.user_id = ?
+AND u.is_searchable = 1 AND u.gender = me.seeking_gender AND u.seeking_gender = me.gender
+AND NOT EXISTS (SELECT 1 FROM likes WHERE from_user = me.user_id AND to_user = l.from_user)
+AND NOT EXISTS (SELECT 1 FROM dislikes WHERE from_user = me.user_id AND to_user = l.from_user)
+'''
+
+def find_incoming_liker(user_id: int):
+    cursor.execute(INCOMING_LIKES_SQL.format(columns='u.*') + " ORDER BY l.rowid LIMIT 1", (user_id,))
+    return cursor.fetchone()
+
+def count_pending_likes(user_id: int) -> int:
+    cursor.execute(INCOMING_LIKES_SQL.format(columns='COUNT(*)'), (user_id,))
+    return cursor.fetchone()[0]
+
+def mark_like_handled(user_id: int, liker_id: int):
+    cursor.execute("UPDATE likes SET handled = 1 WHERE from_user = ? AND to_user = ?", (liker_id, user_id))
+    conn.commit()
+
+def collect_stats() -> dict:
+    cursor.execute("SELECT COUNT(*) FROM users")
+    users_count = cursor.fetchone()[0]
+    cursor.execute("SELECT COUNT(*) FROM likes")
+    likes_count = cursor.fetchone()[0]
+    cursor.execute("SELECT COUNT(*) FROM dislikes")
+    dislikes_count = cursor.fetchone()[0]
+    cursor.execute("SELECT COUNT(*) FROM skips")
+    skips_count = cursor.fetchone()[0]
+    cursor.execute("SELECT COUNT(*) FROM users WHERE blocked=1")
+    blocked_count = cursor.fetchone()[0]
+    cursor.execute("SELECT COUNT(*) FROM users WHERE premium=1")
+    premium_count = cursor.fetchone()[0]
+    cursor.execute("SELECT COUNT(DISTINCT from_user) FROM likes")
+    active_likers = cursor.fetchone()[0]
+    cursor.execute("""
+    SELECT COUNT(*) FROM likes l1
+    WHERE EXISTS (SELECT 1 FROM likes l2 WHERE l1.from_user = l2.to_user AND l1.to_user = l2.from_user)
+    """)
+    matches_count = cursor.fetchone()[0] // 2
+    return {
+        'users': users_count,
+        'premium': premium_count,
+        'likes': likes_count,
+        'dislikes': dislikes_count,
+        'skips': skips_count,
+        'blocked': blocked_count,
+        'active_likers': active_likers,
+        'matches': matches_count,
+    }
+
+def search_users(name: str, min_age: int, max_age: int, gender_query: str, country_query: str, premium_query):
+    if profile_index.ready:
+        countries = None
+        if country_query != '%':
+            countries = [country for country in profile_index.codes['country'] if country_query.lower() in country.lower()]
+        user_ids = profile_index.filter(gender=None if gender_query == '%' else gender_query, countries=countries,
+                                        min_age=min_age, max_age=max_age, premium=premium_query)
+        users = []
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            cursor.execute(f"""
+            SELECT user_id, name, age, gender, country, city, blocked, premium FROM users 
+            WHERE user_id IN ({','.join('?' * len(chunk))}) AND name LIKE ? AND deleted = 0
+            """, chunk + [name])
+            users.extend(cursor.fetchall())
+        users.sort(key=lambda row: row['user_id'])
+        return users
+    query = """
+    SELECT user_id, name, age, gender, country, city, blocked, premium FROM users 
+    WHERE name LIKE ? AND age BETWEEN ? AND ? AND gender LIKE ? AND deleted = 0
+    """
+    params = [name, min_age, max_age, gender_query]
+    if country_query != '%':
+        query += " AND country LIKE ?"
+        params.append(f"%{country_query}%")
+    if premium_query is not None:
+        query += " AND premium = ?"
+        params.append(premium_query)
+    query += " ORDER BY user_id"
+    cursor.execute(query, params)
+    return cursor.fetchall()
 
 def boost_profile(user_id: int):
     cursor.execute("UPDATE users SET last_boost=datetime('now') WHERE user_id=?", (user_id,))
+    refresh_profile_index(user_id)
     conn.commit()
 
 def get_all_admins():
@@ -207,6 +1421,593 @@ def get_all_admins():
     admins.append(SUPER_ADMIN_ID)
     return admins
 
+admin_event_titles = {
+    'started': 'Начали создание анкеты',
+    'created': 'Создали анкету',
+    'mutual': 'Mutual лайков',
+}
+periodic_tasks = []
+pending_tasks = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    pending_tasks.add(task)
+    task.add_done_callback(pending_tasks.discard)
+    return task
+
+async def notify_admin_event(kind: str, text: str, item: str, city: str = None):
+    if ADMIN_REALTIME_NOTIFY:
+        try:
+            await bot.send_message(SUPER_ADMIN_ID, text)
+        except Exception as e:
+            logging.error(f"Failed to send admin event {kind}: {e}")
+        return
+    cursor.execute("INSERT INTO admin_events (kind, item, city) VALUES (?, ?, ?)", (kind, item, city))
+    conn.commit()
+
+def build_admin_digest(last_event_id: int) -> str:
+    response = "Сводка активности 📊\n"
+    for kind, title in admin_event_titles.items():
+        cursor.execute("SELECT COUNT(*) FROM admin_events WHERE kind = ? AND event_id <= ?", (kind, last_event_id))
+        count = cursor.fetchone()[0]
+        if not count:
+            continue
+        response += f"\n{title}: {count}\n"
+        cursor.execute('''
+        SELECT item FROM (
+            SELECT event_id, item FROM admin_events WHERE kind = ? AND event_id <= ? ORDER BY event_id DESC LIMIT ?
+        ) ORDER BY event_id
+        ''', (kind, last_event_id, ADMIN_DIGEST_TOP))
+        for row in cursor.fetchall():
+            response += f"- {row['item']}\n"
+    cursor.execute('''
+    SELECT city, COUNT(*) AS events FROM admin_events WHERE city IS NOT NULL AND event_id <= ?
+    GROUP BY city ORDER BY events DESC LIMIT ?
+    ''', (last_event_id, ADMIN_DIGEST_TOP))
+    top_cities = ', '.join(f"{row['city']} ({row['events']})" for row in cursor.fetchall())
+    if top_cities:
+        response += f"\nТоп городов: {top_cities}\n"
+    return response
+
+async def send_admin_digest():
+    cursor.execute("SELECT MAX(event_id) FROM admin_events")
+    last_event_id = cursor.fetchone()[0]
+    if last_event_id is None:
+        return
+    try:
+        await bot.send_message(SUPER_ADMIN_ID, build_admin_digest(last_event_id))
+    except Exception as e:
+        logging.error(f"Failed to send admin digest: {e}")
+        return
+    # Events added while the message was sent stay for the next digest
+    cursor.execute("DELETE FROM admin_events WHERE event_id <= ?", (last_event_id,))
+    conn.commit()
+
+async def send_report_to_admin(admin_id: int, text: str):
+    try:
+        await bot.send_message(admin_id, text)
+    except Exception as e:
+        logging.error(f"Failed to send report to admin {admin_id}: {e}")
+
+async def send_report_to_admins(text: str):
+    await asyncio.gather(*(send_report_to_admin(admin_id, text) for admin_id in get_all_admins()))
+
+async def admin_digest_loop():
+    while True:
+        await asyncio.sleep(ADMIN_DIGEST_INTERVAL)
+        await send_admin_digest()
+
+def get_update_user_id(update: types.Update):
+    event = (update.message or update.edited_message or update.callback_query or update.inline_query
+             or update.chosen_inline_result or update.shipping_query or update.pre_checkout_query
+             or update.my_chat_member or update.chat_member or update.chat_join_request)
+    if event and event.from_user:
+        return event.from_user.id
+    if update.poll_answer:
+        return update.poll_answer.user.id
+    return None
+
+admin_buttons = {
+    'Статистика 📊', 'Список пользователей 📋', 'Жалобы ⚠️', 'Просмотр анкеты по ID 👤', 'Выдать премиум 💎',
+    'Отменить премиум ❌', 'Пользователи с премиум 💎📋', 'Поиск пользователей 🔎', 'Просмотр лайков ❤️',
+    'Рассылка сообщений 📩', 'Экспорт данных 📤', 'Просмотр логов 📜', 'Список админов 👥', 'Назначить админа ✅',
+    'Удалить админа ❌', 'Производительность ⚡', '/admin',
+}
+
+def get_throttle_category(update: types.Update):
+    if update.callback_query:
+        data = update.callback_query.data or ''
+        if data.startswith(('like_', 'dislike_', 'skip_')):
+            return 'like'
+        if data.startswith('report_'):
+            return 'report'
+        if data.startswith('admin_'):
+            return 'admin'
+        return None
+    if update.message:
+        text = update.message.text
+        if text in ('Искать анкеты 🔍', 'Кто меня лайкнул ❤️'):
+            return 'search'
+        if text in admin_buttons:
+            return 'admin'
+    return None
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Per-user token buckets for searches, likes, reports and admin actions.
+
+    A limit of '5/10' allows a burst of 5 actions refilled over 10 seconds. Throttled
+    callbacks get a "slow down" toast, throttled messages one warning per burst.
+    """
+
+    def __init__(self, limits: dict):
+        super().__init__()
+        self.limits = {}
+        for category, limit in limits.items():
+            capacity, period = limit.split('/')
+            self.limits[category] = (float(capacity), float(period))
+        self.buckets = {}
+        self.allowed = Counter()
+        self.throttled = Counter()
+        self.checks = 0
+
+    def consume(self, user_id: int, category: str) -> bool:
+        capacity, period = self.limits[category]
+        now = time.monotonic()
+        key = (user_id, category)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [capacity, now, False]
+        else:
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * capacity / period)
+            bucket[1] = now
+        self.checks += 1
+        if self.checks % 1000 == 0:
+            self.prune(now)
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        bucket[2] = False
+        return True
+
+    def prune(self, now: float):
+        for key, bucket in list(self.buckets.items()):
+            capacity, period = self.limits[key[1]]
+            if now - bucket[1] >= period:
+                del self.buckets[key]
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        category = get_throttle_category(update)
+        if category is None:
+            return
+        user_id = get_update_user_id(update)
+        if self.consume(user_id, category):
+            self.allowed[category] += 1
+            return
+        self.throttled[category] += 1
+        bucket = self.buckets[(user_id, category)]
+        try:
+            if update.callback_query:
+                await update.callback_query.answer("Не так быстро! Подожди немного ⏳")
+            elif not bucket[2]:
+                await update.message.reply("Не так быстро! Подожди немного ⏳")
+        except Exception as e:
+            logging.error(f"Failed to send throttle notice to {user_id}: {e}")
+        bucket[2] = True
+        raise CancelHandler()
+
+    def get_stats(self) -> dict:
+        return {
+            'allowed': dict(self.allowed),
+            'throttled': dict(self.throttled),
+            'tracked_buckets': len(self.buckets),
+        }
+
+class UserSerializationMiddleware(BaseMiddleware):
+    """
+    Runs updates of the same user one at a time and at most `limit` updates overall.
+
+    Updates above the limit wait in a queue; once `max_queued` updates are waiting,
+    new ones are dropped. A user with `max_user_queued` updates pending has further
+    updates dropped, so one flooding user cannot fill the shared queue.
+    """
+
+    def __init__(self, limit: int, max_queued: int, max_user_queued: int):
+        super().__init__()
+        self.limit = limit
+        self.max_queued = max_queued
+        self.max_user_queued = max_user_queued
+        self.semaphore = asyncio.Semaphore(limit)
+        self.user_locks = {}
+        self.queued = 0
+        self.in_flight = 0
+        self.max_queue_depth = 0
+        self.processed = 0
+        self.shed = 0
+
+    def _leave_user(self, user_id, locked: bool):
+        entry = self.user_locks[user_id]
+        if locked:
+            entry[0].release()
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.user_locks[user_id]
+
+    def _shed(self, update: types.Update, reason: str):
+        self.shed += 1
+        logging.warning(f"Dropped update {update.update_id}: {reason}")
+        raise CancelHandler()
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        user_id = get_update_user_id(update)
+        if user_id is not None:
+            entry = self.user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+            if entry[1] >= self.max_user_queued:
+                self._shed(update, f"user {user_id} already has {entry[1]} updates pending")
+            entry[1] += 1
+            try:
+                await entry[0].acquire()
+            except BaseException:
+                self._leave_user(user_id, locked=False)
+                raise
+        # Only updates waiting for a free slot count here, not those waiting behind their own user
+        if self.queued >= self.max_queued:
+            if user_id is not None:
+                self._leave_user(user_id, locked=True)
+            self._shed(update, f"{self.queued} updates already queued")
+        self.queued += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queued)
+        try:
+            await self.semaphore.acquire()
+        except BaseException:
+            if user_id is not None:
+                self._leave_user(user_id, locked=True)
+            raise
+        finally:
+            self.queued -= 1
+        self.in_flight += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if released:
+                return
+            released = True
+            self.in_flight -= 1
+            self.processed += 1
+            self.semaphore.release()
+            if user_id is not None:
+                self._leave_user(user_id, locked=True)
+
+        data['serialization_release'] = release
+        # aiogram skips post-process when a later middleware raises in pre-process,
+        # so the end of the update's task releases the slot as well
+        asyncio.current_task().add_done_callback(lambda task: release())
+
+    async def on_post_process_update(self, update: types.Update, result, data: dict):
+        release = data.pop('serialization_release', None)
+        if release:
+            release()
+
+    def get_stats(self) -> dict:
+        return {
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'max_queue_depth': self.max_queue_depth,
+            'processed': self.processed,
+            'shed': self.shed,
+            'limit': self.limit,
+        }
+
+update_types = ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+                'shipping_query', 'pre_checkout_query', 'poll', 'poll_answer', 'my_chat_member', 'chat_member',
+                'chat_join_request', 'channel_post', 'edited_channel_post')
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Records update counts, per-update latency with its DB and Telegram API share,
+    and per-handler latency. Handler errors are counted by HandlerErrorCounter.
+    """
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        update_type = next((name for name in update_types if getattr(update, name) is not None), 'unknown')
+        metrics.updates[update_type] += 1
+        data['metrics_started'] = time.perf_counter()
+        update_timings.set({'db': 0.0, 'api': 0.0})
+
+    async def on_post_process_update(self, update: types.Update, result, data: dict):
+        timings = update_timings.get()
+        metrics.update_latency.observe(time.perf_counter() - data['metrics_started'])
+        metrics.update_db_time.observe(timings['db'])
+        metrics.update_api_time.observe(timings['api'])
+
+    def _start_handler(self, data: dict):
+        handler = current_handler.get()
+        data['metrics_handler'] = handler.__name__
+        data['metrics_handler_started'] = time.perf_counter()
+        data['metrics_handler_token'] = current_handler_name.set(handler.__name__)
+
+    def _finish_handler(self, data: dict):
+        if 'metrics_handler' in data:
+            elapsed = time.perf_counter() - data['metrics_handler_started']
+            metrics.handler_latency[data['metrics_handler']].observe(elapsed)
+            current_handler_name.reset(data.pop('metrics_handler_token'))
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        self._start_handler(data)
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        self._finish_handler(data)
+
+    async def on_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        self._start_handler(data)
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results, data: dict):
+        self._finish_handler(data)
+
+def render_metrics() -> str:
+    lines = ['# TYPE bot_updates_total counter']
+    for update_type, count in metrics.updates.items():
+        lines.append(f'bot_updates_total{{type="{update_type}"}} {count}')
+    lines.append('# TYPE bot_update_duration_seconds histogram')
+    lines += metrics.update_latency.render('bot_update_duration_seconds')
+    lines.append('# TYPE bot_update_db_seconds histogram')
+    lines += metrics.update_db_time.render('bot_update_db_seconds')
+    lines.append('# TYPE bot_update_api_seconds histogram')
+    lines += metrics.update_api_time.render('bot_update_api_seconds')
+    lines.append('# TYPE bot_handler_duration_seconds histogram')
+    for name, histogram in metrics.handler_latency.items():
+        lines += histogram.render('bot_handler_duration_seconds', f'handler="{name}"')
+    lines.append('# TYPE bot_handler_errors_total counter')
+    for name, count in metrics.handler_errors.items():
+        lines.append(f'bot_handler_errors_total{{handler="{name}"}} {count}')
+    lines.append('# TYPE bot_api_duration_seconds histogram')
+    for method, histogram in metrics.api_latency.items():
+        lines += histogram.render('bot_api_duration_seconds', f'method="{method}"')
+    lines.append('# TYPE bot_query_duration_seconds histogram')
+    for fingerprint, histogram in metrics.query_latency.items():
+        label = fingerprint.replace('\\', '\\\\').replace('"', '\\"')
+        lines += histogram.render('bot_query_duration_seconds', f'query="{label}"')
+    lines.append('# TYPE bot_slow_queries_total counter')
+    for fingerprint, count in metrics.slow_queries.items():
+        label = fingerprint.replace('\\', '\\\\').replace('"', '\\"')
+        lines.append(f'bot_slow_queries_total{{query="{label}"}} {count}')
+    lines.append('# TYPE bot_api_errors_total counter')
+    for method, count in metrics.api_errors.items():
+        lines.append(f'bot_api_errors_total{{method="{method}"}} {count}')
+    for key, value in serialization_middleware.get_stats().items():
+        lines.append(f'# TYPE bot_dispatch_{key} gauge')
+        lines.append(f'bot_dispatch_{key} {value}')
+    throttling_stats = throttling_middleware.get_stats()
+    lines.append('# TYPE bot_throttle_allowed_total counter')
+    for category, count in throttling_stats['allowed'].items():
+        lines.append(f'bot_throttle_allowed_total{{category="{category}"}} {count}')
+    lines.append('# TYPE bot_throttle_throttled_total counter')
+    for category, count in throttling_stats['throttled'].items():
+        lines.append(f'bot_throttle_throttled_total{{category="{category}"}} {count}')
+    lines.append('# TYPE bot_throttle_buckets gauge')
+    lines.append(f"bot_throttle_buckets {throttling_stats['tracked_buckets']}")
+    lines.append('# TYPE bot_profile_index_rows gauge')
+    lines.append(f"bot_profile_index_rows {len(profile_index.positions)}")
+    lines.append('# TYPE bot_profile_index_bytes gauge')
+    for column, size in profile_index.memory_usage().items():
+        lines.append(f'bot_profile_index_bytes{{column="{column}"}} {size}')
+    return '\n'.join(lines) + '\n'
+
+async def handle_metrics(request):
+    return web.Response(text=render_metrics(), content_type='text/plain')
+
+metrics_runners = []
+
+async def start_metrics_server(port: int):
+    metrics_app = web.Application()
+    metrics_app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(metrics_app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, port).start()
+    except OSError as e:
+        # Metrics are optional, the bot keeps running without them
+        logging.error(f"Metrics server not started on {METRICS_HOST}:{port}: {e}")
+        await runner.cleanup()
+        return
+    metrics_runners.append(runner)
+    logging.info(f"Metrics available at http://{METRICS_HOST}:{port}/metrics")
+
+record_key = hashlib.sha256(RECORD_UPDATES_SALT.encode()).digest() if RECORD_UPDATES_SALT else os.urandom(32)
+
+def anonymize_user_id(user_id: int) -> int:
+    digest = hashlib.blake2b(str(user_id).encode(), key=record_key, digest_size=5).digest()
+    return (1 << 40) + int.from_bytes(digest, 'big')
+
+class UpdateRecorder:
+    """
+    Writes incoming updates to rotating JSONL files for replay.py. User ids are
+    replaced by anonymize_user_id and free text by placeholders; only texts the
+    bot itself offered as reply keyboard buttons, commands and numbers are kept.
+    File ids of media are replaced too, anyone with the bot token could download them.
+    """
+    message_keys = ('message_id', 'date', 'chat', 'from', 'text', 'caption', 'entities', 'photo', 'video',
+                    'document', 'sticker', 'voice', 'audio', 'media_group_id')
+    media_keys = ('photo', 'video', 'document', 'sticker', 'voice', 'audio')
+    media_fields = ('file_id', 'file_unique_id', 'width', 'height', 'duration', 'file_size', 'mime_type',
+                    'thumb', 'thumbnail', 'is_animated', 'is_video', 'type')
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.buttons = {'Отмена', 'Назад'}
+        self.file = None
+        self.written = 0
+
+    def learn_buttons(self, reply_markup):
+        if isinstance(reply_markup, str):
+            try:
+                reply_markup = json.loads(reply_markup)
+            except ValueError:
+                return
+        if not isinstance(reply_markup, dict):
+            return
+        for row in reply_markup.get('keyboard', []):
+            for button in row:
+                self.buttons.add(button['text'] if isinstance(button, dict) else button)
+
+    def scrub_text(self, text: str) -> str:
+        if text in self.buttons:
+            return text
+        if text.startswith('/'):
+            command, _, args = text.partition(' ')
+            return f"{command} {self.scrub_text(args)}" if args else command
+        if text.isdigit():
+            return str(anonymize_user_id(int(text))) if len(text) >= 6 else text
+        return 'x' * len(text)
+
+    def scrub_user(self, user: dict) -> dict:
+        if user.get('is_bot'):
+            return user
+        user_id = anonymize_user_id(user['id'])
+        return {'id': user_id, 'is_bot': False, 'first_name': 'User', 'username': f"user{user_id}"}
+
+    def scrub_media(self, media):
+        if isinstance(media, list):
+            return [self.scrub_media(item) for item in media]
+        scrubbed = {}
+        for key, value in media.items():
+            if key in ('file_id', 'file_unique_id'):
+                # Keyed like user ids, so the same file keeps the same placeholder across recordings
+                value = 'file_' + hashlib.blake2b(value.encode(), key=record_key, digest_size=8).hexdigest()
+            elif isinstance(value, (dict, list)):
+                value = self.scrub_media(value)
+            if key in self.media_fields:
+                scrubbed[key] = value
+        return scrubbed
+
+    def scrub_message(self, message: dict) -> dict:
+        message = {key: value for key, value in message.items() if key in self.message_keys}
+        chat = message['chat']
+        message['chat'] = {'id': anonymize_user_id(chat['id']) if chat['id'] > 0 else chat['id'], 'type': chat['type']}
+        if 'from' in message:
+            message['from'] = self.scrub_user(message['from'])
+        for key in ('text', 'caption'):
+            if key in message:
+                message[key] = self.scrub_text(message[key])
+        if 'entities' in message:
+            message['entities'] = [entity for entity in message['entities'] if entity['type'] == 'bot_command']
+        for key in self.media_keys:
+            if key in message:
+                message[key] = self.scrub_media(message[key])
+        return message
+
+    def scrub_update(self, update: dict) -> dict:
+        if 'message' in update:
+            return {'update_id': update['update_id'], 'message': self.scrub_message(update['message'])}
+        if 'callback_query' in update:
+            query = dict(update['callback_query'])
+            query['from'] = self.scrub_user(query['from'])
+            if query.get('data'):
+                query['data'] = re.sub(r'\d+', lambda m: str(anonymize_user_id(int(m.group()))), query['data'], count=1)
+            if 'message' in query:
+                query['message'] = self.scrub_message(query['message'])
+            query.pop('inline_message_id', None)
+            return {'update_id': update['update_id'], 'callback_query': query}
+        return {'update_id': update['update_id']}
+
+    def rotate(self):
+        self.close()
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"updates-{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}.jsonl")
+        self.file = open(path, 'a', encoding='utf-8', buffering=1)
+        self.written = self.file.write(json.dumps({'meta': {'super_admin_id': anonymize_user_id(SUPER_ADMIN_ID),
+                                                            'started': time.time()}}) + '\n')
+        logging.info(f"Recording updates to {path}")
+
+    def write(self, update: types.Update):
+        line = json.dumps({'ts': time.time(), 'update': self.scrub_update(update.to_python())}) + '\n'
+        if self.file is None or self.written + len(line) > self.max_bytes:
+            self.rotate()
+        self.written += self.file.write(line)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+class RecordingMiddleware(BaseMiddleware):
+    def __init__(self, recorder: UpdateRecorder):
+        super().__init__()
+        self.recorder = recorder
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        try:
+            self.recorder.write(update)
+        except Exception as e:
+            logging.error(f"Error in RecordingMiddleware: {e}")
+
+class ActivityMiddleware(BaseMiddleware):
+    """
+    Remembers when each user was last seen. Timestamps stay in memory and are
+    written by flush() in one batched UPDATE instead of a write per update.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.pending = {}
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        user_id = get_update_user_id(update)
+        if user_id:
+            self.pending[user_id] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+
+    def flush(self) -> int:
+        if not self.pending:
+            return 0
+        pending, self.pending = self.pending, {}
+        try:
+            cursor.executemany("UPDATE users SET last_seen=? WHERE user_id=?", [(seen, user_id) for user_id, seen in pending.items()])
+            conn.commit()
+        except Exception:
+            for user_id, seen in pending.items():
+                self.pending.setdefault(user_id, seen)
+            raise
+        return len(pending)
+
+class UserContextMiddleware(BaseMiddleware):
+    """
+    Gives every update a UserContext for its sender, so the caller's row, admin
+    flag and premium status are read at most once. Handlers get it as `user_ctx`.
+    """
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        user_id = get_update_user_id(update)
+        user_context.set(UserContext(user_id) if user_id else None)
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        data['user_ctx'] = user_context.get()
+
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        data['user_ctx'] = user_context.get()
+
+async def last_seen_loop():
+    while True:
+        await asyncio.sleep(LAST_SEEN_FLUSH_INTERVAL)
+        try:
+            activity_middleware.flush()
+        except Exception as e:
+            logging.error(f"Error in last_seen_loop: {e}")
+
+update_recorder = UpdateRecorder(RECORD_UPDATES_DIR, RECORD_UPDATES_MAX_BYTES) if RECORD_UPDATES_DIR else None
+activity_middleware = ActivityMiddleware()
+metrics_middleware = MetricsMiddleware()
+throttling_middleware = ThrottlingMiddleware(THROTTLE_LIMITS)
+serialization_middleware = UserSerializationMiddleware(MAX_CONCURRENT_UPDATES, MAX_QUEUED_UPDATES, MAX_USER_QUEUED_UPDATES)
+if update_recorder:
+    dp.middleware.setup(RecordingMiddleware(update_recorder))
+dp.middleware.setup(metrics_middleware)
+dp.middleware.setup(activity_middleware)
+dp.middleware.setup(throttling_middleware)
+dp.middleware.setup(serialization_middleware)
+dp.middleware.setup(UserContextMiddleware())
+
 class ProfileForm(StatesGroup):
     name = State()
     photos = State()
@@ -227,6 +2028,7 @@ class EditForm(StatesGroup):
     seeking_gender = State()
     country = State()
     city = State()
+    pref_age = State()
 
 class AdminForm(StatesGroup):
     view_user_id = State()
@@ -257,11 +2059,15 @@ async def start(message: types.Message, state: FSMContext):
     try:
         user_id = message.from_user.id
         args = message.get_args()
+        reactivate_user(user_id)
         if check_admin(user_id):
             await admin_panel(message)
             return
         cursor.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
-        if cursor.fetchone():
+        existing = cursor.fetchone()
+        if existing and existing['deleted']:
+            await message.reply("Анкета удалена администратором. Создать новую можно чуть позже. 🗑️")
+        elif existing:
             await show_menu(message)
         else:
             if args:
@@ -274,7 +2080,8 @@ async def start(message: types.Message, state: FSMContext):
                 await ProfileForm.name.set()
             cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'started_profile_creation'))
             conn.commit()
-            await bot.send_message(SUPER_ADMIN_ID, f"Новый пользователь {message.from_user.username or 'без username'} начал создание анкеты.")
+            username = message.from_user.username or 'без username'
+            await notify_admin_event('started', f"Новый пользователь {username} начал создание анкеты.", username)
         await check_premium(user_id)
     except Exception as e:
         logging.error(f"Error in /start: {e}")
@@ -527,40 +2334,43 @@ async def process_city(message: types.Message, state: FSMContext):
             premium = 0
             premium_expiry = None
             invite_code = data.get('invite_code')
-            if invite_code:
-                try:
-                    inviter_id = int(invite_code)
-                    cursor.execute("SELECT 1 FROM users WHERE user_id=?", (inviter_id,))
-                    if cursor.fetchone():
-                        cursor.execute("INSERT OR IGNORE INTO invitations (inviter_id, invited_id) VALUES (?, ?)", (inviter_id, user_id))
-                        conn.commit()
-                        cursor.execute("SELECT COUNT(*) FROM invitations WHERE inviter_id=?", (inviter_id,))
-                        invited_count_result = cursor.fetchone()
-                        invited_count = invited_count_result[0]
-                        cursor.execute("UPDATE users SET invited_count=? WHERE user_id=?", (invited_count, inviter_id))
-                        conn.commit()
-                        if invited_count >= 5:
-                            cursor.execute("SELECT premium_expiry FROM users WHERE user_id=?", (inviter_id,))
-                            current_expiry_result = cursor.fetchone()
-                            current_expiry = current_expiry_result['premium_expiry'] if current_expiry_result else None
+            inviter_id = int(invite_code) if invite_code and invite_code.isdigit() else None
+            inviter_rewarded = False
+            action = 'profile_created' if not data.get('editing', False) and not data.get('admin_editing', False) else 'profile_edited'
+            with unit_of_work():
+                if inviter_id:
+                    cursor.execute('''
+                    INSERT OR IGNORE INTO invitations (inviter_id, invited_id)
+                    SELECT ?, ? WHERE EXISTS (SELECT 1 FROM users WHERE user_id = ?)
+                    ''', (inviter_id, user_id, inviter_id))
+                    if cursor.rowcount:
+                        cursor.execute("UPDATE users SET invited_count = COALESCE(invited_count, 0) + 1 WHERE user_id=? RETURNING invited_count, premium_expiry",
+                                       (inviter_id,))
+                        inviter = cursor.fetchone()
+                        if inviter['invited_count'] >= 5:
+                            current_expiry = inviter['premium_expiry']
                             new_expiry = (datetime.fromisoformat(current_expiry) + timedelta(days=1)) if current_expiry else (datetime.now() + timedelta(days=1))
                             cursor.execute("UPDATE users SET premium=1, premium_expiry=? WHERE user_id=?", (new_expiry.isoformat(), inviter_id))
-                            conn.commit()
-                            await bot.send_message(inviter_id, "Поздравляем! Ты пригласил 5 друзей и получил премиум на 24 часа! 😎")
-                except ValueError:
-                    pass
-            cursor.execute('''
-            INSERT OR REPLACE INTO users (user_id, username, name, photos, age, gender, description, seeking_gender, country, city, blocked, premium, premium_expiry, invited_count, last_boost)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, COALESCE((SELECT blocked FROM users WHERE user_id=?), 0), ?, ?, COALESCE((SELECT invited_count FROM users WHERE user_id=?), 0), datetime('now'))
-            ''', (user_id, data['username'], data['name'], photos_json, data['age'], data['gender'],
-                  data['description'], data['seeking_gender'], data['country'], data['city'], user_id, premium, premium_expiry, user_id))
-            conn.commit()
-            action = 'profile_created' if not data.get('editing', False) and not data.get('admin_editing', False) else 'profile_edited'
-            cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, action))
-            conn.commit()
+                            refresh_profile_index(inviter_id)
+                            inviter_rewarded = True
+                # Only the form fields are overwritten; every other column of an existing row is kept
+                cursor.execute('''
+                INSERT INTO users (user_id, username, name, photos, age, gender, description, seeking_gender, country, city, premium, premium_expiry, last_boost)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username = excluded.username, name = excluded.name, photos = excluded.photos, age = excluded.age,
+                    gender = excluded.gender, description = excluded.description, seeking_gender = excluded.seeking_gender,
+                    country = excluded.country, city = excluded.city, last_boost = excluded.last_boost
+                ''', (user_id, data['username'], data['name'], photos_json, data['age'], data['gender'],
+                      data['description'], data['seeking_gender'], data['country'], data['city'], premium, premium_expiry))
+                refresh_profile_flags(user_id)
+                cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, action))
+                if action == 'profile_created':
+                    boost_profile(user_id)
+            if inviter_rewarded:
+                await notify_user(inviter_id, "Поздравляем! Ты пригласил 5 друзей и получил премиум на 24 часа! 😎")
             if action == 'profile_created':
-                await bot.send_message(SUPER_ADMIN_ID, f"Новый пользователь {data['username']} создал анкету.")
-                boost_profile(user_id)
+                await notify_admin_event('created', f"Новый пользователь {data['username']} создал анкету.", f"{data['username']} ({data['city']})", data['city'])
         await state.finish()
         msg = "Анкета обновлена! Теперь можно искать знакомства. 🙂" if data.get('editing', False) or data.get('admin_editing', False) else "Анкета создана! 🙂"
         await message.reply(msg, reply_markup=types.ReplyKeyboardRemove())
@@ -574,23 +2384,25 @@ async def process_city(message: types.Message, state: FSMContext):
 
 async def show_menu(message: types.Message):
     try:
-        user_id = message.from_user.id
+        # Callbacks pass the bot's own message here; in a private chat the chat id is the user
+        user_id = message.chat.id
         await check_premium(user_id)
         keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
         keyboard.row(KeyboardButton('Искать анкеты 🔍'), KeyboardButton('Кто меня лайкнул ❤️'))
         keyboard.row(KeyboardButton('Моя анкета 👤'), KeyboardButton('Редактировать анкету ✏️'))
         keyboard.row(KeyboardButton('Помощь ❓'), KeyboardButton('Мой статус 💎'))
-        await message.reply("Вы в главном меню: Выбери действие! 🙂", reply_markup=keyboard)
+        pending = count_pending_likes(user_id)
+        pending_line = f"\nНовых лайков: {pending} ❤️" if pending else ""
+        await message.reply(f"Вы в главном меню: Выбери действие! 🙂{pending_line}", reply_markup=keyboard)
     except Exception as e:
         logging.error(f"Error in show_menu: {e}")
 
 @dp.message_handler(Text(equals='Мой статус 💎'))
-async def view_status(message: types.Message):
+async def view_status(message: types.Message, user_ctx: UserContext):
     try:
         user_id = message.from_user.id
         await check_premium(user_id)
-        cursor.execute("SELECT invited_count, premium, premium_expiry FROM users WHERE user_id=?", (user_id,))
-        result = cursor.fetchone()
+        result = user_ctx.row
         if not result:
             await message.reply("Анкета не найдена. Создай /start 😔")
             return
@@ -609,12 +2421,11 @@ async def view_status(message: types.Message):
         await message.reply("Ошибка при просмотре статуса. 😔")
 
 @dp.message_handler(Text(equals='Моя анкета 👤'))
-async def view_own_profile(message: types.Message):
+async def view_own_profile(message: types.Message, user_ctx: UserContext):
     try:
         user_id = message.from_user.id
         await check_premium(user_id)
-        cursor.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
-        profile = cursor.fetchone()
+        profile = user_ctx.row
         if not profile:
             await message.reply("Анкета не найдена. Создай /start 😔")
             return
@@ -637,7 +2448,10 @@ async def view_own_profile(message: types.Message):
         seeking_gender = profile['seeking_gender']
         country = profile['country']
         city = profile['city']
-        caption = f"Твоя анкета:\n{name}, {age} лет, {gender.capitalize()} {status}\n{desc_line}Ищешь: {seeking_gender.capitalize()}\nСтрана: {country}\nГород: {city}"
+        pref_age_min = profile['pref_age_min']
+        pref_age_max = profile['pref_age_max']
+        pref_line = f"Возраст: {pref_age_min}-{pref_age_max}\n" if pref_age_min is not None else ""
+        caption = f"Твоя анкета:\n{name}, {age} лет, {gender.capitalize()} {status}\n{desc_line}Ищешь: {seeking_gender.capitalize()}\n{pref_line}Страна: {country}\nГород: {city}"
         media = MediaGroup()
         for i, photo in enumerate(photos):
             if i == 0:
@@ -653,7 +2467,7 @@ async def show_edit_menu(message: types.Message):
     keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
     keyboard.row('Имя ✏️', 'Фото 📸', 'Возраст 🔢')
     keyboard.row('Пол 🚻', 'Описание 📝', 'Пол поиска 🔍')
-    keyboard.row('Страна 🌍', 'Город 🏙️')
+    keyboard.row('Страна 🌍', 'Город 🏙️', 'Возраст поиска 🎯')
     keyboard.row('Завершить редактирование ✅')
     await message.reply("Что хочешь изменить?", reply_markup=keyboard)
 
@@ -695,10 +2509,10 @@ async def edit_name(message: types.Message, state: FSMContext):
         await message.reply("Имя не может быть пустым.")
         return
     user_id = message.from_user.id
-    cursor.execute("UPDATE users SET name=? WHERE user_id=?", (message.text.strip(), user_id))
-    conn.commit()
-    cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'edited_name'))
-    conn.commit()
+    with unit_of_work():
+        cursor.execute("UPDATE users SET name=? WHERE user_id=?", (message.text.strip(), user_id))
+        refresh_profile_flags(user_id)
+        cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'edited_name'))
     await message.reply("Имя обновлено! 🙂")
     await state.finish()
     await show_edit_menu(message)
@@ -734,10 +2548,10 @@ async def edit_photos_done(message: types.Message, state: FSMContext):
                 return
             user_id = message.from_user.id
             photos_json = json.dumps(data['photos'])
-            cursor.execute("UPDATE users SET photos=? WHERE user_id=?", (photos_json, user_id))
-            conn.commit()
-            cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'edited_photos'))
-            conn.commit()
+            with unit_of_work():
+                cursor.execute("UPDATE users SET photos=? WHERE user_id=?", (photos_json, user_id))
+                refresh_profile_flags(user_id)
+                cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'edited_photos'))
             await message.reply("Фото обновлены! 🙂")
             await state.finish()
             await show_edit_menu(message)
@@ -762,10 +2576,10 @@ async def edit_age(message: types.Message, state: FSMContext):
             await message.reply("Возраст должен быть больше 0.")
             return
         user_id = message.from_user.id
-        cursor.execute("UPDATE users SET age=? WHERE user_id=?", (age, user_id))
-        conn.commit()
-        cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'edited_age'))
-        conn.commit()
+        with unit_of_work():
+            cursor.execute("UPDATE users SET age=? WHERE user_id=?", (age, user_id))
+            refresh_profile_flags(user_id)
+            cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'edited_age'))
         await message.reply("Возраст обновлен! 🙂")
         await state.finish()
         await show_edit_menu(message)
@@ -790,10 +2604,10 @@ async def edit_gender(message: types.Message, state: FSMContext):
         await message.reply("Выбери 'Мужской 🚹' или 'Женский 🚺'.")
         return
     user_id = message.from_user.id
-    cursor.execute("UPDATE users SET gender=? WHERE user_id=?", (gender, user_id))
-    conn.commit()
-    cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'edited_gender'))
-    conn.commit()
+    with unit_of_work():
+        cursor.execute("UPDATE users SET gender=? WHERE user_id=?", (gender, user_id))
+        refresh_profile_flags(user_id)
+        cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'edited_gender'))
     await message.reply("Пол обновлен! 🙂")
     await state.finish()
     await show_edit_menu(message)
@@ -818,10 +2632,9 @@ async def edit_description(message: types.Message, state: FSMContext):
             await message.reply("Если не пропустить, описание не может быть пустым.")
             return
     user_id = message.from_user.id
-    cursor.execute("UPDATE users SET description=? WHERE user_id=?", (desc, user_id))
-    conn.commit()
-    cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'edited_description'))
-    conn.commit()
+    with unit_of_work():
+        cursor.execute("UPDATE users SET description=? WHERE user_id=?", (desc, user_id))
+        cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'edited_description'))
     await message.reply("Описание обновлено! 🙂")
     await state.finish()
     await show_edit_menu(message)
@@ -844,10 +2657,10 @@ async def edit_seeking_gender(message: types.Message, state: FSMContext):
         await message.reply("Выбери 'Мужской 🚹' или 'Женский 🚺'.")
         return
     user_id = message.from_user.id
-    cursor.execute("UPDATE users SET seeking_gender=? WHERE user_id=?", (seeking_gender, user_id))
-    conn.commit()
-    cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'edited_seeking_gender'))
-    conn.commit()
+    with unit_of_work():
+        cursor.execute("UPDATE users SET seeking_gender=? WHERE user_id=?", (seeking_gender, user_id))
+        refresh_profile_flags(user_id)
+        cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'edited_seeking_gender'))
     await message.reply("Пол поиска обновлен! 🙂")
     await state.finish()
     await show_edit_menu(message)
@@ -872,10 +2685,10 @@ async def edit_country(message: types.Message, state: FSMContext):
         await message.reply("Выбери из списка.")
         return
     user_id = message.from_user.id
-    cursor.execute("UPDATE users SET country=? WHERE user_id=?", (country, user_id))
-    conn.commit()
-    cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'edited_country'))
-    conn.commit()
+    with unit_of_work():
+        cursor.execute("UPDATE users SET country=? WHERE user_id=?", (country, user_id))
+        refresh_profile_flags(user_id)
+        cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'edited_country'))
     await message.reply("Страна обновлена! 🙂 (Возможно, обнови город, если нужно.)")
     await state.finish()
     await show_edit_menu(message)
@@ -909,14 +2722,46 @@ async def edit_city(message: types.Message, state: FSMContext):
     if city not in cities_by_country.get(country, []):
         await message.reply("Выбери из списка для твоей страны.")
         return
-    cursor.execute("UPDATE users SET city=? WHERE user_id=?", (city, user_id))
-    conn.commit()
-    cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'edited_city'))
-    conn.commit()
+    with unit_of_work():
+        cursor.execute("UPDATE users SET city=? WHERE user_id=?", (city, user_id))
+        refresh_profile_flags(user_id)
+        cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'edited_city'))
     await message.reply("Город обновлен! 🙂")
     await state.finish()
     await show_edit_menu(message)
 
+@dp.message_handler(Text(equals='Возраст поиска 🎯'))
+async def edit_pref_age_start(message: types.Message, state: FSMContext):
+    keyboard = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
+    keyboard.add(KeyboardButton('Любой ❓'), KeyboardButton('Назад ⬅️'))
+    await message.reply("Введи возраст, который ищешь, в формате 18-30 (или Любой):", reply_markup=keyboard)
+    await EditForm.pref_age.set()
+
+@dp.message_handler(state=EditForm.pref_age)
+async def edit_pref_age(message: types.Message, state: FSMContext):
+    if message.text == 'Назад ⬅️':
+        await back_handler(message, state)
+        return
+    try:
+        if message.text == 'Любой ❓':
+            pref_age_min, pref_age_max = None, None
+        else:
+            match = re.fullmatch(r'\s*(\d{1,3})\s*[-–]\s*(\d{1,3})\s*', message.text or '')
+            if not match:
+                await message.reply("Введи диапазон в формате 18-30.")
+                return
+            pref_age_min, pref_age_max = sorted(map(int, match.groups()))
+        user_id = message.from_user.id
+        with unit_of_work():
+            cursor.execute("UPDATE users SET pref_age_min=?, pref_age_max=? WHERE user_id=?", (pref_age_min, pref_age_max, user_id))
+            cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'edited_pref_age'))
+        await message.reply("Возраст поиска обновлен! 🙂")
+        await state.finish()
+        await show_edit_menu(message)
+    except Exception as e:
+        logging.error(f"Error in edit_pref_age: {e}")
+        await message.reply("Ошибка при обновлении возраста поиска. 😔")
+
 @dp.message_handler(Text(equals='Помощь ❓'))
 async def help_command(message: types.Message):
     try:
@@ -932,14 +2777,15 @@ async def help_command(message: types.Message):
     except Exception as e:
         logging.error(f"Error in help_command: {e}")
 
-@dp.message_handler(Text(equals='Искать анкеты 🔍'))
-async def search_profiles(message: types.Message, state: FSMContext):
+@dp.message_handler(Text(equals='Искать анкеты 🔍'), state=[None, SearchContext.search])
+async def search_profiles(message: types.Message, state: FSMContext, user_ctx: UserContext = None):
     try:
-        user_id = message.from_user.id
+        # Callbacks pass the bot's own message here; in a private chat the chat id is the user
+        user_id = message.chat.id
+        user_ctx = user_ctx or caller_context(user_id) or UserContext(user_id)
         await check_premium(user_id)
         is_admin_flag = check_admin(user_id)
-        cursor.execute("SELECT seeking_gender, blocked, city, premium FROM users WHERE user_id=?", (user_id,))
-        result = cursor.fetchone()
+        result = user_ctx.row
         if not result:
             return
         seeking_gender = result['seeking_gender']
@@ -949,28 +2795,8 @@ async def search_profiles(message: types.Message, state: FSMContext):
         if blocked and not is_admin_flag:
             await message.reply("Ты заблокирован. Нельзя искать анкеты. 🚫")
             return
-        profile = None
-        if not is_admin_flag:
-            cursor.execute('''
-            SELECT * FROM users 
-            WHERE gender = ? AND user_id != ? AND blocked = 0 AND city = ?
-            AND user_id NOT IN (SELECT to_user FROM likes WHERE from_user = ?)
-            AND user_id NOT IN (SELECT to_user FROM dislikes WHERE from_user = ?)
-            AND user_id NOT IN (SELECT to_user FROM skips WHERE from_user = ?)
-            ORDER BY premium DESC, last_boost DESC, RANDOM() LIMIT 1
-            ''', (seeking_gender, user_id, user_city, user_id, user_id, user_id))
-            profile = cursor.fetchone()
-        if not profile:
-            cursor.execute('''
-            SELECT * FROM users 
-            WHERE gender = ? AND user_id != ? AND (blocked = 0 OR ? = 1)
-            AND (user_id NOT IN (SELECT to_user FROM likes WHERE from_user = ?) OR ? = 1)
-            AND (user_id NOT IN (SELECT to_user FROM dislikes WHERE from_user = ?) OR ? = 1)
-            AND (user_id NOT IN (SELECT to_user FROM skips WHERE from_user = ?) OR ? = 1)
-            ORDER BY premium DESC, last_boost DESC, RANDOM() LIMIT 1
-            ''', (seeking_gender, user_id, is_admin_flag, user_id, is_admin_flag, user_id, is_admin_flag, user_id, is_admin_flag))
-            profile = cursor.fetchone()
-
+        profile = find_candidate(user_id, seeking_gender, user_city, is_admin_flag, result['age'],
+                                 result['pref_age_min'], result['pref_age_max'], result['country'], result['gender'])
         if not profile:
             await message.reply("Нет подходящих анкет сейчас. Попробуй позже или пригласи друзей! 🔍")
             return
@@ -986,9 +2812,6 @@ async def search_profiles(message: types.Message, state: FSMContext):
         blocked = profile['blocked']
         premium = profile['premium']
         photos = json.loads(photos_json or '[]')
-        if not photos:
-            await search_profiles(message, state)
-            return
         desc_line = f"{description}\n" if description else ""
         status = "💎 VIP" if premium else ""
         caption = f"{name}, {age} лет, {gender.capitalize()} {status}\n{desc_line}Страна: {country}\nГород: {city}"
@@ -999,6 +2822,8 @@ async def search_profiles(message: types.Message, state: FSMContext):
             else:
                 media.attach_photo(photo)
         await bot.send_media_group(message.chat.id, media)
+        if not is_admin_flag:
+            feed_impressions[to_user_id] += 1
         keyboard = InlineKeyboardMarkup(row_width=2)
         if is_admin_flag:
             keyboard.add(
@@ -1034,14 +2859,13 @@ async def admin_next_profile(callback_query: types.CallbackQuery):
         await callback_query.answer("Ошибка. 😔")
 
 @dp.callback_query_handler(lambda c: c.data.startswith('like_'), state=SearchContext.search)
-async def process_like_search(callback_query: types.CallbackQuery, state: FSMContext):
+async def process_like_search(callback_query: types.CallbackQuery, state: FSMContext, user_ctx: UserContext):
     try:
         await state.finish()
         to_user_id = int(callback_query.data.split('_')[1])
         from_user_id = callback_query.from_user.id
 
-        cursor.execute("SELECT blocked, premium FROM users WHERE user_id=?", (from_user_id,))
-        result = cursor.fetchone()
+        result = user_ctx.row
         if result:
             blocked_from = result['blocked']
             premium = result['premium']
@@ -1061,14 +2885,11 @@ async def process_like_search(callback_query: types.CallbackQuery, state: FSMCon
             await callback_query.answer("Лимит лайков (30 в день). Стань премиум! 💎")
             return
 
-        cursor.execute("INSERT OR IGNORE INTO likes (from_user, to_user) VALUES (?, ?)", (from_user_id, to_user_id))
-        conn.commit()
+        with unit_of_work():
+            cursor.execute("INSERT OR IGNORE INTO likes (from_user, to_user) VALUES (?, ?)", (from_user_id, to_user_id))
+            cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (from_user_id, f'liked_{to_user_id}'))
 
-        cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (from_user_id, f'liked_{to_user_id}'))
-        conn.commit()
-
-        cursor.execute("SELECT name, username, gender FROM users WHERE user_id=?", (from_user_id,))
-        from_profile = cursor.fetchone()
+        from_profile = user_ctx.row
         if not from_profile:
             raise ValueError("From user not found")
         from_name = from_profile['name']
@@ -1087,13 +2908,13 @@ async def process_like_search(callback_query: types.CallbackQuery, state: FSMCon
             like_msg = f"Ты понравилась {from_name}! Проверь анкеты, чтобы ответить. 👀"
         else:
             like_msg = f"Ты понравился {from_name}! Проверь анкеты, чтобы ответить. 👀"
-        await bot.send_message(to_user_id, like_msg)
+        await notify_user(to_user_id, like_msg)
 
         cursor.execute("SELECT * FROM likes WHERE from_user = ? AND to_user = ?", (to_user_id, from_user_id))
         if cursor.fetchone():
             await bot.send_message(from_user_id, f"Взаимный лайк с {to_name}! Напиши ему/ей в ЛС: @{to_username} 🤝")
-            await bot.send_message(to_user_id, f"Взаимный лайк с {from_name}! Напиши ему/ей в ЛС: @{from_username} 🤝")
-            await bot.send_message(SUPER_ADMIN_ID, f"Новый mutual лайк между {from_user_id} и {to_user_id}.")
+            await notify_user(to_user_id, f"Взаимный лайк с {from_name}! Напиши ему/ей в ЛС: @{from_username} 🤝")
+            await notify_admin_event('mutual', f"Новый mutual лайк между {from_user_id} и {to_user_id}.", f"{from_user_id} ↔ {to_user_id}")
 
         await callback_query.answer("Лайк поставлен! 👍")
         await search_profiles(callback_query.message, None)
@@ -1102,14 +2923,13 @@ async def process_like_search(callback_query: types.CallbackQuery, state: FSMCon
         await callback_query.answer("Ошибка при лайке. 😔")
 
 @dp.callback_query_handler(lambda c: c.data.startswith('like_'), state=ViewingState.likes)
-async def process_like_likes(callback_query: types.CallbackQuery, state: FSMContext):
+async def process_like_likes(callback_query: types.CallbackQuery, state: FSMContext, user_ctx: UserContext):
     try:
         await state.finish()
         to_user_id = int(callback_query.data.split('_')[1])
         from_user_id = callback_query.from_user.id
 
-        cursor.execute("SELECT blocked, premium FROM users WHERE user_id=?", (from_user_id,))
-        result = cursor.fetchone()
+        result = user_ctx.row
         if result:
             blocked_from = result['blocked']
             premium = result['premium']
@@ -1121,22 +2941,21 @@ async def process_like_likes(callback_query: types.CallbackQuery, state: FSMCont
         blocked_to_result = cursor.fetchone()
         blocked_to = blocked_to_result['blocked'] if blocked_to_result else None
         if blocked_to:
+            mark_like_handled(from_user_id, to_user_id)
             await callback_query.answer("Этот пользователь заблокирован. 🚫")
-            await view_incoming_likes(callback_query.message)
+            await view_incoming_likes(callback_query.message, state, from_user_id)
             return
 
         if not await check_like_limit(from_user_id):
             await callback_query.answer("Лимит лайков (30 в день). Стань премиум! 💎")
             return
 
-        cursor.execute("INSERT OR IGNORE INTO likes (from_user, to_user) VALUES (?, ?)", (from_user_id, to_user_id))
-        conn.commit()
-
-        cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (from_user_id, f'liked_{to_user_id}'))
-        conn.commit()
+        with unit_of_work():
+            cursor.execute("INSERT OR IGNORE INTO likes (from_user, to_user) VALUES (?, ?)", (from_user_id, to_user_id))
+            mark_like_handled(from_user_id, to_user_id)
+            cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (from_user_id, f'liked_{to_user_id}'))
 
-        cursor.execute("SELECT name, username, gender FROM users WHERE user_id=?", (from_user_id,))
-        from_profile = cursor.fetchone()
+        from_profile = user_ctx.row
         if not from_profile:
             raise ValueError("From user not found")
         from_name = from_profile['name']
@@ -1155,16 +2974,16 @@ async def process_like_likes(callback_query: types.CallbackQuery, state: FSMCont
             like_msg = f"Ты понравилась {from_name}! Проверь анкеты, чтобы ответить. 👀"
         else:
             like_msg = f"Ты понравился {from_name}! Проверь анкеты, чтобы ответить. 👀"
-        await bot.send_message(to_user_id, like_msg)
+        await notify_user(to_user_id, like_msg)
 
         cursor.execute("SELECT * FROM likes WHERE from_user = ? AND to_user = ?", (to_user_id, from_user_id))
         if cursor.fetchone():
             await bot.send_message(from_user_id, f"Взаимный лайк с {to_name}! Напиши ему/ей в ЛС: @{to_username} 🤝")
-            await bot.send_message(to_user_id, f"Взаимный лайк с {from_name}! Напиши ему/ей в ЛС: @{from_username} 🤝")
-            await bot.send_message(SUPER_ADMIN_ID, f"Новый mutual лайк между {from_user_id} и {to_user_id}.")
+            await notify_user(to_user_id, f"Взаимный лайк с {from_name}! Напиши ему/ей в ЛС: @{from_username} 🤝")
+            await notify_admin_event('mutual', f"Новый mutual лайк между {from_user_id} и {to_user_id}.", f"{from_user_id} ↔ {to_user_id}")
 
         await callback_query.answer("Лайк поставлен! 👍")
-        await view_incoming_likes(callback_query.message)
+        await view_incoming_likes(callback_query.message, state, from_user_id)
     except Exception as e:
         logging.error(f"Error in process_like_likes: {e}")
         await callback_query.answer("Ошибка при лайке. 😔")
@@ -1176,11 +2995,9 @@ async def process_dislike_search(callback_query: types.CallbackQuery, state: FSM
         to_user_id = int(callback_query.data.split('_')[1])
         from_user_id = callback_query.from_user.id
 
-        cursor.execute("INSERT OR IGNORE INTO dislikes (from_user, to_user) VALUES (?, ?)", (from_user_id, to_user_id))
-        conn.commit()
-
-        cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (from_user_id, f'disliked_{to_user_id}'))
-        conn.commit()
+        with unit_of_work():
+            cursor.execute("INSERT OR IGNORE INTO dislikes (from_user, to_user) VALUES (?, ?)", (from_user_id, to_user_id))
+            cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (from_user_id, f'disliked_{to_user_id}'))
 
         await callback_query.answer("Дизлайк! Следующая... 👎")
         await search_profiles(callback_query.message, None)
@@ -1195,14 +3012,13 @@ async def process_dislike_likes(callback_query: types.CallbackQuery, state: FSMC
         to_user_id = int(callback_query.data.split('_')[1])
         from_user_id = callback_query.from_user.id
 
-        cursor.execute("INSERT OR IGNORE INTO dislikes (from_user, to_user) VALUES (?, ?)", (from_user_id, to_user_id))
-        conn.commit()
-
-        cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (from_user_id, f'disliked_{to_user_id}'))
-        conn.commit()
+        with unit_of_work():
+            cursor.execute("INSERT OR IGNORE INTO dislikes (from_user, to_user) VALUES (?, ?)", (from_user_id, to_user_id))
+            cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (from_user_id, f'disliked_{to_user_id}'))
+            mark_like_handled(from_user_id, to_user_id)
 
         await callback_query.answer("Дизлайк! Следующий... 👎")
-        await view_incoming_likes(callback_query.message)
+        await view_incoming_likes(callback_query.message, state, from_user_id)
     except Exception as e:
         logging.error(f"Error in process_dislike_likes: {e}")
         await callback_query.answer("Ошибка при дизлайке. 😔")
@@ -1214,11 +3030,9 @@ async def process_skip_search(callback_query: types.CallbackQuery, state: FSMCon
         to_user_id = int(callback_query.data.split('_')[1])
         from_user_id = callback_query.from_user.id
 
-        cursor.execute("INSERT OR IGNORE INTO skips (from_user, to_user) VALUES (?, ?)", (from_user_id, to_user_id))
-        conn.commit()
-
-        cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (from_user_id, f'skipped_{to_user_id}'))
-        conn.commit()
+        with unit_of_work():
+            cursor.execute("INSERT OR REPLACE INTO skips (from_user, to_user, created_at) VALUES (?, ?, CURRENT_TIMESTAMP)", (from_user_id, to_user_id))
+            cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (from_user_id, f'skipped_{to_user_id}'))
 
         await callback_query.answer("Пропущено! Следующая... ⏭️")
         await search_profiles(callback_query.message, None)
@@ -1280,31 +3094,27 @@ async def process_report(message: types.Message, state: FSMContext):
         reported_result = cursor.fetchone()
         reported_name = reported_result['name'] if reported_result else "Unknown"
         report_msg = f"⚠️ Новая жалоба!\nОт: {reporter_name} (ID: {reporter_id})\nНа: {reported_name} (ID: {reported_user_id})\nПричина: {reason}"
-        admins = get_all_admins()
-        for admin_id in admins:
-            try:
-                await bot.send_message(admin_id, report_msg)
-            except Exception as e:
-                logging.error(f"Failed to send report to admin {admin_id}: {e}")
+        run_in_background(send_report_to_admins(report_msg))
         cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (reporter_id, f'reported_{reported_user_id}_{reason[:50]}'))
         conn.commit()
         await message.reply("Жалоба отправлена администраторам. Спасибо! 🙏", reply_markup=types.ReplyKeyboardRemove())
+        await state.finish()
         if from_state == SearchContext.search.state:
             await search_profiles(message, None)
         elif from_state == ViewingState.likes.state:
-            await view_incoming_likes(message)
+            mark_like_handled(reporter_id, reported_user_id)
+            await view_incoming_likes(message, state)
         else:
             await show_menu(message)
-        await state.finish()
     except Exception as e:
         logging.error(f"Error in process_report: {e}")
         await message.reply("Ошибка при отправке жалобы. 😔")
         await state.finish()
 
 @dp.message_handler(Text(equals='Кто меня лайкнул ❤️'))
-async def view_incoming_likes(message: types.Message, state: FSMContext):
+async def view_incoming_likes(message: types.Message, state: FSMContext, user_id: int = None):
     try:
-        user_id = message.from_user.id
+        user_id = user_id or message.from_user.id
         await check_premium(user_id)
         cursor.execute("SELECT blocked FROM users WHERE user_id=?", (user_id,))
         blocked_result = cursor.fetchone()
@@ -1312,15 +3122,9 @@ async def view_incoming_likes(message: types.Message, state: FSMContext):
         if blocked:
             await message.reply("Ты заблокирован. Нельзя просматривать лайки. 🚫")
             return
-        cursor.execute('''
-        SELECT * FROM users 
-        WHERE user_id IN (SELECT from_user FROM likes WHERE to_user = ?)
-        AND blocked = 0
-        ORDER BY premium DESC, last_boost DESC, RANDOM() LIMIT 1
-        ''', (user_id,))
-        profile = cursor.fetchone()
+        profile = find_incoming_liker(user_id)
         if not profile:
-            await message.reply("Нет лайков пока. Продолжай искать! 😔")
+            await message.reply("Новых лайков пока нет. Продолжай искать! 😔")
             return
         to_user_id = profile['user_id']
         name = profile['name']
@@ -1332,15 +3136,9 @@ async def view_incoming_likes(message: types.Message, state: FSMContext):
         city = profile['city']
         premium = profile['premium']
         photos = json.loads(photos_json or '[]')
-        if not photos:
-            await view_incoming_likes(message, state)
-            return
-        cursor.execute("SELECT 1 FROM likes WHERE from_user=? AND to_user=?", (user_id, to_user_id))
-        is_mutual = cursor.fetchone() is not None
         desc_line = f"{description}\n" if description else ""
         status = "💎 VIP" if premium else ""
-        mutual_text = "\n🤝 Взаимный лайк! Напишите в ЛС!" if is_mutual else ""
-        caption = f"{name}, {age} лет, {gender.capitalize()} {status}\n{desc_line}Страна: {country}\nГород: {city}\nЭтот пользователь лайкнул тебя!{mutual_text}"
+        caption = f"{name}, {age} лет, {gender.capitalize()} {status}\n{desc_line}Страна: {country}\nГород: {city}\nЭтот пользователь лайкнул тебя!"
         media = MediaGroup()
         for i, photo in enumerate(photos):
             if i == 0:
@@ -1368,12 +3166,12 @@ async def skip_incoming(callback_query: types.CallbackQuery, state: FSMContext):
         await state.finish()
         to_user_id = int(callback_query.data.split('_')[2])
         from_user_id = callback_query.from_user.id
-        cursor.execute("INSERT OR IGNORE INTO skips (from_user, to_user) VALUES (?, ?)", (from_user_id, to_user_id))
-        conn.commit()
-        cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (from_user_id, f'skipped_{to_user_id}'))
-        conn.commit()
+        with unit_of_work():
+            cursor.execute("INSERT OR REPLACE INTO skips (from_user, to_user, created_at) VALUES (?, ?, CURRENT_TIMESTAMP)", (from_user_id, to_user_id))
+            cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (from_user_id, f'skipped_{to_user_id}'))
+            mark_like_handled(from_user_id, to_user_id)
         await callback_query.answer("Пропущено! Следующий... ⏭️")
-        await view_incoming_likes(callback_query.message)
+        await view_incoming_likes(callback_query.message, state, from_user_id)
     except Exception as e:
         logging.error(f"Error in skip_incoming: {e}")
         await callback_query.answer("Ошибка. 😔")
@@ -1391,6 +3189,7 @@ async def admin_panel(message: types.Message):
         keyboard.row(KeyboardButton('Экспорт данных 📤'), KeyboardButton('Просмотр логов 📜'))
         keyboard.row(KeyboardButton('Выдать премиум 💎'), KeyboardButton('Отменить премиум ❌'))
         keyboard.row(KeyboardButton('Пользователи с премиум 💎📋'), KeyboardButton('Жалобы ⚠️'))
+        keyboard.row(KeyboardButton('Производительность ⚡'))
         if check_super_admin(message.from_user.id):
             keyboard.row(KeyboardButton('Список админов 👥'), KeyboardButton('Назначить админа ✅'), KeyboardButton('Удалить админа ❌'))
         keyboard.add(KeyboardButton('Отмена'))
@@ -1403,30 +3202,47 @@ async def stats(message: types.Message):
     if not check_admin(message.from_user.id):
         return
     try:
-        cursor.execute("SELECT COUNT(*) FROM users")
-        users_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM likes")
-        likes_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM dislikes")
-        dislikes_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM skips")
-        skips_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM users WHERE blocked=1")
-        blocked_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM users WHERE premium=1")
-        premium_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(DISTINCT from_user) FROM likes")
-        active_likers = cursor.fetchone()[0]
-        cursor.execute("""
-        SELECT COUNT(*) FROM likes l1
-        WHERE EXISTS (SELECT 1 FROM likes l2 WHERE l1.from_user = l2.to_user AND l1.to_user = l2.from_user)
-        """)
-        matches_count = cursor.fetchone()[0] // 2
-        await message.reply(f"Пользователей: {users_count}\nПремиум: {premium_count}\nЛайков: {likes_count}\nДизлайков: {dislikes_count}\nСкипов: {skips_count}\nЗаблокировано: {blocked_count}\nАктивных лайкеров: {active_likers}\nMutual matches: {matches_count} 📊")
+        counts = collect_stats()
+        await message.reply(f"Пользователей: {counts['users']}\nПремиум: {counts['premium']}\nЛайков: {counts['likes']}\nДизлайков: {counts['dislikes']}\nСкипов: {counts['skips']}\nЗаблокировано: {counts['blocked']}\nАктивных лайкеров: {counts['active_likers']}\nMutual matches: {counts['matches']} 📊")
     except Exception as e:
         logging.error(f"Error in stats: {e}")
         await message.reply("Ошибка при получении статистики. 😔")
 
+def format_percentiles(histogram: Histogram) -> str:
+    return '/'.join(f"{histogram.percentile(q) * 1000:.0f}" for q in (0.5, 0.95, 0.99))
+
+@dp.message_handler(Text(equals='Производительность ⚡'))
+async def performance(message: types.Message):
+    if not check_admin(message.from_user.id):
+        return
+    try:
+        updates = metrics.update_latency
+        db_avg = metrics.update_db_time.total / metrics.update_db_time.count * 1000 if metrics.update_db_time.count else 0
+        api_avg = metrics.update_api_time.total / metrics.update_api_time.count * 1000 if metrics.update_api_time.count else 0
+        dispatch = serialization_middleware.get_stats()
+        throttled = throttling_middleware.get_stats()['throttled']
+        response = "Производительность ⚡ (p50/p95/p99, мс)\n"
+        response += f"Обновлений: {updates.count}, {format_percentiles(updates)}\n"
+        response += f"В среднем на обновление: БД {db_avg:.1f} мс, API {api_avg:.1f} мс\n"
+        response += f"В работе: {dispatch['in_flight']}, в очереди: {dispatch['queued']} (макс. {dispatch['max_queue_depth']}), отброшено: {dispatch['shed']}\n"
+        if throttled:
+            response += f"Ограничено: {', '.join(f'{k}: {v}' for k, v in throttled.items())}\n"
+        if profile_index.ready:
+            index_size = sum(profile_index.memory_usage().values()) / 1024 / 1024
+            response += f"Индекс анкет: {len(profile_index.positions)} шт., {index_size:.1f} МБ ({'numpy' if numpy is not None else 'array'})\n"
+        response += "\nХендлеры:\n"
+        handlers = sorted(metrics.handler_latency.items(), key=lambda item: item[1].count, reverse=True)[:20]
+        for name, histogram in handlers:
+            response += f"{name}: {histogram.count} шт., ошибок {metrics.handler_errors[name]}, {format_percentiles(histogram)}\n"
+        response += "\nСамые затратные запросы:\n"
+        queries = sorted(metrics.query_latency.items(), key=lambda item: item[1].total, reverse=True)[:5]
+        for fingerprint, histogram in queries:
+            response += f"{fingerprint[:120]}: {histogram.count} шт., всего {histogram.total * 1000:.1f} мс, медленных {metrics.slow_queries[fingerprint]}, {format_percentiles(histogram)}\n"
+        await message.reply(response)
+    except Exception as e:
+        logging.error(f"Error in performance: {e}")
+        await message.reply("Ошибка при получении метрик. 😔")
+
 @dp.message_handler(Text(equals='Список пользователей 📋'))
 async def list_users(message: types.Message):
     if not check_admin(message.from_user.id):
@@ -1562,11 +3378,11 @@ async def admin_block_callback(callback_query: types.CallbackQuery):
         user_id = int(parts[2])
         current_blocked = int(parts[3])
         new_blocked = 1 if current_blocked == 0 else 0
-        cursor.execute("UPDATE users SET blocked=? WHERE user_id=?", (new_blocked, user_id))
-        conn.commit()
+        with unit_of_work():
+            cursor.execute("UPDATE users SET blocked=? WHERE user_id=?", (new_blocked, user_id))
+            refresh_profile_flags(user_id)
+            cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, f'blocked_{new_blocked}'))
         action = "заблокирован 🔒" if new_blocked else "разблокирован 🔓"
-        cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, f'blocked_{new_blocked}'))
-        conn.commit()
         await callback_query.answer(f"Пользователь {action}.")
         await callback_query.message.edit_reply_markup(reply_markup=None)
     except Exception as e:
@@ -1579,13 +3395,7 @@ async def admin_delete_callback(callback_query: types.CallbackQuery):
         return
     try:
         user_id = int(callback_query.data.split('_')[2])
-        cursor.execute("DELETE FROM users WHERE user_id=?", (user_id,))
-        cursor.execute("DELETE FROM likes WHERE from_user=? OR to_user=?", (user_id, user_id))
-        cursor.execute("DELETE FROM dislikes WHERE from_user=? OR to_user=?", (user_id, user_id))
-        cursor.execute("DELETE FROM skips WHERE from_user=? OR to_user=?", (user_id, user_id))
-        cursor.execute("DELETE FROM logs WHERE user_id=?", (user_id,))
-        cursor.execute("DELETE FROM invitations WHERE inviter_id=? OR invited_id=?", (user_id, user_id))
-        conn.commit()
+        soft_delete_user(user_id)
         await callback_query.answer("Пользователь удален. 🗑️")
         await callback_query.message.edit_reply_markup(reply_markup=None)
     except Exception as e:
@@ -1639,7 +3449,10 @@ async def admin_message_text(message: types.Message, state: FSMContext):
             return
         async with state.proxy() as data:
             user_id = data['user_id']
-        await bot.send_message(user_id, f"Сообщение от админа: {text}")
+        if not await notify_user(user_id, f"Сообщение от админа: {text}"):
+            await message.reply(f"Пользователь ID {user_id} недоступен: заблокировал бота или удалил аккаунт. 🚫")
+            await state.finish()
+            return
         await message.reply(f"Сообщение отправлено пользователю ID {user_id}. 📩")
         cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'received_admin_message'))
         conn.commit()
@@ -1691,19 +3504,19 @@ async def admin_premium_duration(message: types.Message, state: FSMContext):
             return
         async with state.proxy() as data:
             user_id = data['premium_user']
-        cursor.execute("SELECT premium_expiry FROM users WHERE user_id=?", (user_id,))
-        current_expiry_result = cursor.fetchone()
-        current_expiry = current_expiry_result['premium_expiry'] if current_expiry_result and current_expiry_result['premium_expiry'] else None
-        if current_expiry:
-            new_expiry = datetime.fromisoformat(current_expiry) + timedelta(days=days)
-        else:
-            new_expiry = datetime.now() + timedelta(days=days)
-        cursor.execute("UPDATE users SET premium=1, premium_expiry=? WHERE user_id=?", (new_expiry.isoformat(), user_id))
-        conn.commit()
-        await bot.send_message(user_id, f"Администратор выдал тебе премиум на {days} дней! 😎")
+        with unit_of_work():
+            cursor.execute("SELECT premium_expiry FROM users WHERE user_id=?", (user_id,))
+            current_expiry_result = cursor.fetchone()
+            current_expiry = current_expiry_result['premium_expiry'] if current_expiry_result and current_expiry_result['premium_expiry'] else None
+            if current_expiry:
+                new_expiry = datetime.fromisoformat(current_expiry) + timedelta(days=days)
+            else:
+                new_expiry = datetime.now() + timedelta(days=days)
+            cursor.execute("UPDATE users SET premium=1, premium_expiry=? WHERE user_id=?", (new_expiry.isoformat(), user_id))
+            refresh_profile_index(user_id)
+            cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, f'admin_granted_premium_{days}_days'))
+        await notify_user(user_id, f"Администратор выдал тебе премиум на {days} дней! 😎")
         await message.reply(f"Премиум выдан пользователю ID {user_id} на {days} дней. 💎")
-        cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, f'admin_granted_premium_{days}_days'))
-        conn.commit()
         await state.finish()
     except ValueError:
         await message.reply("Введи число (дней).")
@@ -1736,12 +3549,12 @@ async def admin_cancel_premium(message: types.Message, state: FSMContext):
             await message.reply("У пользователя нет премиум.")
             await state.finish()
             return
-        cursor.execute("UPDATE users SET premium=0, premium_expiry=NULL WHERE user_id=?", (user_id,))
-        conn.commit()
-        await bot.send_message(user_id, "Администратор отменил твой премиум статус. 😔")
+        with unit_of_work():
+            cursor.execute("UPDATE users SET premium=0, premium_expiry=NULL WHERE user_id=?", (user_id,))
+            refresh_profile_index(user_id)
+            cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'admin_canceled_premium'))
+        await notify_user(user_id, "Администратор отменил твой премиум статус. 😔")
         await message.reply(f"Премиум отменен для пользователя ID {user_id}. ❌")
-        cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'admin_canceled_premium'))
-        conn.commit()
         await state.finish()
     except ValueError:
         await message.reply("Введи число (ID).")
@@ -1903,20 +3716,7 @@ async def admin_search_premium(message: types.Message, state: FSMContext):
             max_age = data['max_age']
             gender_query = data['gender']
             country_query = data['country']
-        query = """
-        SELECT user_id, name, age, gender, country, city, blocked, premium FROM users 
-        WHERE name LIKE ? AND age BETWEEN ? AND ? AND gender LIKE ?
-        """
-        params = [name, min_age, max_age, gender_query]
-        if country_query != '%':
-            query += " AND country LIKE ?"
-            params.append(f"%{country_query}%")
-        if premium_query is not None:
-            query += " AND premium = ?"
-            params.append(premium_query)
-        query += " ORDER BY user_id"
-        cursor.execute(query, params)
-        users = cursor.fetchall()
+        users = search_users(name, min_age, max_age, gender_query, country_query, premium_query)
         if not users:
             await message.reply("Нет результатов.")
         else:
@@ -1961,7 +3761,7 @@ async def admin_view_likes(message: types.Message, state: FSMContext):
         likers = [row[0] for row in cursor.fetchall()]
         cursor.execute("SELECT to_user FROM dislikes WHERE from_user=?", (user_id,))
         disliked = [row[0] for row in cursor.fetchall()]
-        cursor.execute("SELECT to_user FROM skips WHERE from_user=?", (user_id,))
+        cursor.execute(f"SELECT to_user FROM skips WHERE from_user=? AND {ACTIVE_SKIP_SQL}", (user_id,))
         skipped = [row[0] for row in cursor.fetchall()]
         mutual = set(liked) & set(likers)
         response = f"Лайки от {user_id}: {', '.join(map(str, liked)) or 'Нет'}\n"
@@ -2033,7 +3833,8 @@ async def admin_broadcast_media(message: types.Message, state: FSMContext):
             data['media_type'] = media_type
         keyboard = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
         keyboard.row(KeyboardButton('Все 🌍'), KeyboardButton('Активные ✅'))
-        keyboard.row(KeyboardButton('Заблокированные 🔒'), KeyboardButton('Отмена'))
+        keyboard.row(KeyboardButton(f'Заходили за {ACTIVE_USER_DAYS} дн. 🕒'), KeyboardButton('Заблокированные 🔒'))
+        keyboard.row(KeyboardButton('Отмена'))
         await message.reply("Выбери фильтр:", reply_markup=keyboard)
         await AdminForm.broadcast_filter.set()
     except Exception as e:
@@ -2046,12 +3847,14 @@ async def admin_broadcast_filter(message: types.Message, state: FSMContext):
         if message.text == 'Отмена':
             await admin_cancel_handler(message, state)
             return
-        filter_type = message.text.replace(' 🌍', '').replace(' ✅', '').replace(' 🔒', '')
-        where = ""
+        filter_type = message.text.replace(' 🌍', '').replace(' ✅', '').replace(' 🔒', '').replace(' 🕒', '')
+        where = "WHERE unreachable IS NULL AND deleted = 0"
         if filter_type == 'Активные':
-            where = "WHERE blocked=0"
+            where += " AND blocked=0"
+        elif filter_type == f'Заходили за {ACTIVE_USER_DAYS} дн.':
+            where += f" AND blocked=0 AND {RECENTLY_ACTIVE_SQL}"
         elif filter_type == 'Заблокированные':
-            where = "WHERE blocked=1"
+            where += " AND blocked=1"
         elif filter_type != 'Все':
             await message.reply("Неверный фильтр.")
             return
@@ -2062,6 +3865,7 @@ async def admin_broadcast_filter(message: types.Message, state: FSMContext):
             media = data.get('media')
             media_type = data.get('media_type')
         sent = 0
+        unreachable = 0
         caption_or_text = f"Сообщение от админа: {text}"
         for uid in users:
             try:
@@ -2075,9 +3879,12 @@ async def admin_broadcast_filter(message: types.Message, state: FSMContext):
                     await bot.send_message(uid, caption_or_text)
                 sent += 1
                 await asyncio.sleep(0.01)
+            except (BotBlocked, ChatNotFound, UserDeactivated):
+                unreachable += 1
             except Exception as send_e:
                 logging.warning(f"Failed to send to {uid}: {send_e}")
-        await message.reply(f"Рассылка отправлена {sent} пользователям.", reply_markup=types.ReplyKeyboardRemove())
+        unreachable_line = f"\nНедоступны (заблокировали бота): {unreachable}" if unreachable else ""
+        await message.reply(f"Рассылка отправлена {sent} пользователям.{unreachable_line}", reply_markup=types.ReplyKeyboardRemove())
         await state.finish()
     except Exception as e:
         logging.error(f"Error in broadcast: {e}")
@@ -2214,10 +4021,9 @@ async def appoint_admin(message: types.Message, state: FSMContext):
             await message.reply("Пользователь уже админ.")
             await state.finish()
             return
-        cursor.execute("INSERT INTO admins (user_id) VALUES (?)", (user_id,))
-        conn.commit()
-        cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'appointed_admin'))
-        conn.commit()
+        with unit_of_work():
+            cursor.execute("INSERT INTO admins (user_id) VALUES (?)", (user_id,))
+            cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'appointed_admin'))
         await message.reply(f"Пользователь ID {user_id} назначен админом. ✅")
         await state.finish()
     except ValueError:
@@ -2255,10 +4061,9 @@ async def remove_admin(message: types.Message, state: FSMContext):
             await message.reply("Пользователь не является админом.")
             await state.finish()
             return
-        cursor.execute("DELETE FROM admins WHERE user_id=?", (user_id,))
-        conn.commit()
-        cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'removed_admin'))
-        conn.commit()
+        with unit_of_work():
+            cursor.execute("DELETE FROM admins WHERE user_id=?", (user_id,))
+            cursor.execute("INSERT INTO logs (user_id, action) VALUES (?, ?)", (user_id, 'removed_admin'))
         await message.reply(f"Админка удалена у пользователя ID {user_id}. ❌")
         await state.finish()
     except ValueError:
@@ -2273,5 +4078,159 @@ async def errors_handler(update, exception):
     logging.error(f"Global error: {exception}")
     return True
 
+@web.middleware
+async def webhook_secret_middleware(request, handler):
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        logging.warning(f"Rejected webhook request from {request.remote}: bad secret token")
+        return web.Response(status=403)
+    return await handler(request)
+
+async def set_webhook():
+    await bot.set_webhook(WEBHOOK_HOST.rstrip('/') + WEBHOOK_PATH, allowed_updates=ALLOWED_UPDATES,
+                          drop_pending_updates=SKIP_UPDATES, secret_token=WEBHOOK_SECRET)
+
+async def start_background_jobs(metrics_port: int = METRICS_PORT, primary: bool = True):
+    if metrics_port:
+        await start_metrics_server(metrics_port)
+    periodic_tasks.append(asyncio.create_task(storage.run()))
+    periodic_tasks.append(asyncio.create_task(feed_loop(rebuild=primary)))
+    periodic_tasks.append(asyncio.create_task(last_seen_loop()))
+    if primary:
+        periodic_tasks.append(asyncio.create_task(skip_compaction_loop()))
+        periodic_tasks.append(asyncio.create_task(purge_loop()))
+        if not ADMIN_REALTIME_NOTIFY:
+            periodic_tasks.append(asyncio.create_task(admin_digest_loop()))
+    periodic_tasks.append(asyncio.create_task(profile_index_loop()))
+
+async def stop_background_jobs(primary: bool = True):
+    for task in periodic_tasks:
+        task.cancel()
+    for runner in metrics_runners:
+        await runner.cleanup()
+    if pending_tasks:
+        await asyncio.gather(*pending_tasks, return_exceptions=True)
+    if primary:
+        await send_admin_digest()
+    flush_feed_impressions()
+    activity_middleware.flush()
+    if update_recorder:
+        update_recorder.close()
+
+async def on_startup(dispatcher: Dispatcher):
+    if BOT_MODE == 'webhook':
+        await set_webhook()
+    await start_background_jobs()
+
+async def on_shutdown(dispatcher: Dispatcher):
+    await stop_background_jobs()
+
+def route_update(queues, update: types.Update):
+    user_id = get_update_user_id(update) or 0
+    queues[user_id % len(queues)].put(update.to_python())
+
+async def run_worker(queue, metrics_port: int, primary: bool):
+    Dispatcher.set_current(dp)
+    Bot.set_current(bot)
+    await start_background_jobs(metrics_port, primary)
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            raw_update = await loop.run_in_executor(None, queue.get)
+            if raw_update is None:
+                break
+            run_in_background(dp.process_updates([types.Update(**raw_update)]))
+    finally:
+        await stop_background_jobs(primary)
+        await storage.close()
+        await storage.wait_closed()
+        await (await bot.get_session()).close()
+
+def worker_main(index: int, queue):
+    # The parent stops workers through their queues, so they can flush before exiting
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logging.info(f"Worker {index} started (pid {os.getpid()})")
+    asyncio.run(run_worker(queue, METRICS_PORT + index + 1 if METRICS_PORT else 0, index == 0))
+
+async def poll_updates_to_workers(queues):
+    await bot.delete_webhook(drop_pending_updates=SKIP_UPDATES)
+    offset = None
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, limit=POLLING_LIMIT, timeout=POLLING_TIMEOUT,
+                                                allowed_updates=ALLOWED_UPDATES)
+            except Exception as e:
+                logging.error(f"Error while getting updates: {e}")
+                await asyncio.sleep(5)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                route_update(queues, update)
+            if POLLING_RELAX:
+                await asyncio.sleep(POLLING_RELAX)
+    finally:
+        await (await bot.get_session()).close()
+
+def create_webhook_router_app(queues) -> web.Application:
+    async def handle_update(request):
+        route_update(queues, types.Update(**await request.json()))
+        return web.Response()
+
+    async def on_app_startup(app):
+        await set_webhook()
+
+    async def on_app_shutdown(app):
+        await (await bot.get_session()).close()
+
+    web_app = web.Application(middlewares=[webhook_secret_middleware])
+    web_app.router.add_post(WEBHOOK_PATH, handle_update)
+    web_app.on_startup.append(on_app_startup)
+    web_app.on_shutdown.append(on_app_shutdown)
+    return web_app
+
+def stop_on_sigterm(signum, frame):
+    # Shut down as on Ctrl+C; a second SIGTERM must not interrupt joining the workers
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+def run_sharded():
+    """
+    Receives updates in this process and hands each one to one of BOT_WORKERS worker
+    processes chosen by user id, so every user is always handled by the same worker.
+    """
+    signal.signal(signal.SIGTERM, stop_on_sigterm)
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(BOT_WORKERS)]
+    workers = [context.Process(target=worker_main, args=(index, queue), daemon=True)
+               for index, queue in enumerate(queues)]
+    for worker in workers:
+        worker.start()
+    try:
+        if BOT_MODE == 'webhook':
+            web.run_app(create_webhook_router_app(queues), host=WEBAPP_HOST, port=WEBAPP_PORT)
+        else:
+            asyncio.run(poll_updates_to_workers(queues))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            worker.join(timeout=30)
+            if worker.is_alive():
+                logging.error(f"Worker {worker.pid} did not stop in time, killing it")
+                worker.kill()
+
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True)
\ No newline at end of file
+    if BOT_WORKERS > 1:
+        run_sharded()
+    elif BOT_MODE == 'webhook':
+        web_app = web.Application(middlewares=[webhook_secret_middleware])
+        webhook_executor = executor.set_webhook(dp, WEBHOOK_PATH, web_app=web_app,
+                                                on_startup=on_startup, on_shutdown=on_shutdown)
+        webhook_executor.run_app(host=WEBAPP_HOST, port=WEBAPP_PORT)
+    else:
+        polling = dp.start_polling(timeout=POLLING_TIMEOUT, relax=POLLING_RELAX, limit=POLLING_LIMIT,
+                                   allowed_updates=ALLOWED_UPDATES)
+        executor.start(dp, polling, skip_updates=SKIP_UPDATES, on_startup=on_startup, on_shutdown=on_shutdown)
\ No newline at end of file
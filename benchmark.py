@@ -0,0 +1,232 @@
+"""Latency benchmarks for the hot database paths of the bot.
+
+Usage:
+    python benchmark.py --sizes 10000,100000,1000000
+    python benchmark.py --sizes 10000 --json bench.json
+    python benchmark.py --sizes 10000 --baseline bench.json --max-regression 0.25
+
+Each size runs in its own process against bench_data/users_<size>.db, which
+is generated with generate_dataset.py on first use. The queries are the
+functions app.py itself calls, so a change to the SQL is measured directly.
+With --baseline the run fails when any p95 grows by more than
+--max-regression compared to a previous --json report. The query plans of
+the candidate tiers are printed too; every tier should read the users table
+through a covering index only, in ranking order, without sorting its segment
+in a temp B-tree. Only the bounded window may be sorted.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summarize(samples):
+    return {
+        'count': len(samples),
+        'mean': statistics.fmean(samples),
+        'p50': percentile(samples, 0.50),
+        'p95': percentile(samples, 0.95),
+        'p99': percentile(samples, 0.99),
+    }
+
+
+def run_cases(db_path, iterations, seed):
+    os.environ['DB_PATH'] = db_path
+    os.environ['FSM_DB_PATH'] = db_path
+    os.environ.setdefault('API_TOKEN', '0:benchmark')
+    os.environ.setdefault('SUPER_ADMIN_ID', '1')
+    os.environ['METRICS_PORT'] = '0'
+    os.environ.setdefault('SLOW_QUERY_MS', '60000')
+    sys.path.insert(0, ROOT)
+    import app
+
+    started = time.perf_counter()
+    app.profile_index = app.build_profile_index(app.conn)
+    usage = app.profile_index.memory_usage()
+    print(f"profile index: {len(app.profile_index.positions)} rows in {time.perf_counter() - started:.1f}s, "
+          f"{sum(usage.values()) / 1024 / 1024:.1f} MB ({', '.join(f'{k} {v / 1024:.0f} KB' for k, v in usage.items())}), "
+          f"{'numpy' if app.numpy is not None else 'array'}", file=sys.stderr)
+    rng = random.Random(seed)
+    profiles = app.conn.execute('''
+    SELECT user_id, seeking_gender, city, age, pref_age_min, pref_age_max, country, gender FROM users WHERE is_searchable = 1
+    ''').fetchall()
+    countries = list(app.cities_by_country)
+    print_query_plans(app, profiles[0])
+
+    def candidate():
+        user_id, seeking_gender, city, age, min_age, max_age, country, gender = rng.choice(profiles)
+        app.find_candidate(user_id, seeking_gender, city, False, age, min_age, max_age, country, gender)
+
+    def candidate_admin():
+        user_id, seeking_gender, city, age, min_age, max_age, country, gender = rng.choice(profiles)
+        app.find_candidate(user_id, seeking_gender, city, True, age)
+
+    def indexed_candidate():
+        user_id, seeking_gender, city, age, min_age, max_age, country, gender = rng.choice(profiles)
+        app.find_indexed_candidate(user_id, seeking_gender, city, False, min_age, max_age, country, gender)
+
+    def tier_candidate_sql(tier):
+        def run():
+            user_id, seeking_gender, city, age, min_age, max_age, country, gender = rng.choice(profiles)
+            location = dict(app.search_tiers(city, country)).get(tier)
+            app.conn.execute(*app.tier_candidate_query(tier, location, user_id, gender, seeking_gender,
+                                                       min_age, max_age)).fetchone()
+        return run
+
+    def without_index(func):
+        def run():
+            app.profile_index.ready = False
+            try:
+                func()
+            finally:
+                app.profile_index.ready = True
+        return run
+
+    def incoming_liker():
+        app.find_incoming_liker(rng.choice(profiles)[0])
+
+    def like_limit():
+        app.count_recent_likes(rng.choice(profiles)[0])
+
+    def admin_search():
+        min_age = rng.randint(18, 40)
+        app.search_users(
+            rng.choice(['%', '%', 'А%', '%на%']),
+            min_age,
+            min_age + rng.randint(1, 10),
+            rng.choice(['%', 'мужской', 'женский']),
+            rng.choice(['%'] + countries),
+            rng.choice([None, 0, 1]),
+        )
+
+    cases = [
+        ('find_candidate', candidate, iterations),
+        ('find_indexed_candidate', indexed_candidate, iterations),
+        ('city_tier_sql', tier_candidate_sql('city'), iterations),
+        ('country_tier_sql', tier_candidate_sql('country'), iterations),
+        ('neighbours_tier_sql', tier_candidate_sql('neighbours'), iterations),
+        ('any_tier_sql', tier_candidate_sql('any'), iterations),
+        ('find_candidate_admin', candidate_admin, iterations),
+        ('find_candidate_admin_sql', without_index(candidate_admin), iterations),
+        ('find_incoming_liker', incoming_liker, iterations),
+        ('count_recent_likes', like_limit, iterations),
+        ('search_users', admin_search, max(iterations // 10, 5)),
+        ('search_users_sql', without_index(admin_search), max(iterations // 10, 5)),
+        ('collect_stats', app.collect_stats, max(iterations // 50, 3)),
+    ]
+    results = {}
+    for name, func, count in cases:
+        func()
+        samples = []
+        for _ in range(count):
+            started = time.perf_counter()
+            func()
+            samples.append((time.perf_counter() - started) * 1000)
+        results[name] = summarize(samples)
+    return results
+
+
+def print_query_plans(app, profile):
+    user_id, seeking_gender, city, age, min_age, max_age, country, gender = profile
+    for tier, location in app.search_tiers(city, country):
+        sql, params = app.tier_candidate_query(tier, location, user_id, gender, seeking_gender, 18, 30)
+        plan = app.conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+        details = [row[3] for row in plan]
+        # The outer lookup by primary key is fine, every other access to users should stay in the index
+        table_scans = [d for d in details if ' users' in d and 'COVERING INDEX' not in d and 'INTEGER PRIMARY KEY' not in d]
+        # A sort next to the users scan means the LIMIT is applied after ranking the whole segment;
+        # the sort of the bounded window sits one level up and is expected
+        scan_parents = {parent for _, parent, _, detail in plan if ' users' in detail and 'INTEGER PRIMARY KEY' not in detail}
+        segment_sorts = [detail for _, parent, _, detail in plan if 'USE TEMP B-TREE' in detail and parent in scan_parents]
+        problems = ['reads the table: ' + '; '.join(table_scans)] if table_scans else []
+        if segment_sorts:
+            problems.append('sorts the segment: ' + '; '.join(segment_sorts))
+        print(f"{tier} tier plan:\n  " + "\n  ".join(details), file=sys.stderr)
+        print(f"{tier} tier plan: {', '.join(problems) if problems else 'index-only, ranking order'}", file=sys.stderr)
+
+
+def ensure_dataset(db_path, size, seed):
+    if os.path.exists(db_path):
+        return
+    print(f"generating {db_path}...", flush=True)
+    subprocess.run(
+        [sys.executable, os.path.join(ROOT, 'generate_dataset.py'), '--users', str(size), '--db', db_path, '--seed', str(seed)],
+        check=True,
+    )
+
+
+def run_size(args, size):
+    db_path = os.path.join(args.data_dir, f"users_{size}.db")
+    ensure_dataset(db_path, size, args.seed)
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--worker', db_path,
+         '--iterations', str(args.iterations), '--seed', str(args.seed)],
+        check=True, stdout=subprocess.PIPE, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def print_report(report):
+    for size, results in report.items():
+        print(f"\n{size} users (ms)")
+        print(f"{'query':<24}{'count':>7}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+        for name, row in results.items():
+            print(f"{name:<24}{row['count']:>7}{row['mean']:>10.2f}{row['p50']:>10.2f}{row['p95']:>10.2f}{row['p99']:>10.2f}")
+
+
+def find_regressions(report, baseline, max_regression):
+    regressions = []
+    for size, results in report.items():
+        for name, row in results.items():
+            previous = baseline.get(size, {}).get(name)
+            if previous and row['p95'] > previous['p95'] * (1 + max_regression):
+                regressions.append(f"{size}/{name}: p95 {previous['p95']:.2f} -> {row['p95']:.2f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot's hot queries")
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--data-dir', default=os.path.join(ROOT, 'bench_data'))
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help="write the report to this file")
+    parser.add_argument('--baseline', help="compare against a previous --json report")
+    parser.add_argument('--max-regression', type=float, default=0.25)
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_cases(args.worker, args.iterations, args.seed)))
+        return
+
+    report = {}
+    for size in (int(value) for value in args.sizes.split(',')):
+        report[str(size)] = run_size(args, size)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(report, json.load(f), args.max_regression)
+        if regressions:
+            print("\nRegressions:\n" + "\n".join(regressions))
+            sys.exit(1)
+        print("\nNo regressions")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""Build a synthetic dating_database.db for benchmarks and load tests.
+
+Usage:
+    python generate_dataset.py --users 100000 --db bench_data/users_100000.db
+
+The schema is created by importing app.py, so the generated file always
+matches the bot's current tables, indexes and derived columns.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+parser = argparse.ArgumentParser(description="Generate a synthetic dating database")
+parser.add_argument('--users', type=int, default=10000)
+parser.add_argument('--db', default='dating_database.db')
+parser.add_argument('--likes', type=float, default=20, help="average likes given per user")
+parser.add_argument('--dislikes', type=float, default=10, help="average dislikes given per user")
+parser.add_argument('--skips', type=float, default=10, help="average skips given per user")
+parser.add_argument('--logs', type=float, default=5, help="average log rows per user")
+parser.add_argument('--mutual', type=float, default=0.15, help="share of likes answered with a like")
+parser.add_argument('--seed', type=int, default=42)
+parser.add_argument('--force', action='store_true', help="overwrite an existing database")
+args = parser.parse_args()
+
+if os.path.exists(args.db):
+    if not args.force:
+        sys.exit(f"{args.db} already exists, use --force to overwrite")
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(args.db + suffix):
+            os.remove(args.db + suffix)
+if os.path.dirname(args.db):
+    os.makedirs(os.path.dirname(args.db), exist_ok=True)
+
+os.environ['DB_PATH'] = args.db
+os.environ.setdefault('FSM_DB_PATH', args.db)
+os.environ.setdefault('API_TOKEN', '0:benchmark')
+os.environ.setdefault('SUPER_ADMIN_ID', '1')
+os.environ['METRICS_PORT'] = '0'
+os.environ.setdefault('SLOW_QUERY_MS', '60000')
+
+import app
+
+BATCH = 50000
+NAMES = {
+    'мужской': ['Алексей', 'Дмитрий', 'Иван', 'Тимур', 'Фаррух', 'Азамат', 'Рустам', 'Бахтиёр', 'Сергей', 'Нурлан'],
+    'женский': ['Анна', 'Мария', 'Дарья', 'Мадина', 'Зарина', 'Айгерим', 'Екатерина', 'Нигора', 'Алина', 'Гульнара'],
+}
+COUNTRY_WEIGHTS = {'Россия': 45, 'Узбекистан': 20, 'Казахстан': 15, 'Кыргызстан': 10, 'Таджикистан': 10}
+# Actions as app.py logs them, weighted in percent of all rows; swipes make up the other 80%.
+# {target} is another user's id
+LOG_ACTIONS = {
+    'started_profile_creation': 3,
+    'profile_created': 2,
+    'profile_edited': 3,
+    'edited_name': 0.5,
+    'edited_photos': 1,
+    'edited_age': 0.3,
+    'edited_gender': 0.1,
+    'edited_description': 1,
+    'edited_seeking_gender': 0.1,
+    'edited_country': 0.2,
+    'edited_city': 0.5,
+    'edited_pref_age': 1,
+    'reported_{target}_{reason}': 0.5,
+    'blocked_1': 0.05,
+    'received_admin_message': 0.3,
+    'admin_granted_premium_30_days': 0.05,
+}
+REPORT_REASONS = ['Спам', 'Фейковая анкета', 'Оскорбления', 'Чужие фото', 'Реклама']
+
+
+def city_weights():
+    # Zipf-like skew: the first cities of each country hold most of the users
+    cities, weights = [], []
+    for country, cities_list in app.cities_by_country.items():
+        share = COUNTRY_WEIGHTS.get(country, 5)
+        ranks = [1 / (rank + 1) for rank in range(len(cities_list))]
+        total = sum(ranks)
+        for city, weight in zip(cities_list, ranks):
+            cities.append((country, city))
+            weights.append(share * weight / total)
+    return cities, weights
+
+
+def random_timestamp(rng, now, days=30):
+    return (now - timedelta(seconds=rng.randint(0, days * 86400))).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def insert_batched(sql, rows):
+    batch = []
+    count = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH:
+            app.conn.executemany(sql, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        app.conn.executemany(sql, batch)
+        count += len(batch)
+    return count
+
+
+def generate_users(rng, now):
+    cities, weights = city_weights()
+    for user_id in range(1, args.users + 1):
+        gender = 'мужской' if rng.random() < 0.5 else 'женский'
+        seeking = ('женский' if gender == 'мужской' else 'мужской') if rng.random() < 0.95 else gender
+        country, city = rng.choices(cities, weights)[0]
+        photos = [] if rng.random() < 0.1 else [f"photo_{user_id}_{i}" for i in range(rng.randint(1, 3))]
+        premium = 1 if rng.random() < 0.05 else 0
+        age = rng.randint(18, 45)
+        pref_age = (max(18, age - rng.randint(2, 8)), age + rng.randint(2, 8)) if rng.random() < 0.4 else (None, None)
+        yield (
+            user_id,
+            f"user{user_id}",
+            rng.choice(NAMES[gender]),
+            json.dumps(photos),
+            age,
+            gender,
+            "Описание анкеты" if rng.random() < 0.7 else None,
+            seeking,
+            country,
+            city,
+            1 if rng.random() < 0.02 else 0,
+            premium,
+            (now + timedelta(days=rng.randint(1, 30))).strftime('%Y-%m-%d %H:%M:%S') if premium else None,
+            0,
+            random_timestamp(rng, now, 7) if premium and rng.random() < 0.5 else None,
+            *pref_age,
+            random_timestamp(rng, now, 60) if rng.random() < 0.9 else None,
+        )
+
+
+def load_profiles():
+    by_city = {}
+    by_gender = {}
+    for user_id, gender, city in app.conn.execute("SELECT user_id, gender, city FROM users"):
+        by_city.setdefault((city, gender), []).append(user_id)
+        by_gender.setdefault(gender, []).append(user_id)
+    seeking = dict(app.conn.execute("SELECT user_id, seeking_gender FROM users"))
+    cities = dict(app.conn.execute("SELECT user_id, city FROM users"))
+    return by_city, by_gender, seeking, cities
+
+
+def pick_targets(rng, user_id, average, by_city, by_gender, seeking, cities):
+    count = min(int(rng.expovariate(1 / average)) if average > 0 else 0, 500)
+    local = by_city.get((cities[user_id], seeking[user_id]), [])
+    anywhere = by_gender.get(seeking[user_id], [])
+    targets = set()
+    for _ in range(count):
+        # Most swipes stay in the user's own city, the rest come from the global fallback
+        pool = local if local and rng.random() < 0.8 else anywhere
+        if pool:
+            target = rng.choice(pool)
+            if target != user_id:
+                targets.add(target)
+    return targets
+
+
+def generate_reactions(rng, now, by_city, by_gender, seeking, cities):
+    likes, dislikes, skips = [], [], []
+    for user_id in range(1, args.users + 1):
+        liked = pick_targets(rng, user_id, args.likes, by_city, by_gender, seeking, cities)
+        for target in liked:
+            likes.append((user_id, target, random_timestamp(rng, now)))
+            if rng.random() < args.mutual:
+                likes.append((target, user_id, random_timestamp(rng, now)))
+        disliked = pick_targets(rng, user_id, args.dislikes, by_city, by_gender, seeking, cities) - liked
+        dislikes.extend((user_id, target) for target in disliked)
+        skipped = pick_targets(rng, user_id, args.skips, by_city, by_gender, seeking, cities) - liked - disliked
+        skips.extend((user_id, target, random_timestamp(rng, now, 60)) for target in skipped)
+        if len(likes) >= BATCH:
+            yield likes, dislikes, skips
+            likes, dislikes, skips = [], [], []
+    yield likes, dislikes, skips
+
+
+def generate_logs(rng, now):
+    # Swipes in the same mix as the generated likes, dislikes and skips
+    swipes = {'liked_{target}': args.likes, 'disliked_{target}': args.dislikes, 'skipped_{target}': args.skips}
+    swipe_total = sum(swipes.values()) or 1
+    weighted = {**{action: 80 * weight / swipe_total for action, weight in swipes.items()}, **LOG_ACTIONS}
+    actions = list(weighted)
+    weights = list(weighted.values())
+    for user_id in range(1, args.users + 1):
+        for _ in range(int(rng.expovariate(1 / args.logs)) if args.logs > 0 else 0):
+            action = rng.choices(actions, weights)[0].format(target=rng.randint(1, args.users),
+                                                            reason=rng.choice(REPORT_REASONS))
+            yield user_id, action, random_timestamp(rng, now)
+
+
+def main():
+    rng = random.Random(args.seed)
+    now = datetime.now()
+    started = time.perf_counter()
+    app.conn.execute("PRAGMA synchronous=OFF")
+
+    users = insert_batched('''
+    INSERT INTO users (user_id, username, name, photos, age, gender, description, seeking_gender,
+                       country, city, blocked, premium, premium_expiry, invited_count, last_boost,
+                       pref_age_min, pref_age_max, last_seen)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', generate_users(rng, now))
+    app.refresh_profile_flags()
+    app.conn.commit()
+    print(f"users: {users} ({time.perf_counter() - started:.1f}s)")
+
+    by_city, by_gender, seeking, cities = load_profiles()
+    totals = [0, 0, 0]
+    for likes, dislikes, skips in generate_reactions(rng, now, by_city, by_gender, seeking, cities):
+        app.conn.executemany("INSERT OR IGNORE INTO likes (from_user, to_user, timestamp) VALUES (?, ?, ?)", likes)
+        app.conn.executemany("INSERT OR IGNORE INTO dislikes (from_user, to_user) VALUES (?, ?)", dislikes)
+        app.conn.executemany("INSERT OR IGNORE INTO skips (from_user, to_user, created_at) VALUES (?, ?, ?)", skips)
+        totals[0] += len(likes)
+        totals[1] += len(dislikes)
+        totals[2] += len(skips)
+    app.conn.commit()
+    print(f"likes: {totals[0]}, dislikes: {totals[1]}, skips: {totals[2]} ({time.perf_counter() - started:.1f}s)")
+
+    logs = insert_batched("INSERT INTO logs (user_id, action, timestamp) VALUES (?, ?, ?)", generate_logs(rng, now))
+    app.conn.commit()
+    print(f"logs: {logs} ({time.perf_counter() - started:.1f}s)")
+
+    print(f"feed: {app.rebuild_feed()} profiles ({time.perf_counter() - started:.1f}s)")
+    app.conn.execute("ANALYZE")
+    app.conn.execute("PRAGMA synchronous=NORMAL")
+    app.conn.commit()
+    print(f"done: {args.db} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,367 @@
+"""End-to-end load test against a local stand-in for the Telegram Bot API.
+
+Usage:
+    python loadtest.py --users 1000 --concurrency 200 --swipes 10
+    python loadtest.py --users 500 --latency 50 --jitter 20 --rate-limit 0.01
+    python loadtest.py --dataset bench_data/users_100000.db --users 2000
+
+The real dispatcher from app.py long-polls a local aiohttp server that
+emulates getUpdates, sendMessage, sendMediaGroup, answerCallbackQuery and
+getMe. It can add latency and 429 responses to every call. Simulated users
+register, swipe, like and open their inbox, while the super admin loops
+through the admin menu. A run reports updates/sec, per-flow latency and API
+calls per update.
+
+Every run uses a fresh database in a temporary directory. --dataset copies
+a database made by generate_dataset.py there first. Throttling and
+concurrency limits come from the usual environment variables, so
+THROTTLE_*, MAX_CONCURRENT_UPDATES and friends can be compared offline.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict, deque
+
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BOT_ID = 100000000
+ADMIN_ID = 1
+SILENT_METHODS = {'getUpdates', 'getMe', 'deleteWebhook', 'setWebhook'}
+
+
+class FakeBotAPI:
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit=0.0, retry_after=1, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.updates = deque()
+        self.has_updates = asyncio.Event()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.callback_users = {}
+        self.calls = Counter()
+        self.calls_by_chat = Counter()
+        self.rate_limited = 0
+        self.markups = {}
+        self.runner = None
+
+    def push(self, update: dict) -> int:
+        update['update_id'] = next(self.update_ids)
+        if 'callback_query' in update:
+            self.callback_users[update['callback_query']['id']] = update['callback_query']['from']['id']
+        self.updates.append(update)
+        self.has_updates.set()
+        return update['update_id']
+
+    def message(self, chat_id, **extra):
+        return {'message_id': next(self.message_ids), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': BOT_ID, 'is_bot': True, 'first_name': 'Bot'}, **extra}
+
+    async def get_updates(self, data):
+        timeout = float(data.get('timeout') or 0)
+        limit = int(data.get('limit') or 100)
+        if not self.updates and timeout:
+            try:
+                await asyncio.wait_for(self.has_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        batch = [self.updates.popleft() for _ in range(min(limit, len(self.updates)))]
+        if not self.updates:
+            self.has_updates.clear()
+        return batch
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        data = dict(request.query)
+        data.update(await request.post())
+        self.calls[method] += 1
+        if method == 'getUpdates':
+            return web.json_response({'ok': True, 'result': await self.get_updates(data)})
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.rng.gauss(self.latency, self.jitter)) / 1000)
+        if method in SILENT_METHODS:
+            if method == 'getMe':
+                return web.json_response({'ok': True, 'result': {'id': BOT_ID, 'is_bot': True,
+                                                                 'first_name': 'Bot', 'username': 'loadtest_bot'}})
+            return web.json_response({'ok': True, 'result': True})
+
+        chat_id = int(data['chat_id']) if data.get('chat_id') else self.callback_users.pop(data.get('callback_query_id'), 0)
+        self.calls_by_chat[chat_id] += 1
+        if self.rate_limit and self.rng.random() < self.rate_limit:
+            self.rate_limited += 1
+            return web.json_response({'ok': False, 'error_code': 429,
+                                      'description': f"Too Many Requests: retry after {self.retry_after}",
+                                      'parameters': {'retry_after': self.retry_after}}, status=429)
+        if data.get('reply_markup'):
+            markup = json.loads(data['reply_markup'])
+            buttons = [button['callback_data'] for row in markup.get('inline_keyboard', []) for button in row
+                       if 'callback_data' in button]
+            if buttons:
+                self.markups[chat_id] = buttons
+        if method == 'sendMediaGroup':
+            media = json.loads(data.get('media') or '[]')
+            return web.json_response({'ok': True, 'result': [self.message(chat_id, photo=[
+                {'file_id': item['media'], 'file_unique_id': item['media'], 'width': 1, 'height': 1}])
+                for item in media]})
+        if method.startswith('send') or method == 'copyMessage':
+            return web.json_response({'ok': True, 'result': self.message(chat_id, text=data.get('text', ''))})
+        return web.json_response({'ok': True, 'result': True})
+
+    async def start(self, host='127.0.0.1', port=0) -> str:
+        application = web.Application()
+        application.router.add_route('*', '/bot{token}/{method}', self.handle)
+        self.runner = web.AppRunner(application, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+
+class CompletionTracker:
+    """Resolves a future once the dispatcher has fully processed an update."""
+
+    def __init__(self):
+        self.waiters = {}
+
+    def install(self, dispatcher):
+        notify = dispatcher.updates_handler.notify
+
+        async def tracked(update, *args):
+            try:
+                return await notify(update, *args)
+            finally:
+                waiter = self.waiters.pop(update.update_id, None)
+                if waiter and not waiter.done():
+                    waiter.set_result(time.perf_counter())
+
+        dispatcher.updates_handler.notify = tracked
+
+    def expect(self, update_id: int) -> asyncio.Future:
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[update_id] = waiter
+        return waiter
+
+
+def load_app(db_path: str, api_url: str):
+    os.environ['DB_PATH'] = db_path
+    os.environ['FSM_DB_PATH'] = db_path
+    os.environ['BOT_API_SERVER'] = api_url
+    os.environ['BOT_MODE'] = 'polling'
+    os.environ['BOT_WORKERS'] = '1'
+    os.environ['METRICS_PORT'] = '0'
+    os.environ['RECORD_UPDATES_DIR'] = ''
+    os.environ.setdefault('API_TOKEN', '123456:loadtest')
+    os.environ.setdefault('SUPER_ADMIN_ID', str(ADMIN_ID))
+    os.environ.setdefault('POLLING_TIMEOUT', '1')
+    sys.path.insert(0, ROOT)
+    import app
+    return app
+
+
+def copy_database(source: str, target: str):
+    with sqlite3.connect(source) as src, sqlite3.connect(target) as dst:
+        src.backup(dst)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class LoadTest:
+    def __init__(self, args, app, api, tracker):
+        self.args = args
+        self.app = app
+        self.api = api
+        self.tracker = tracker
+        self.rng = random.Random(args.seed)
+        self.latencies = defaultdict(list)
+        self.api_calls = Counter()
+        self.timeouts = Counter()
+        self.message_ids = itertools.count(1)
+        self.admin_id = app.SUPER_ADMIN_ID
+        self.finished = False
+
+    def user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f"Load{user_id}", 'username': f"load{user_id}"}
+
+    def message(self, user_id, text=None, photo=None):
+        message = {'message_id': next(self.message_ids), 'date': int(time.time()),
+                   'chat': {'id': user_id, 'type': 'private'}, 'from': self.user(user_id)}
+        if text is not None:
+            message['text'] = text
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        if photo:
+            message['photo'] = [{'file_id': photo, 'file_unique_id': photo, 'width': 1, 'height': 1}]
+        return {'message': message}
+
+    def callback(self, user_id, data):
+        return {'callback_query': {
+            'id': str(next(self.message_ids)), 'chat_instance': str(user_id), 'data': data,
+            'from': self.user(user_id),
+            'message': {'message_id': next(self.message_ids), 'date': int(time.time()),
+                        'chat': {'id': user_id, 'type': 'private'},
+                        'from': {'id': BOT_ID, 'is_bot': True, 'first_name': 'Bot'}, 'text': 'Действия:'}}}
+
+    async def send(self, flow, user_id, update):
+        calls_before = self.api.calls_by_chat[user_id]
+        started = time.perf_counter()
+        waiter = self.tracker.expect(self.api.push(update))
+        try:
+            finished = await asyncio.wait_for(waiter, self.args.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts[flow] += 1
+            return
+        self.latencies[flow].append((finished - started) * 1000)
+        self.api_calls[flow] += self.api.calls_by_chat[user_id] - calls_before
+        if self.args.think:
+            await asyncio.sleep(self.rng.uniform(0, 2 * self.args.think) / 1000)
+
+    async def register(self, user_id):
+        countries = list(self.app.cities_by_country)
+        country = self.rng.choice(countries)
+        city = self.rng.choice(self.app.cities_by_country[country][:5])
+        gender = self.rng.choice(['Мужской 🚹', 'Женский 🚺'])
+        seeking = 'Женский 🚺' if gender == 'Мужской 🚹' else 'Мужской 🚹'
+        steps = [self.message(user_id, '/start'), self.message(user_id, f"Load{user_id}")]
+        steps += [self.message(user_id, photo=f"load_{user_id}_{i}") for i in range(self.rng.randint(1, 3))]
+        steps += [self.message(user_id, 'Готово 📸'), self.message(user_id, str(self.rng.randint(18, 45))),
+                  self.message(user_id, gender), self.message(user_id, 'Пропустить 📝'),
+                  self.message(user_id, seeking), self.message(user_id, f"{country} 🌍"),
+                  self.message(user_id, f"{city} 🏙️")]
+        for update in steps:
+            await self.send('registration', user_id, update)
+
+    async def swipe(self, user_id):
+        await self.send('search', user_id, self.message(user_id, 'Искать анкеты 🔍'))
+        buttons = self.api.markups.pop(user_id, [])
+        if not buttons:
+            return
+        roll = self.rng.random()
+        prefix = 'like_' if roll < self.args.like_ratio else ('dislike_' if roll < 0.8 else 'skip_')
+        choice = next((data for data in buttons if data.startswith(prefix)), None)
+        if choice:
+            await self.send('like' if prefix == 'like_' else 'swipe', user_id, self.callback(user_id, choice))
+
+    async def simulate_user(self, user_id, slots):
+        async with slots:
+            await self.register(user_id)
+            for _ in range(self.args.swipes):
+                await self.swipe(user_id)
+            if self.rng.random() < 0.3:
+                await self.send('inbox', user_id, self.message(user_id, 'Кто меня лайкнул ❤️'))
+                await self.send('inbox', user_id, self.message(user_id, 'Отмена'))
+
+    async def simulate_admin(self):
+        screens = ['Статистика 📊', 'Производительность ⚡', 'Список пользователей 📋', 'Пользователи с премиум 💎📋']
+        search = ['Поиск пользователей 🔎', 'Load', '18', '40', 'Любой ❓', 'Любой ❓', 'Любой ❓']
+        while not self.finished:
+            await self.send('admin', self.admin_id, self.message(self.admin_id, '/admin'))
+            for text in screens + search:
+                if self.finished:
+                    break
+                await self.send('admin', self.admin_id, self.message(self.admin_id, text))
+            await asyncio.sleep(self.args.admin_interval / 1000)
+
+    async def run(self):
+        first_id = max(self.admin_id, self.app.conn.execute("SELECT COALESCE(MAX(user_id), 0) FROM users").fetchone()[0]) + 1
+        slots = asyncio.Semaphore(self.args.concurrency)
+        admin = asyncio.create_task(self.simulate_admin()) if self.args.admin else None
+        started = time.perf_counter()
+        await asyncio.gather(*(self.simulate_user(first_id + i, slots) for i in range(self.args.users)))
+        self.finished = True
+        if admin:
+            await admin
+        return time.perf_counter() - started
+
+    def report(self, elapsed):
+        updates = sum(len(samples) for samples in self.latencies.values())
+        calls = sum(count for method, count in self.api.calls.items() if method not in SILENT_METHODS)
+        print(f"\nUpdates: {updates} in {elapsed:.1f}s, {updates / elapsed:.1f} updates/s")
+        print(f"API calls: {calls}, {calls / max(updates, 1):.2f} per update, 429 responses: {self.api.rate_limited}")
+        print("By method: " + ", ".join(f"{method} {count}" for method, count in self.api.calls.most_common()))
+        print(f"\n{'flow':<14}{'updates':>9}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}{'api/upd':>9}{'timeouts':>10}")
+        for flow, samples in sorted(self.latencies.items()):
+            print(f"{flow:<14}{len(samples):>9}{statistics.fmean(samples):>9.1f}{percentile(samples, 0.5):>9.1f}"
+                  f"{percentile(samples, 0.95):>9.1f}{percentile(samples, 0.99):>9.1f}{max(samples):>9.1f}"
+                  f"{self.api_calls[flow] / len(samples):>9.2f}{self.timeouts[flow]:>10}")
+
+
+async def main_async(args, db_path):
+    api = FakeBotAPI(args.latency, args.jitter, args.rate_limit, args.retry_after, args.seed)
+    api_url = await api.start()
+    app = load_app(db_path, api_url)
+    logging.getLogger().setLevel(args.log_level)
+    tracker = CompletionTracker()
+    tracker.install(app.dp)
+    app.Dispatcher.set_current(app.dp)
+    app.Bot.set_current(app.bot)
+
+    await app.start_background_jobs(0)
+    polling = asyncio.create_task(app.dp.start_polling(timeout=app.POLLING_TIMEOUT, limit=app.POLLING_LIMIT,
+                                                       relax=app.POLLING_RELAX, allowed_updates=app.ALLOWED_UPDATES))
+    test = LoadTest(args, app, api, tracker)
+    try:
+        elapsed = await test.run()
+    finally:
+        app.dp.stop_polling()
+        await polling
+        await app.stop_background_jobs()
+        await app.storage.close()
+        await app.storage.wait_closed()
+        await (await app.bot.get_session()).close()
+        await api.stop()
+    test.report(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the bot against a fake Bot API")
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=100, help="simulated users active at once")
+    parser.add_argument('--swipes', type=int, default=10, help="searches per user after registration")
+    parser.add_argument('--like-ratio', type=float, default=0.5)
+    parser.add_argument('--think', type=float, default=0, help="average pause between user actions, ms")
+    parser.add_argument('--admin', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--admin-interval', type=float, default=500, help="pause between admin loops, ms")
+    parser.add_argument('--latency', type=float, default=0, help="Bot API latency, ms")
+    parser.add_argument('--jitter', type=float, default=0, help="Bot API latency deviation, ms")
+    parser.add_argument('--rate-limit', type=float, default=0, help="share of calls answered with 429")
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=30, help="seconds to wait for one update")
+    parser.add_argument('--dataset', help="database from generate_dataset.py to start from")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='loadtest_')
+    db_path = os.path.join(workdir, 'loadtest.db')
+    if args.dataset:
+        copy_database(args.dataset, db_path)
+    try:
+        asyncio.run(main_async(args, db_path))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""Replay recorded updates through the dispatcher against a copy of the database.
+
+Usage:
+    python replay.py recordings/ --db dating_database.db
+    python replay.py recordings/updates-20250101-120000-4242.jsonl --db dating_database.db --speed 10
+    python replay.py recordings/ --db dating_database.db --speed 0 --latency 40
+
+The bot writes recordings when RECORD_UPDATES_DIR is set. The database is
+copied to a temporary directory and its user ids are rewritten with
+app.anonymize_user_id, so recorded users find their own profiles, likes and
+FSM states. This only works with the RECORD_UPDATES_SALT the recording was
+made with. With a different salt, or with --no-remap, recorded users show up
+as new users. --speed 1 keeps the original timing, 10 plays ten times
+faster and 0 sends updates as fast as the dispatcher takes them. Bot API
+calls go to the fake server from loadtest.py.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import os
+import re
+import shutil
+import statistics
+import tempfile
+import time
+from collections import defaultdict
+
+from loadtest import FakeBotAPI, CompletionTracker, copy_database, load_app, percentile
+
+REMAP_COLUMNS = {
+    'users': ('user_id',),
+    'likes': ('from_user', 'to_user'),
+    'dislikes': ('from_user', 'to_user'),
+    'skips': ('from_user', 'to_user'),
+    'logs': ('user_id',),
+    'admins': ('user_id',),
+    'invitations': ('inviter_id', 'invited_id'),
+    'purge_queue': ('user_id',),
+    'feed_pages': ('user_id',),
+}
+
+
+def recording_files(paths):
+    files = []
+    for path in paths:
+        files.extend(sorted(glob.glob(os.path.join(path, '*.jsonl'))) if os.path.isdir(path) else [path])
+    return files
+
+
+def read_meta(files):
+    with open(files[0], encoding='utf-8') as f:
+        return json.loads(f.readline()).get('meta', {})
+
+
+def read_records(files):
+    for path in files:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                if 'update' in record:
+                    yield record
+
+
+def remap_user_ids(app):
+    tables = {row[0] for row in app.conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    app.conn.create_function('anonymize_user_id', 1, app.anonymize_user_id)
+    for table, columns in REMAP_COLUMNS.items():
+        if table in tables:
+            app.conn.execute(f"UPDATE {table} SET " + ', '.join(f"{c} = anonymize_user_id({c})" for c in columns))
+    states = app.storage.conn.execute("SELECT chat, user, state, data FROM fsm_states").fetchall()
+    remapped = []
+    for chat, user, state, data in states:
+        data = json.loads(data or '{}')
+        if 'target_user_id' in data:
+            data['target_user_id'] = app.anonymize_user_id(data['target_user_id'])
+        remapped.append((str(app.anonymize_user_id(int(chat))) if int(chat) > 0 else chat,
+                         str(app.anonymize_user_id(int(user))), json.dumps(data), chat, user))
+    app.storage.conn.executemany("UPDATE fsm_states SET chat=?, user=?, data=? WHERE chat=? AND user=?", remapped)
+    app.storage.conn.commit()
+    app.conn.commit()
+
+
+def update_kind(update):
+    if 'callback_query' in update:
+        return 'callback:' + re.sub(r'_?\d.*$', '', update['callback_query'].get('data') or '')
+    message = update.get('message', {})
+    text = message.get('text')
+    if text is None:
+        return 'photo' if 'photo' in message else 'media'
+    if text.startswith('/'):
+        return text.split()[0]
+    if set(text) == {'x'}:
+        return 'text'
+    return 'number' if text.isdigit() else text
+
+
+async def replay(args, files, db_path):
+    api = FakeBotAPI(args.latency, args.jitter, args.rate_limit, seed=args.seed)
+    api_url = await api.start()
+    app = load_app(db_path, api_url)
+    logging.getLogger().setLevel(args.log_level)
+    if args.remap:
+        remap_user_ids(app)
+    tracker = CompletionTracker()
+    tracker.install(app.dp)
+    app.Dispatcher.set_current(app.dp)
+    app.Bot.set_current(app.bot)
+    await app.start_background_jobs(0)
+    polling = asyncio.create_task(app.dp.start_polling(timeout=app.POLLING_TIMEOUT, limit=app.POLLING_LIMIT,
+                                                       relax=app.POLLING_RELAX, allowed_updates=app.ALLOWED_UPDATES))
+    pending = []
+    lags = []
+    started = time.perf_counter()
+    first_ts = None
+    try:
+        for record in read_records(files):
+            if args.limit and len(pending) >= args.limit:
+                break
+            if first_ts is None:
+                first_ts = record['ts']
+            if args.speed > 0:
+                delay = (record['ts'] - first_ts) / args.speed - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    lags.append(-delay * 1000)
+            pushed = time.perf_counter()
+            pending.append((update_kind(record['update']), pushed, tracker.expect(api.push(record['update']))))
+        latencies = defaultdict(list)
+        timeouts = 0
+        for kind, pushed, waiter in pending:
+            try:
+                finished = await asyncio.wait_for(waiter, args.timeout)
+                latencies[kind].append((finished - pushed) * 1000)
+            except asyncio.TimeoutError:
+                timeouts += 1
+        elapsed = time.perf_counter() - started
+    finally:
+        app.dp.stop_polling()
+        await polling
+        await app.stop_background_jobs()
+        await app.storage.close()
+        await app.storage.wait_closed()
+        await (await app.bot.get_session()).close()
+        await api.stop()
+
+    updates = sum(len(samples) for samples in latencies.values())
+    calls = sum(count for method, count in api.calls.items() if method not in ('getUpdates', 'getMe', 'deleteWebhook'))
+    print(f"\nReplayed {updates} updates in {elapsed:.1f}s, {updates / elapsed:.1f} updates/s, timeouts: {timeouts}")
+    print(f"API calls: {calls}, {calls / max(updates, 1):.2f} per update, 429 responses: {api.rate_limited}")
+    if lags:
+        print(f"Behind schedule: {len(lags)} updates, mean {statistics.fmean(lags):.1f} ms, max {max(lags):.1f} ms")
+    print(f"\n{'update':<40}{'count':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for kind, samples in sorted(latencies.items(), key=lambda item: -len(item[1]))[:args.top]:
+        print(f"{kind[:39]:<40}{len(samples):>8}{percentile(samples, 0.5):>9.1f}{percentile(samples, 0.95):>9.1f}"
+              f"{percentile(samples, 0.99):>9.1f}{max(samples):>9.1f}")
+    print(f"\n{'handler':<40}{'count':>8}{'errors':>8}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, histogram in sorted(app.metrics.handler_latency.items(), key=lambda item: -item[1].count):
+        print(f"{name[:39]:<40}{histogram.count:>8}{app.metrics.handler_errors[name]:>8}"
+              f"{histogram.percentile(0.5) * 1000:>9.1f}{histogram.percentile(0.95) * 1000:>9.1f}"
+              f"{histogram.percentile(0.99) * 1000:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded updates against a copy of the database")
+    parser.add_argument('recordings', nargs='+', help="JSONL files or directories written by RECORD_UPDATES_DIR")
+    parser.add_argument('--db', required=True, help="database to copy, usually a production snapshot")
+    parser.add_argument('--speed', type=float, default=1.0, help="1 keeps recorded timing, 0 replays without pauses")
+    parser.add_argument('--limit', type=int, default=0, help="stop after this many updates")
+    parser.add_argument('--remap', action=argparse.BooleanOptionalAction, default=True,
+                        help="rewrite database user ids with the recording salt")
+    parser.add_argument('--latency', type=float, default=0, help="Bot API latency, ms")
+    parser.add_argument('--jitter', type=float, default=0, help="Bot API latency deviation, ms")
+    parser.add_argument('--rate-limit', type=float, default=0, help="share of calls answered with 429")
+    parser.add_argument('--timeout', type=float, default=60, help="seconds to wait for one update")
+    parser.add_argument('--top', type=int, default=25, help="update kinds to show")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    files = recording_files(args.recordings)
+    if not files:
+        parser.error("no recordings found")
+    super_admin_id = read_meta(files).get('super_admin_id')
+    if super_admin_id:
+        os.environ['SUPER_ADMIN_ID'] = str(super_admin_id)
+
+    workdir = tempfile.mkdtemp(prefix='replay_')
+    db_path = os.path.join(workdir, 'replay.db')
+    copy_database(args.db, db_path)
+    try:
+        asyncio.run(replay(args, files, db_path))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
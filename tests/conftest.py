@@ -0,0 +1,147 @@
+"""
+Shared fixtures. app.py is imported once against a temporary database, Bot API
+calls are answered in-process and every test starts from empty tables.
+"""
+import asyncio
+import itertools
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = tempfile.mkdtemp(prefix='bot_tests_')
+os.environ.update({
+    'DB_PATH': os.path.join(DATA_DIR, 'bot.db'),
+    'FSM_DB_PATH': os.path.join(DATA_DIR, 'fsm.db'),
+    'API_TOKEN': '123456:test',
+    'SUPER_ADMIN_ID': '1',
+    'BOT_MODE': 'polling',
+    'BOT_WORKERS': '1',
+    'METRICS_PORT': '0',
+    'RECORD_UPDATES_DIR': '',
+})
+sys.path.insert(0, ROOT)
+
+import app  # noqa: E402
+from aiogram import Bot, Dispatcher, types  # noqa: E402
+from aiogram.bot import api as aiogram_api  # noqa: E402
+
+BOT_ID = 123
+TABLES = ('users', 'likes', 'dislikes', 'skips', 'logs', 'invitations', 'admins', 'feed_pages', 'purge_queue', 'admin_events')
+ids = itertools.count(1000)
+
+
+@pytest.fixture(scope='session')
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def run(loop):
+    Dispatcher.set_current(app.dp)
+    Bot.set_current(app.bot)
+    return loop.run_until_complete
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    for table in TABLES:
+        app.conn.execute(f"DELETE FROM {table}")
+    app.conn.commit()
+    app.storage.records.clear()
+    app.storage.dirty.clear()
+    app.storage.active.clear()
+    app.storage.conn.execute("DELETE FROM fsm_states")
+    app.storage.conn.commit()
+    app.exhausted_tiers.clear()
+    app.feed_impressions.clear()
+    app.activity_middleware.pending.clear()
+    app.throttling_middleware.buckets.clear()
+    app.profile_index = app.ProfileIndex()
+    yield
+
+
+class FakeBotAPI:
+    def __init__(self):
+        self.calls = []
+        self.errors = {}
+
+    async def make_request(self, session, server, token, method, data=None, files=None, **kwargs):
+        data = data or {}
+        self.calls.append((method, data))
+        # A real request suspends the handler, letting other updates run meanwhile
+        await asyncio.sleep(0)
+        chat_id = data.get('chat_id')
+        if chat_id is not None and int(chat_id) in self.errors and method.startswith('send'):
+            raise self.errors[int(chat_id)]
+        if method == 'getMe':
+            return {'id': BOT_ID, 'is_bot': True, 'first_name': 'Bot', 'username': 'bot'}
+        message = {'message_id': next(ids), 'date': 0, 'chat': {'id': int(chat_id or 0), 'type': 'private'}}
+        if method == 'sendMediaGroup':
+            return [message]
+        if method.startswith('send'):
+            return dict(message, text=data.get('text', ''))
+        return True
+
+    def texts(self, chat_id):
+        return [data.get('text') for method, data in self.calls
+                if method == 'sendMessage' and str(data.get('chat_id')) == str(chat_id)]
+
+
+@pytest.fixture
+def bot_api(monkeypatch):
+    fake = FakeBotAPI()
+    monkeypatch.setattr(aiogram_api, 'make_request', fake.make_request)
+    return fake
+
+
+def user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'u{user_id}', 'username': f'user{user_id}'}
+
+
+def message(user_id, text=None, photo=None):
+    body = {'message_id': next(ids), 'date': 0, 'chat': {'id': user_id, 'type': 'private'}, 'from': user(user_id)}
+    if text is not None:
+        body['text'] = text
+        if text.startswith('/'):
+            body['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    if photo:
+        body['photo'] = [{'file_id': photo, 'file_unique_id': photo, 'width': 1, 'height': 1}]
+    return types.Update(update_id=next(ids), message=body)
+
+
+def callback(user_id, data):
+    # Like Telegram, the attached message is the bot's own one
+    return types.Update(update_id=next(ids), callback_query={
+        'id': str(next(ids)), 'chat_instance': '1', 'data': data, 'from': user(user_id),
+        'message': {'message_id': next(ids), 'date': 0, 'chat': {'id': user_id, 'type': 'private'},
+                    'from': {'id': BOT_ID, 'is_bot': True, 'first_name': 'Bot'}, 'text': 'Действия:'}})
+
+
+def add_user(user_id, gender='женский', seeking_gender='мужской', city='Москва', country='Россия', age=25, **columns):
+    row = {'user_id': user_id, 'username': f'user{user_id}', 'name': f'User{user_id}', 'photos': '["photo"]',
+           'age': age, 'gender': gender, 'seeking_gender': seeking_gender, 'country': country, 'city': city, **columns}
+    app.conn.execute(f"INSERT INTO users ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})", list(row.values()))
+    app.refresh_profile_flags(user_id)
+    app.conn.commit()
+
+
+def profile_form_updates(user_id, gender='Женский 🚺', seeking='Мужской 🚹', country='Россия', city='Москва', age=25):
+    return [message(user_id, f'User{user_id}'), message(user_id, photo=f'photo{user_id}'),
+            message(user_id, 'Готово 📸'), message(user_id, str(age)), message(user_id, gender),
+            message(user_id, 'Пропустить 📝'), message(user_id, seeking), message(user_id, f'{country} 🌍'),
+            message(user_id, f'{city} 🏙️')]
+
+
+def register_updates(user_id, **profile):
+    return [message(user_id, '/start'), *profile_form_updates(user_id, **profile)]
+
+
+def dispatch(run, *updates):
+    # One update at a time, as polling delivers a single user's updates
+    for update in updates:
+        run(app.dp.process_updates([update]))
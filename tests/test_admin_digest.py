@@ -0,0 +1,27 @@
+import app
+
+
+def test_digest_sends_events_from_every_worker_once(run, bot_api, monkeypatch):
+    monkeypatch.setattr(app, 'ADMIN_REALTIME_NOTIFY', False)
+    run(app.notify_admin_event('created', 'created 21', 'User21 (ID: 21)', 'Москва'))
+    # Another worker's event, written through its own connection
+    app.conn.execute("INSERT INTO admin_events (kind, item, city) VALUES ('created', 'User22 (ID: 22)', 'Москва')")
+    app.conn.commit()
+
+    run(app.send_admin_digest())
+    run(app.send_admin_digest())
+    digests = bot_api.texts(app.SUPER_ADMIN_ID)
+    assert len(digests) == 1
+    assert 'Создали анкету: 2' in digests[0]
+    assert 'User21 (ID: 21)' in digests[0] and 'User22 (ID: 22)' in digests[0]
+    assert 'Москва (2)' in digests[0]
+    assert app.conn.execute("SELECT COUNT(*) FROM admin_events").fetchone()[0] == 0
+
+
+def test_only_the_primary_worker_sends_the_digest_on_shutdown(run, bot_api, monkeypatch):
+    monkeypatch.setattr(app, 'ADMIN_REALTIME_NOTIFY', False)
+    run(app.notify_admin_event('mutual', 'mutual', '21 ↔ 22'))
+    run(app.stop_background_jobs(primary=False))
+    assert bot_api.texts(app.SUPER_ADMIN_ID) == []
+    run(app.stop_background_jobs())
+    assert len(bot_api.texts(app.SUPER_ADMIN_ID)) == 1
@@ -0,0 +1,24 @@
+import app
+from conftest import add_user
+
+
+def searcher(user_id=10, **columns):
+    add_user(user_id, gender='мужской', seeking_gender='женский', **columns)
+    return app.conn.execute("SELECT * FROM users WHERE user_id=?", (user_id,)).fetchone()
+
+
+def candidate_for(me):
+    profile = app.find_candidate(me['user_id'], me['seeking_gender'], me['city'], False, me['age'],
+                                 me['pref_age_min'], me['pref_age_max'], me['country'], me['gender'])
+    return profile['user_id'] if profile else None
+
+
+def test_search_keeps_to_the_preferred_age_range():
+    me = searcher(pref_age_min=20, pref_age_max=30)
+    add_user(21, age=40)
+    assert candidate_for(me) is None
+
+    add_user(22, age=25)
+    app.exhausted_tiers.clear()
+    assert candidate_for(me) == 22
+
@@ -0,0 +1,60 @@
+import time
+
+import app
+
+
+def stored_updated_at(storage):
+    return storage.conn.execute("SELECT updated_at FROM fsm_states WHERE chat='7' AND user='7'").fetchone()[0]
+
+
+def test_state_and_data_survive_a_restart(run, tmp_path):
+    path = str(tmp_path / 'fsm.db')
+    storage = app.SQLiteStorage(path)
+    run(storage.set_state(chat=7, user=7, state='ProfileForm:city'))
+    run(storage.update_data(chat=7, user=7, age=30))
+    run(storage.close())
+    run(storage.wait_closed())
+
+    reopened = app.SQLiteStorage(path)
+    assert run(reopened.get_state(chat=7, user=7)) == 'ProfileForm:city'
+    assert run(reopened.get_data(chat=7, user=7)) == {'age': 30}
+
+
+def test_reads_keep_an_active_state_from_expiring(run, tmp_path, monkeypatch):
+    storage = app.SQLiteStorage(str(tmp_path / 'fsm.db'))
+    run(storage.set_state(chat=7, user=7, state='ProfileForm:city'))
+    storage.flush()
+    written = time.time() - 100
+    storage.conn.execute("UPDATE fsm_states SET updated_at=?", (written,))
+    storage.conn.commit()
+
+    assert run(storage.get_state(chat=7, user=7)) == 'ProfileForm:city'
+    storage.flush()
+    assert stored_updated_at(storage) > written
+
+    monkeypatch.setattr(app, 'FSM_STATE_TTL', 50)
+    storage.evict()
+    storage.records.clear()
+    assert run(storage.get_state(chat=7, user=7)) == 'ProfileForm:city'
+
+
+def test_idle_state_expires(run, tmp_path, monkeypatch):
+    storage = app.SQLiteStorage(str(tmp_path / 'fsm.db'))
+    run(storage.set_state(chat=7, user=7, state='ProfileForm:city'))
+    storage.flush()
+    storage.conn.execute("UPDATE fsm_states SET updated_at=?", (time.time() - 100,))
+    storage.conn.commit()
+
+    monkeypatch.setattr(app, 'FSM_STATE_TTL', 50)
+    monkeypatch.setattr(app, 'FSM_HOT_TTL', -1)
+    storage.evict()
+    assert run(storage.get_state(chat=7, user=7)) is None
+
+
+def test_update_data_does_not_keep_the_callers_objects(run, tmp_path):
+    storage = app.SQLiteStorage(str(tmp_path / 'fsm.db'))
+    photos = ['a']
+    run(storage.update_data(chat=7, user=7, data={'photos': photos}))
+    run(storage.update_data(chat=7, user=7, tags=photos))
+    photos.append('b')
+    assert run(storage.get_data(chat=7, user=7)) == {'photos': ['a'], 'tags': ['a']}
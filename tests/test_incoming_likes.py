@@ -0,0 +1,46 @@
+import app
+from conftest import add_user, callback, dispatch, message
+
+
+def receive_likes(user_id, *likers):
+    add_user(user_id, gender='мужской', seeking_gender='женский')
+    for liker in likers:
+        add_user(liker)
+        app.conn.execute("INSERT INTO likes (from_user, to_user) VALUES (?, ?)", (liker, user_id))
+    app.conn.commit()
+
+
+def next_liker(user_id):
+    row = app.find_incoming_liker(user_id)
+    return row['user_id'] if row else None
+
+
+def test_inbox_walks_likes_in_arrival_order(run, bot_api):
+    receive_likes(10, 21, 22, 23)
+    dispatch(run, message(10, 'Кто меня лайкнул ❤️'), callback(10, 'skip_incoming_21'))
+    assert next_liker(10) == 22
+    assert app.count_pending_likes(10) == 2
+
+
+def test_answering_a_later_like_keeps_older_likers_pending(run, bot_api):
+    receive_likes(10, 21, 22, 23)
+    app.mark_like_handled(10, 22)
+    assert next_liker(10) == 21
+    assert app.count_pending_likes(10) == 2
+
+    app.mark_like_handled(10, 21)
+    assert next_liker(10) == 23
+    assert app.count_pending_likes(10) == 1
+
+
+def test_like_reusing_a_purged_rowid_stays_pending(run, bot_api):
+    receive_likes(10, 21)
+    app.mark_like_handled(10, 21)
+    answered = app.conn.execute("SELECT rowid FROM likes WHERE from_user = 21").fetchone()[0]
+    app.conn.execute("DELETE FROM likes WHERE from_user = 21")
+    add_user(22)
+    app.conn.execute("INSERT INTO likes (from_user, to_user) VALUES (22, 10)")
+    app.conn.commit()
+    assert app.conn.execute("SELECT rowid FROM likes WHERE from_user = 22").fetchone()[0] == answered
+    assert next_liker(10) == 22
+    assert app.count_pending_likes(10) == 1
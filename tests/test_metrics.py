@@ -0,0 +1,51 @@
+import app
+from conftest import add_user
+
+
+def observations(sql):
+    histogram = app.metrics.query_latency.get(app.query_fingerprint(sql))
+    return histogram.count if histogram else 0
+
+
+def test_statement_read_with_fetchall_is_observed_once():
+    add_user(10)
+    sql = "SELECT user_id FROM users WHERE age > ?"
+    before = observations(sql)
+    app.cursor.execute(sql, (18,))
+    app.cursor.fetchall()
+    assert observations(sql) == before + 1
+
+
+def test_statement_read_with_fetchone_is_observed_when_next_statement_starts():
+    add_user(10)
+    add_user(11)
+    sql = "SELECT user_id FROM users WHERE age < ?"
+    before = observations(sql)
+    app.cursor.execute(sql, (99,))
+    app.cursor.fetchone()
+    assert observations(sql) == before
+    app.cursor.execute("SELECT 1")
+    assert observations(sql) == before + 1
+
+
+def test_write_is_observed_right_away_and_checked_for_slowness(monkeypatch):
+    add_user(10)
+    monkeypatch.setattr(app, 'SLOW_QUERY_MS', 0)
+    sql = "UPDATE users SET age = ? WHERE user_id = ?"
+    before, slow_before = observations(sql), app.metrics.slow_queries[app.query_fingerprint(sql)]
+    app.cursor.execute(sql, (30, 10))
+    assert observations(sql) == before + 1
+    assert app.metrics.slow_queries[app.query_fingerprint(sql)] == slow_before + 1
+    app.conn.commit()
+
+
+def test_slow_batch_is_explained_with_its_first_row(monkeypatch, caplog):
+    add_user(10)
+    add_user(11)
+    monkeypatch.setattr(app, 'SLOW_QUERY_MS', 0)
+    sql = "UPDATE users SET impressions = impressions + ? WHERE user_id = ?"
+    app.slow_query_logged.pop(app.query_fingerprint(sql), None)
+    app.cursor.executemany(sql, ((1, user_id) for user_id in (10, 11)))
+    app.conn.commit()
+    assert 'SEARCH users USING INTEGER PRIMARY KEY' in caplog.text
+    assert 'EXPLAIN failed' not in caplog.text
@@ -0,0 +1,28 @@
+import socket
+
+from aiogram.dispatcher.handler import current_handler
+
+import app
+
+
+def test_busy_metrics_port_does_not_stop_startup(run):
+    with socket.socket() as taken:
+        taken.bind((app.METRICS_HOST, 0))
+        taken.listen()
+        runners = len(app.metrics_runners)
+        run(app.start_metrics_server(taken.getsockname()[1]))
+        assert len(app.metrics_runners) == runners
+
+
+def test_handler_name_is_reset_after_the_handler(run):
+    middleware = app.MetricsMiddleware()
+
+    async def handled():
+        current_handler.set(test_handler_name_is_reset_after_the_handler)
+        data = {}
+        await middleware.on_process_message(None, data)
+        inside = app.current_handler_name.get()
+        await middleware.on_post_process_message(None, [], data)
+        return inside, app.current_handler_name.get()
+
+    assert run(handled()) == ('test_handler_name_is_reset_after_the_handler', None)
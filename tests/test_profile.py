@@ -0,0 +1,19 @@
+import app
+from conftest import add_user, callback, dispatch, profile_form_updates, register_updates
+
+
+def test_registration_creates_searchable_profile(run, bot_api):
+    dispatch(run, *register_updates(10))
+    row = app.conn.execute("SELECT name, city, is_complete, is_searchable FROM users WHERE user_id=10").fetchone()
+    assert tuple(row) == ('User10', 'Москва', 1, 1)
+
+
+def test_profile_save_keeps_columns_outside_the_form(run, bot_api):
+    add_user(10, pref_age_min=20, pref_age_max=30, impressions=5, invited_count=3, blocked=0,
+             last_seen='2030-01-01 00:00:00')
+    # An admin re-fills the whole form, which saves every form field at once
+    dispatch(run, callback(1, 'admin_edit_10'), *profile_form_updates(1, city='Санкт-Петербург'))
+    row = app.conn.execute('''
+    SELECT city, pref_age_min, pref_age_max, impressions, invited_count, last_seen FROM users WHERE user_id=10
+    ''').fetchone()
+    assert tuple(row) == ('Санкт-Петербург', 20, 30, 5, 3, '2030-01-01 00:00:00')
@@ -0,0 +1,31 @@
+import app
+from conftest import add_user
+
+
+def count(table, condition):
+    return app.conn.execute(f"SELECT COUNT(*) FROM {table} WHERE {condition}").fetchone()[0]
+
+
+def test_deleted_user_is_hidden_at_once_and_purged_later(run):
+    add_user(10, gender='мужской', seeking_gender='женский')
+    add_user(21)
+    add_user(22)
+    for table in ('likes', 'dislikes', 'skips'):
+        app.conn.execute(f"INSERT INTO {table} (from_user, to_user) VALUES (21, 10), (10, 21), (22, 10)")
+    app.conn.execute("INSERT INTO logs (user_id, action) VALUES (21, 'x'), (22, 'x')")
+    app.conn.execute("INSERT INTO invitations (inviter_id, invited_id) VALUES (21, 22), (22, 10)")
+    app.conn.commit()
+
+    app.soft_delete_user(21)
+    assert count('users', 'user_id = 21 AND is_searchable = 0 AND blocked = 1') == 1
+    assert app.find_candidate(10, 'женский', 'Москва', False, 25, None, None, 'Россия', 'мужской')['user_id'] == 22
+
+    assert run(app.purge_deleted_users()) == 1
+    assert count('users', 'user_id = 21') == 0
+    assert count('purge_queue', '1 = 1') == 0
+    for table, column in app.PURGE_COLUMNS:
+        assert count(table, f'{column} = 21') == 0
+    for table in ('likes', 'dislikes', 'skips'):
+        assert count(table, 'from_user = 22') == 1
+    assert count('logs', 'user_id = 22') == 1
+    assert count('invitations', 'inviter_id = 22') == 1
@@ -0,0 +1,38 @@
+import json
+
+import app
+import replay
+
+
+def photo_update(user_id, file_id):
+    return {'update_id': 1, 'message': {
+        'message_id': 1, 'date': 0, 'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'Anna', 'username': 'anna'},
+        'caption': 'my photo',
+        'photo': [{'file_id': file_id, 'file_unique_id': file_id + 'u', 'width': 90, 'height': 90, 'file_size': 100}],
+        'document': {'file_id': file_id + 'doc', 'file_unique_id': file_id + 'docu', 'file_name': 'passport.pdf',
+                     'thumb': {'file_id': file_id + 'thumb', 'file_unique_id': file_id + 'thumbu', 'width': 1, 'height': 1}},
+    }}
+
+
+def test_recorded_media_carries_no_file_ids_or_names(tmp_path):
+    recorder = app.UpdateRecorder(str(tmp_path), 1024)
+    scrubbed = recorder.scrub_update(photo_update(555000111, 'AgACAgIAAxkBAAI'))
+    dumped = json.dumps(scrubbed)
+    assert 'AgACAgIAAxkBAAI' not in dumped
+    assert 'passport' not in dumped and 'Anna' not in dumped and '555000111' not in dumped
+    assert scrubbed['message']['photo'][0]['width'] == 90
+    # The same file maps to the same placeholder, so replays send consistent ids
+    again = recorder.scrub_update(photo_update(555000111, 'AgACAgIAAxkBAAI'))
+    assert again['message']['photo'] == scrubbed['message']['photo']
+
+
+def test_replay_remaps_every_user_id_column():
+    columns = {}
+    for (table,) in app.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'"):
+        for column in app.conn.execute(f"PRAGMA table_info({table})"):
+            name = column[1]
+            if name in ('user_id', 'from_user', 'to_user') or name.endswith('ed_id') or name.endswith('er_id'):
+                columns.setdefault(table, set()).add(name)
+    for table, names in columns.items():
+        assert names <= set(replay.REMAP_COLUMNS.get(table, ())), table
@@ -0,0 +1,41 @@
+import app
+from conftest import add_user
+
+
+def index_sql(name):
+    row = app.conn.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+
+def test_match_indexes_are_built_before_serving():
+    for name, definition in app.MATCH_INDEXES.items():
+        assert index_sql(name) == f"CREATE INDEX {name} ON {definition}"
+
+
+def test_changed_match_index_definition_is_swapped():
+    app.conn.execute("DROP INDEX idx_match_city")
+    app.conn.execute("CREATE INDEX idx_match_city ON users(gender, seeking_gender, city, is_searchable, age)")
+    app.conn.commit()
+    assert app.build_match_indexes(app.conn) == ['idx_match_city']
+    assert index_sql('idx_match_city') == f"CREATE INDEX idx_match_city ON {app.MATCH_INDEXES['idx_match_city']}"
+
+
+def test_tier_window_is_taken_in_ranking_order(monkeypatch):
+    monkeypatch.setattr(app, 'TIER_SCAN_LIMIT', 2)
+    add_user(10, gender='мужской', seeking_gender='женский')
+    for user_id in (21, 22, 23):
+        add_user(user_id, age=20, last_seen='2030-01-01 00:00:00')
+    # Oldest and least recently seen, so it is last in age order and in activity order
+    add_user(24, age=60, premium=1)
+    assert app.cursor.execute(*app.tier_candidate_query('city', 'Москва', 10, 'мужской', 'женский')).fetchone()['user_id'] == 24
+
+
+def test_exhausted_tiers_drop_expired_keys_and_stay_under_the_cap(monkeypatch):
+    monkeypatch.setattr(app, 'TIER_EMPTY_MAX', 3)
+    app.exhausted_tiers['expired'] = 0.0
+    app.mark_tier_exhausted('a')
+    assert list(app.exhausted_tiers) == ['a']
+    for key in ('b', 'c', 'd', 'a'):
+        app.mark_tier_exhausted(key)
+    assert list(app.exhausted_tiers) == ['c', 'd', 'a']
+    assert app.tier_exhausted('a') and not app.tier_exhausted('b')
@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+from aiogram.dispatcher.handler import CancelHandler
+
+import app
+from conftest import message, register_updates
+
+
+def test_a_users_updates_run_in_arrival_order(run, bot_api):
+    # Delivered together, as one polling batch; each step depends on the state the previous one set
+    run(app.dp.process_updates(register_updates(10)))
+    row = app.conn.execute("SELECT name, city, is_searchable FROM users WHERE user_id=10").fetchone()
+    assert tuple(row) == ('User10', 'Москва', 1)
+    assert not app.serialization_middleware.user_locks
+
+
+def test_a_flooding_user_is_shed_without_dropping_others(run):
+    middleware = app.UserSerializationMiddleware(limit=1, max_queued=1, max_user_queued=2)
+
+    async def flood():
+        await middleware.on_pre_process_update(message(10, 'a'), {})
+        # Waits behind the user's own first update, not for a free slot
+        waiting = asyncio.create_task(middleware.on_pre_process_update(message(10, 'b'), {}))
+        other = asyncio.create_task(middleware.on_pre_process_update(message(20, 'c'), {}))
+        await asyncio.sleep(0)
+        with pytest.raises(CancelHandler):
+            await middleware.on_pre_process_update(message(10, 'd'), {})
+        assert not other.done() and middleware.queued == 1
+        waiting.cancel()
+        other.cancel()
+
+    run(flood())
+    assert middleware.shed == 1
+
+
+def test_slot_is_released_when_post_process_is_skipped(run):
+    middleware = app.UserSerializationMiddleware(limit=1, max_queued=10, max_user_queued=10)
+
+    async def cancelled_by_a_later_middleware():
+        await middleware.on_pre_process_update(message(10, 'a'), {})
+
+    run(cancelled_by_a_later_middleware())
+    assert not middleware.semaphore.locked()
+    assert not middleware.user_locks
+    assert middleware.in_flight == 0
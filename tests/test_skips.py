@@ -0,0 +1,34 @@
+import app
+from conftest import add_user
+
+
+def skip(from_user, to_user, days_ago):
+    app.conn.execute("INSERT INTO skips (from_user, to_user, created_at) VALUES (?, ?, datetime('now', ?))",
+                     (from_user, to_user, f'-{days_ago} days'))
+    app.conn.commit()
+
+
+def candidate_for(user_id):
+    profile = app.find_candidate(user_id, 'женский', 'Москва', False, 25, None, None, 'Россия', 'мужской')
+    return profile['user_id'] if profile else None
+
+
+def test_skipped_profile_returns_after_the_ttl():
+    add_user(10, gender='мужской', seeking_gender='женский')
+    add_user(21)
+    skip(10, 21, 1)
+    assert candidate_for(10) is None
+
+    app.conn.execute("DELETE FROM skips")
+    skip(10, 21, app.SKIP_TTL_DAYS + 1)
+    app.exhausted_tiers.clear()
+    assert candidate_for(10) == 21
+
+
+def test_compaction_deletes_only_expired_skips(run):
+    skip(10, 21, 1)
+    skip(10, 22, app.SKIP_TTL_DAYS + 1)
+    skip(11, 21, app.SKIP_TTL_DAYS + 2)
+    deleted = run(app.delete_in_batches('skips', f"created_at <= datetime('now', '-{app.SKIP_TTL_DAYS} days')", batch=1))
+    assert deleted == 2
+    assert [tuple(row) for row in app.conn.execute("SELECT from_user, to_user FROM skips")] == [(10, 21)]
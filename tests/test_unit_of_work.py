@@ -0,0 +1,41 @@
+import sqlite3
+
+import pytest
+
+import app
+from conftest import add_user
+
+
+def committed(sql):
+    # A separate connection sees only what has been committed
+    other = sqlite3.connect(app.DB_PATH)
+    try:
+        return other.execute(sql).fetchone()[0]
+    finally:
+        other.close()
+
+
+def test_failed_block_rolls_back_writes_of_helpers_that_commit():
+    add_user(10, gender='мужской', seeking_gender='женский')
+    add_user(21)
+    app.conn.execute("INSERT INTO likes (from_user, to_user) VALUES (21, 10)")
+    app.conn.commit()
+
+    with pytest.raises(RuntimeError):
+        with app.unit_of_work():
+            app.cursor.execute("INSERT INTO dislikes (from_user, to_user) VALUES (10, 21)")
+            app.mark_like_handled(10, 21)
+            raise RuntimeError
+    assert app.conn.depth == 0
+    assert committed("SELECT COUNT(*) FROM dislikes") == 0
+    assert committed("SELECT handled FROM likes WHERE from_user = 21") == 0
+
+
+def test_nested_blocks_commit_once_at_the_outer_end():
+    with app.unit_of_work():
+        app.cursor.execute("INSERT INTO logs (user_id, action) VALUES (10, 'outer')")
+        with app.unit_of_work():
+            app.cursor.execute("INSERT INTO logs (user_id, action) VALUES (10, 'inner')")
+        app.conn.commit()
+        assert committed("SELECT COUNT(*) FROM logs") == 0
+    assert committed("SELECT COUNT(*) FROM logs") == 2